@@ -0,0 +1,135 @@
+"""
+@author: Vitor Eller - @VFermat
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from HXLFactors import HXLFactors
+
+# Inputs of HXLFactors.calculate_factors, in the order of its arguments
+FIELDS = ['prices', 'dividends', 'assets', 'ROE', 'marketcap']
+
+# Input panels attached by each worker process
+_panels = {}
+
+
+def run_batch(panels, jobs, processes=None):
+    """
+    Calculates the factors of several jobs on a pool of processes. The input
+    panels are placed in shared memory once and every worker reads them from
+    there, instead of receiving a pickled copy for each job.
+
+    Parameters
+    ----------
+    panels : Dict like
+        A dict containing one DataFrame (stocks x dates) for each input, keyed
+        as the arguments of HXLFactors.calculate_factors (see
+        HXLLoader.load_workbook).
+    jobs : List or Dict like
+        Jobs to be run, each a tuple (universe, parameters). Universe is a list
+        of tickers (None for every ticker) and parameters is a dict of keyword
+        arguments to HXLFactors. If a dict, its keys name the jobs; otherwise
+        jobs are named by their position.
+    processes : int
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Return
+    ----------
+    factors : DataFrame
+        A tidy DataFrame with columns job, date, factor ('HXLInvestment' or
+        'HXLProfit') and value.
+    """
+
+    if not isinstance(jobs, dict):
+        jobs = dict(enumerate(jobs))
+
+    blocks = {}
+    try:
+        layout = {}
+        for field in FIELDS:
+            panel = panels[field]
+            values = np.ascontiguousarray(panel.values, dtype=float)
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            blocks[field] = block
+            np.ndarray(values.shape, dtype=float, buffer=block.buf)[:] = values
+            layout[field] = (block.name, values.shape, panel.index, panel.columns)
+
+        with ProcessPoolExecutor(max_workers=processes or os.cpu_count(),
+                                 initializer=_attach, initargs=(layout,)) as pool:
+            futures = [pool.submit(_run_job, name, universe, parameters)
+                       for name, (universe, parameters) in jobs.items()]
+            results = [future.result() for future in futures]
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+    return pd.concat(results, ignore_index=True)
+
+
+def _attach(layout):
+    """
+    Initializes a worker process, wrapping the shared input panels in
+    DataFrames without copying them.
+
+    Parameters
+    ----------
+    layout : Dict like
+        A dict containing, for each input, the name of its shared memory block,
+        its shape, its index and its columns.
+    """
+
+    for field, (name, shape, index, columns) in layout.items():
+        try:
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 the block is tracked, by the resource tracker
+            # the worker shares with the parent, which unlinks it
+            block = shared_memory.SharedMemory(name=name)
+        values = np.ndarray(shape, dtype=float, buffer=block.buf)
+        _panels[field] = (block, pd.DataFrame(values, index=index,
+                                              columns=columns, copy=False))
+
+
+def _run_job(name, universe, parameters):
+    """
+    Calculates the factors of one job on the shared input panels.
+
+    Parameters
+    ----------
+    name : Hashable
+        Name of the job.
+    universe : List like
+        Tickers of the job, None for every ticker.
+    parameters : Dict like
+        Keyword arguments to HXLFactors.
+
+    Return
+    ----------
+    factors : DataFrame
+        A tidy DataFrame containing the factors of the job.
+    """
+
+    inputs = []
+    for field in FIELDS:
+        panel = _panels[field][1]
+        if universe is not None:
+            panel = panel[panel.index.isin(universe)]
+        inputs.append(panel)
+
+    hxl = HXLFactors(**(parameters or {}))
+    hxl.calculate_factors(*inputs)
+
+    factors = []
+    for factor in ['HXLInvestment', 'HXLProfit']:
+        series = getattr(hxl, factor)
+        factors.append(pd.DataFrame({'job': name, 'date': series.index,
+                                     'factor': factor,
+                                     'value': series.values.astype(float)}))
+
+    return pd.concat(factors, ignore_index=True)
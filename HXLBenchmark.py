@@ -0,0 +1,241 @@
+"""
+@author: Vitor Eller - @VFermat
+
+Benchmarks the stages of HXLFactors.calculate_factors on synthetic panels.
+
+    python HXLBenchmark.py --stocks 100 1000 --months 60 240 --output bench.json
+    python HXLBenchmark.py --baseline bench.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+
+from HXLFactors import HXLFactors
+
+# Version of the results written by main. Results without one (version 1)
+# named the three alignments '_get_aligned', in the order of ALIGNED
+VERSION = 2
+ALIGNED = ['_get_aligned[dividends]', '_get_aligned[assets]', '_get_aligned[ROE]']
+
+def generate_panels(stocks=500, months=120, seed=0, start='2000-01-31'):
+    """
+    Generates synthetic inputs for HXLFactors.calculate_factors. Stocks list
+    and delist along the sample (NaN outside their life), prices follow fat
+    tailed random walks, and assets, ROE and dividends are released quarterly,
+    with missing releases, zero ROE and non dividend payers.
+
+    Parameters
+    ----------
+    stocks : int
+        Number of stocks.
+    months : int
+        Number of months.
+    seed : int
+        Seed of the random generator.
+    start : String
+        First month of the sample.
+
+    Return
+    ----------
+    panels : Dict
+        A dict containing one DataFrame (stocks x dates) for each input, keyed
+        as the arguments of HXLFactors.calculate_factors.
+    """
+
+    rng = np.random.default_rng(seed)
+    tickers = ['S{:05d} US Equity'.format(i) for i in range(stocks)]
+    dates = pd.date_range(start, periods=months, freq=MonthEnd())
+    quarters = np.arange(2, months, 3)
+
+    # Life of each stock
+    listing = rng.integers(-months, 2*months // 3, stocks)
+    delisting = listing + rng.integers(36, 3*months + 37, stocks)
+    month = np.arange(months)
+    alive = (month >= listing[:, np.newaxis]) & (month < delisting[:, np.newaxis])
+
+    # Prices and marketcap
+    returns = np.clip(0.008 + 0.06*rng.standard_t(4, (stocks, months)), -0.9, None)
+    prices = 20*np.exp(np.cumsum(np.log1p(returns), axis=1))
+    prices[~alive | (rng.random((stocks, months)) < 0.005)] = np.nan
+    shares = rng.lognormal(18, 1.5, stocks)
+    marketcap = prices*shares[:, np.newaxis]
+
+    # Quarterly fundamentals
+    released = alive[:, quarters]
+    growth = rng.normal(0.015, 0.05, (stocks, len(quarters)))
+    assets = 0.6*marketcap[:, quarters[:1]]*np.exp(np.cumsum(growth, axis=1))
+    assets = np.where(np.isnan(assets), rng.lognormal(21, 1.5, (stocks, 1)), assets)
+    assets[~released | (rng.random(released.shape) < 0.02)] = np.nan
+
+    ROE = rng.normal(0.12, 0.15, released.shape)
+    ROE[rng.random(released.shape) < 0.01] = 0
+    ROE[~released | (rng.random(released.shape) < 0.03)] = np.nan
+
+    payers = rng.random(stocks) < 0.6
+    dividends = prices[:, quarters]*rng.uniform(0.002, 0.01, (stocks, 1))
+    dividends[~payers] = 0
+    dividends[~released] = np.nan
+
+    frame = lambda values, columns: pd.DataFrame(values, index=tickers, columns=columns)
+
+    return {
+            'prices': frame(prices, dates),
+            'dividends': frame(dividends, dates[quarters]),
+            'assets': frame(assets, dates[quarters]),
+            'ROE': frame(ROE, dates[quarters]),
+            'marketcap': frame(marketcap, dates)
+            }
+
+
+def run_benchmark(stocks, months, seed=0, memory=True, **parameters):
+    """
+    Runs calculate_factors once on synthetic panels, timing each stage.
+
+    Parameters
+    ----------
+    stocks : int
+        Number of stocks.
+    months : int
+        Number of months.
+    seed : int
+        Seed of the random generator.
+    memory : Boolean
+        If True, the peak memory allocated by each stage is traced (with
+        tracemalloc, which slows the stages down).
+    parameters : Dict like
+        Keyword arguments to HXLFactors.
+
+    Return
+    ----------
+    records : List
+        One dict per stage (plus 'calculate_factors' for the whole run) with
+        the stocks, months, stage, wall and CPU times in seconds, growth of 
+        the peak RSS and traced peak memory in bytes (None if not available),
+        as in HXLFactors.profile_report.
+    """
+
+    panels = generate_panels(stocks, months, seed)
+    hxl = HXLFactors(profile='memory' if memory else True, **parameters)
+    hxl.calculate_factors(panels['prices'], panels['dividends'], panels['assets'],
+                          panels['ROE'], panels['marketcap'])
+
+    report = hxl.profile_report[['stage', 'wall', 'cpu', 'rss_peak', 'traced_peak']]
+    records = []
+    for record in report.to_dict('records'):
+        record = {key: None if pd.isna(value) else value
+                  for key, value in record.items()}
+        records.append(dict({'stocks': stocks, 'months': months}, **record))
+
+    return records
+
+
+def compare(baseline, current, tolerance=0.25):
+    """
+    Compares two benchmark results, listing the stages that got slower.
+
+    Parameters
+    ----------
+    baseline : Dict like
+        Benchmark result used as reference (as written by main). Stages of
+        results of older versions are renamed as in the current one.
+    current : Dict like
+        Benchmark result being checked.
+    tolerance : float
+        Relative slowdown accepted.
+
+    Return
+    ----------
+    regressions : List
+        One dict per slower stage, with its size, stage and both wall times.
+    """
+
+    key = lambda record: (record['stocks'], record['months'], record['stage'])
+    reference = {key(record): record['wall'] for record in _records(baseline)}
+    regressions = []
+    for record in _records(current):
+        wall = reference.get(key(record))
+        if wall is not None and record['wall'] > wall*(1 + tolerance):
+            regressions.append({'stocks': record['stocks'], 'months': record['months'],
+                                'stage': record['stage'], 'baseline': wall,
+                                'current': record['wall']})
+
+    return regressions
+
+
+def _records(result):
+    """
+    Records of a benchmark result, with the stages of older versions renamed
+    as in the current one.
+    """
+
+    records = result['results']
+    if result.get('version', 1) >= VERSION:
+        return records
+
+    seen = {}
+    renamed = []
+    for record in records:
+        if record['stage'] == '_get_aligned':
+            size = (record['stocks'], record['months'])
+            seen[size] = seen.get(size, -1) + 1
+            record = dict(record, stage=ALIGNED[seen[size]])
+        renamed.append(record)
+
+    return renamed
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--stocks', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--months', type=int, nargs='+', default=[60, 240])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not trace memory allocations (tracing slows the stages down)')
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = []
+    for stocks in args.stocks:
+        for months in args.months:
+            results += run_benchmark(stocks, months, args.seed, not args.no_memory)
+
+    current = {
+            'version': VERSION,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'seed': args.seed,
+            'results': results
+            }
+
+    for record in results:
+        print('{stocks:>6} x {months:<4} {stage:<24} {wall:10.4f}s {cpu:10.4f}s'.format(**record)
+              + ('' if record['traced_peak'] is None
+                 else ' {:14,d} B'.format(int(record['traced_peak']))))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), current, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {stocks} x {months} {stage}: {baseline:.4f}s -> '
+                  '{current:.4f}s'.format(**regression))
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""
+@author: Vitor Eller - @VFermat
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from HXLFactors import HXLFactors
+
+FACTORS = ['HXLInvestment', 'HXLProfit']
+STATISTICS = ['mean', 'tstat', 'sharpe']
+
+
+def bootstrap(hxl, resamples=1000, method='stocks', block=1, batch=100,
+              threads=None, seed=None, periods=12):
+    """
+    Calculates the distributions of the mean, t-stat and Sharpe ratio of the
+    factors over bootstrap resamples. The resamples are drawn in batches,
+    each processed as a single array operation, and batches run on parallel
+    threads.
+
+    Resampling stocks redraws the universe (tickers with replacement) and
+    rebuilds the portfolios from the returns, marketcaps and classifications
+    already calculated by hxl, so breakpoints are not calculated again.
+    Resampling months redraws the factor series in blocks of consecutive
+    months.
+
+    Parameters
+    ----------
+    hxl : HXLFactors
+        An HXLFactors object whose factors were calculated.
+    resamples : int
+        Number of resamples.
+    method : String
+        'stocks' to resample the universe or 'months' to resample the factor
+        series.
+    block : int
+        Length of the blocks of months resampled (method 'months').
+    batch : int
+        Number of resamples processed at once.
+    threads : int
+        Number of threads. Defaults to the number of CPUs.
+    seed : int
+        Seed of the random generator. Results do not depend on the number of
+        threads.
+    periods : int
+        Number of months in a year, annualizing the Sharpe ratio.
+
+    Return
+    ----------
+    distributions : DataFrame
+        A DataFrame (resamples x (factor, statistic)) containing the mean,
+        tstat and sharpe of HXLInvestment and HXLProfit on each resample.
+    """
+
+    if method == 'stocks':
+        panels = _stock_panels(hxl)
+        draw = lambda rng, size: _stock_factors(
+                rng.multinomial(panels['stocks'], np.full(panels['stocks'],
+                                                          1/panels['stocks']), size),
+                panels)
+    elif method == 'months':
+        series = np.vstack([getattr(hxl, factor).values.astype(float)
+                            for factor in FACTORS])
+        draw = lambda rng, size: _month_factors(rng, size, series, block)
+    else:
+        raise ValueError('Unknown resampling method: {}.'.format(method))
+
+    sizes = [min(batch, resamples - start) for start in range(0, resamples, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    run = lambda job: _statistics(draw(np.random.default_rng(job[0]), job[1]),
+                                  periods)
+
+    with ThreadPoolExecutor(min(threads or os.cpu_count() or 1,
+                                max(len(sizes), 1))) as pool:
+        results = list(pool.map(run, zip(seeds, sizes)))
+
+    columns = pd.MultiIndex.from_product([FACTORS, STATISTICS],
+                                         names=['factor', 'statistic'])
+
+    return pd.DataFrame(np.vstack(results) if results else np.empty((0, len(columns))),
+                        columns=columns)
+
+
+def _stock_panels(hxl):
+    """
+    Gathers, from the calculated factors, the panels used to rebuild the
+    portfolios of resampled universes: the value weighted lagged returns and
+    the weights of each portfolio, following hxl's treatment of NaN returns.
+    The panels of the portfolios are masked once, here, and laid side by side
+    so every batch of resamples is a single product with them.
+
+    Parameters
+    ----------
+    hxl : HXLFactors
+        An HXLFactors object whose factors were calculated.
+
+    Return
+    ----------
+    panels : Dict
+        A dict containing the number of stocks and months, and the weighted 
+        returns, the weights and the NaN returns (None unless they propagate)
+        of the members of each portfolio, zero elsewhere (stocks x 
+        portfolios*months).
+    """
+
+    securities = hxl.securities
+    if 'lreturn' not in securities or 'clscode' not in securities:
+        raise ValueError('The returns and classifications of the stocks are not '
+                         'available (e.g. restored from a cache without them).')
+
+    codes = securities['clscode']
+    codes, index, columns = codes.values, codes.index, codes.columns
+    returns = securities['lreturn'].reindex(index=index, columns=columns).values
+    weights = securities['marketcap'].reindex(index=index, columns=columns).values
+    returns = np.asarray(returns, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+
+    missing = np.isnan(returns)
+    valid = ~np.isnan(weights)
+    if hxl.nan_returns == 'drop':
+        valid &= ~missing
+    weights = np.where(valid, weights, 0)
+    weighted = np.where(valid & ~missing, returns*weights, 0)
+
+    # Members of each portfolio (stocks x portfolios x months)
+    member = codes[:, np.newaxis, :] == np.arange(len(HXLFactors.cls_labels), 
+                                                  dtype=codes.dtype)[:, np.newaxis]
+    masked = lambda panel: np.where(member, panel[:, np.newaxis, :], 
+                                    0).reshape(len(index), -1)
+
+    return {
+            'stocks': len(index),
+            'months': len(columns),
+            'weighted': masked(weighted),
+            'weights': masked(weights),
+            'missing': (masked((valid & missing).astype(float)) 
+                        if hxl.nan_returns == 'propagate' else None)
+            }
+
+
+def _stock_factors(counts, panels):
+    """
+    Calculates the factors of resampled universes.
+
+    Parameters
+    ----------
+    counts : ndarray
+        2-D array (resamples x stocks) containing how many times each stock
+        was drawn.
+    panels : Dict like
+        Panels of each portfolio, as gathered by _stock_panels.
+
+    Return
+    ----------
+    factors : ndarray
+        3-D array (factors x resamples x months) containing the factors.
+    """
+
+    # Each portfolio is a product of the counts by its members' panels, so
+    # every portfolio of every resample of the batch is summed at once
+    counts = counts.astype(float)
+    shape = (len(counts), len(HXLFactors.cls_labels), panels['months'])
+    numerator = counts @ panels['weighted']
+    denominator = counts @ panels['weights']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        preturn = (numerator/denominator).reshape(shape)
+    if panels['missing'] is not None:
+        preturn[(counts @ panels['missing']).reshape(shape) > 0] = np.nan
+
+    position = {label: code for code, label in enumerate(HXLFactors.cls_labels)}
+    mean = lambda labels: preturn[:, [position[label] for label in labels]].mean(axis=1)
+
+    return np.stack([mean(HXLFactors.high_IA) - mean(HXLFactors.low_IA),
+                     mean(HXLFactors.high_ROE) - mean(HXLFactors.low_ROE)])
+
+
+def _month_factors(rng, size, series, block):
+    """
+    Resamples the factor series in blocks of consecutive months (moving block
+    bootstrap). Months without a factor are not resampled.
+
+    Parameters
+    ----------
+    rng : Generator
+        Random generator.
+    size : int
+        Number of resamples.
+    series : ndarray
+        2-D array (factors x months) containing the factors.
+    block : int
+        Length of the blocks.
+
+    Return
+    ----------
+    factors : ndarray
+        3-D array (factors x resamples x months) containing the factors.
+    """
+
+    series = series[:, ~np.isnan(series).any(axis=0)]
+    months = series.shape[1]
+    if not months:
+        return np.empty((len(series), size, 0))
+    block = max(min(block, months), 1)
+    blocks = -(-months // block)
+    starts = rng.integers(0, months - block + 1, (size, blocks))
+    months_drawn = (starts[:, :, np.newaxis] + np.arange(block)).reshape(size, -1)
+
+    return series[:, months_drawn[:, :months]]
+
+
+def _statistics(factors, periods):
+    """
+    Calculates the mean, t-stat and annualized Sharpe ratio of each resample,
+    skipping months without a factor.
+
+    Parameters
+    ----------
+    factors : ndarray
+        3-D array (factors x resamples x months) containing the factors.
+    periods : int
+        Number of months in a year.
+
+    Return
+    ----------
+    statistics : ndarray
+        2-D array (resamples x (factor, statistic)) containing the statistics.
+    """
+
+    count = np.sum(~np.isnan(factors), axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.nansum(factors, axis=2)/count
+        std = np.sqrt(np.nansum((factors - mean[:, :, np.newaxis])**2, axis=2)
+                      /(count - 1))
+        tstat = mean/(std/np.sqrt(count))
+        sharpe = mean/std*np.sqrt(periods)
+
+    # (statistics x factors x resamples) to (resamples x factors*statistics)
+    statistics = np.stack([mean, tstat, sharpe]).transpose(2, 1, 0)
+
+    return statistics.reshape(statistics.shape[0], -1)
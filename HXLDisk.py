@@ -0,0 +1,235 @@
+"""
+@author: Vitor Eller - @VFermat
+"""
+
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+
+from HXLFactors import HXLFactors, SecuritiesStore, _decode, _fingerprint_inputs
+from HXLLoader import iter_chunks
+
+MANIFEST = 'manifest.json'
+
+# Panels (stocks x months) written to disk, besides the classification codes
+PANELS = ['price', 'marketcap', 'return', 'lreturn', 'I/A']
+FACTORS = ['HXLInvestment', 'HXLProfit']
+# Inputs of HXLFactors.calculate_factors, fingerprinted to key a run
+INPUTS = ['prices', 'dividends', 'assets', 'ROE', 'marketcap']
+
+
+def run_on_disk(panels, directory, months=120, dtype=np.float64, **parameters):
+    """
+    Calculates the factors out of core. The months are streamed in chunks
+    (see HXLFactors.stream_factors) and, as each chunk is finished, its panels
+    are written to memory-mapped .npy files in directory, so only one chunk
+    is in memory at a time. The memory is bounded per chunk, not per block of
+    stocks: each chunk, with the stream_context months before it, goes 
+    through every stage in memory, so months sets the peak. Progress is 
+    recorded after every chunk: if the run is interrupted, running it again
+    resumes after the last month written, giving the same panels as an 
+    uninterrupted run. The run is keyed by a fingerprint of the inputs 
+    (hashed block by block) and of the parameters the results depend on (see
+    HXLFactors._parameters), so revised inputs or parameters start it over,
+    while a cache, profiling or threads do not.
+
+    Parameters
+    ----------
+    panels : Dict like
+        A dict containing the inputs, keyed as the arguments of
+        HXLFactors.calculate_factors (e.g. memory-mapped by
+        HXLLoader.load_workbook).
+    directory : String
+        Directory holding the panels.
+    months : int
+        Number of months of each chunk.
+    dtype : dtype
+        Type of the numeric panels written.
+    parameters : Dict like
+        Keyword arguments to HXLFactors.
+
+    Return
+    ----------
+    store : DiskStore
+        The panels written, memory-mapped read only.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    hxl = HXLFactors(**parameters)
+    prices = panels['prices']
+    index = prices.index
+    columns = prices.columns + MonthEnd(0)
+    key = _fingerprint_inputs(*[panels[field] for field in INPUTS],
+                              pd.Series(index), pd.Series(columns),
+                              hxl._parameters(), hxl.compact,
+                              np.dtype(dtype).str)
+
+    manifest = _read_manifest(directory)
+    if manifest is None or manifest['key'] != key:
+        manifest = {'key': key, 'done': 0, 'dtype': np.dtype(dtype).str}
+        _create_arrays(directory, index, columns, dtype)
+        _write_manifest(directory, manifest)
+    done = manifest['done']
+    if done == len(columns):
+        return DiskStore(directory)
+
+    # Restarting stream_context months before the first month not written
+    # rebuilds the June sort and lagged information it depends on
+    start = max(done - hxl.stream_context, 0)
+    restart = dict(panels, prices=prices.iloc[:, start:],
+                   marketcap=panels['marketcap'].iloc[:, start:])
+
+    arrays = {name: np.load(_path(directory, name), mmap_mode='r+')
+              for name in PANELS + SecuritiesStore.codes + ['factors', 'preturn']}
+    for factors in hxl.stream_factors(iter_chunks(restart, months)):
+        positions = columns.get_indexer(factors.index)
+        new = positions >= done
+        if not new.any():
+            continue
+        finished = factors.index[new]
+        positions = positions[new]
+
+        for name in PANELS + SecuritiesStore.codes:
+            fill = -1 if name in SecuritiesStore.codes else np.nan
+            frame = hxl.securities[name].reindex(index=index, columns=finished,
+                                                 fill_value=fill)
+            arrays[name][:, positions] = frame.values
+        arrays['factors'][positions] = factors.loc[finished, FACTORS].values
+        arrays['preturn'][:, positions] = hxl.securities['preturn'].reindex(
+                columns=finished).values
+
+        # Data first, then the progress that trusts it
+        for array in arrays.values():
+            array.flush()
+        manifest['done'] = int(positions[-1]) + 1
+        _write_manifest(directory, manifest)
+
+    del arrays
+
+    return DiskStore(directory)
+
+
+class DiskStore(Mapping):
+    """
+    Read only, dict like view of the panels written by run_on_disk. Every
+    panel is memory-mapped from its .npy file, so processes opening the same
+    directory share one copy of it.
+    """
+
+    labels = SecuritiesStore.labels
+
+    def __init__(self, directory):
+        """
+        Parameters
+        ----------
+        directory : String
+            Directory holding the panels.
+        """
+
+        self.directory = directory
+        self.index = pd.Index(np.load(_path(directory, 'index')).astype(object))
+        self.columns = pd.DatetimeIndex(np.load(_path(directory, 'columns')))
+        manifest = _read_manifest(directory)
+        self.done = 0 if manifest is None else manifest['done']
+        self.arrays = {name: np.load(_path(directory, name), mmap_mode='r')
+                       for name in PANELS + SecuritiesStore.codes
+                       + ['factors', 'preturn']}
+
+    def __getitem__(self, key):
+
+        if key in self.labels:
+            codes, labels = self.labels[key]
+            return _decode(self[codes], getattr(HXLFactors, labels))
+        elif key == 'preturn':
+            return pd.DataFrame(self.arrays[key][:, :self.done],
+                                index=HXLFactors.cls_labels,
+                                columns=self.columns[:self.done], copy=False)
+        elif key in self.arrays and key != 'factors':
+            return pd.DataFrame(self.arrays[key][:, :self.done], index=self.index,
+                                columns=self.columns[:self.done], copy=False)
+
+        raise KeyError(key)
+
+    def __iter__(self):
+
+        for key in PANELS + SecuritiesStore.codes + ['preturn']:
+            yield key
+        for key in self.labels:
+            yield key
+
+    def __len__(self):
+
+        return len(PANELS) + len(SecuritiesStore.codes) + 1 + len(self.labels)
+
+    @property
+    def factors(self):
+        """
+        DataFrame (months x factors) containing the factors of the months
+        written.
+        """
+
+        return pd.DataFrame(self.arrays['factors'][:self.done],
+                            index=self.columns[:self.done], columns=FACTORS)
+
+
+def _create_arrays(directory, index, columns, dtype):
+    """
+    Creates the .npy files of a run, filled with NaN (and -1 codes).
+
+    Parameters
+    ----------
+    directory : String
+        Directory holding the panels.
+    index : Index
+        Tickers of the panels.
+    columns : Index
+        Months of the panels.
+    dtype : dtype
+        Type of the numeric panels.
+    """
+
+    np.save(_path(directory, 'index'), np.asarray(index, dtype=str))
+    np.save(_path(directory, 'columns'), columns.values.astype('datetime64[ns]'))
+
+    shapes = dict({name: ((len(index), len(columns)), dtype, np.nan)
+                   for name in PANELS},
+                  **{name: ((len(index), len(columns)), np.int8, -1)
+                     for name in SecuritiesStore.codes})
+    shapes['factors'] = ((len(columns), len(FACTORS)), np.float64, np.nan)
+    shapes['preturn'] = ((len(HXLFactors.cls_labels), len(columns)), np.float64,
+                         np.nan)
+    for name, (shape, kind, fill) in shapes.items():
+        array = np.lib.format.open_memmap(_path(directory, name), mode='w+',
+                                          dtype=kind, shape=shape)
+        array[:] = fill
+        array.flush()
+        del array
+
+
+def _path(directory, name):
+    """Path of the .npy file holding one panel."""
+
+    return os.path.join(directory, '{}.npy'.format(name.replace('/', '_')))
+
+
+def _read_manifest(directory):
+    """Reads the manifest of a run, None if there is none."""
+
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(directory, manifest):
+    """Atomically replaces the manifest of a run."""
+
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
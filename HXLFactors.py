@@ -2,273 +2,2439 @@
 @author: Vitor Eller - @VFermat
 """
 
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+from types import MappingProxyType
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: peak RSS is not profiled there
+    resource = None
+
 import pandas as pd
 import numpy as np
 from pandas.tseries.offsets import MonthEnd
 
+
+def _peak_rss():
+    """
+    Peak resident set size of the process, in bytes. None if unknown.
+    """
+    
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    return peak if sys.platform == 'darwin' else peak*1024
+
+
+def _shapes(value):
+    """
+    Describes the shapes of a value for the profile: arrays give their shape,
+    dicts the shapes of their arrays and sequences the shapes of their items.
+    """
+    
+    if isinstance(getattr(value, 'shape', None), tuple):
+        return value.shape
+    elif isinstance(value, Mapping):
+        return {key: item.shape for key, item in value.items() 
+                if isinstance(getattr(item, 'shape', None), tuple)}
+    elif isinstance(value, (tuple, list)):
+        return [_shapes(item) for item in value]
+    
+    return None
+
+
+# Breakpoints already calculated, keyed by the fingerprint of their inputs,
+# shared by the threads calculating factors
+_breakpoint_cache = OrderedDict()
+_breakpoint_cache_size = 64
+_breakpoint_lock = threading.Lock()
+
+# Bytes of each block hashed by _fingerprint
+_fingerprint_block = 1 << 22
+
+# Treatments of NaN returns by _value_weight, and the least cells of the 
+# blocks of months it reduces on each thread
+_nan_returns = ['zero', 'drop', 'propagate']
+_value_weight_block = 1 << 18
+
+
+def _fingerprint(*arrays):
+    """
+    Calculates a fingerprint of the content of numeric arrays.
+    
+    Parameters
+    ----------
+    arrays : ndarray
+        Arrays to be fingerprinted. None is accepted and fingerprinted as such.
+        
+    Return
+    ----------
+    fingerprint : String
+        Hex digest of the arrays' shapes, types and content.
+    """
+    
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        if array is None:
+            digest.update(b'None')
+            continue
+        array = np.asarray(array)
+        digest.update('{}{}'.format(array.shape, array.dtype.str).encode())
+        # Hashed by blocks of rows, so that only one block is copied when the
+        # array is not contiguous (or is memory-mapped)
+        array = np.atleast_1d(array)
+        rows = max(_fingerprint_block//max(array[:1].nbytes, 1), 1)
+        for start in range(0, len(array), rows):
+            block = np.ascontiguousarray(array[start:start + rows])
+            digest.update(block.view(np.uint8).reshape(-1))
+    
+    return digest.hexdigest()
+
+
+def _fingerprint_inputs(*inputs):
+    """
+    Calculates a fingerprint of the inputs of the factors. DataFrames and 
+    Series are fingerprinted by their values, index and columns; arrays, 
+    Indexes and lists by their content; tuples and dicts item by item; any 
+    other input (e.g. a scalar parameter) by its repr.
+    
+    Parameters
+    ----------
+    inputs : DataFrame, Series or any
+        Inputs to be fingerprinted.
+        
+    Return
+    ----------
+    fingerprint : String
+        Hex digest of the inputs.
+    """
+    
+    arrays = []
+    for value in inputs:
+        _fingerprint_arrays(value, arrays)
+    
+    return _fingerprint(*arrays)
+
+
+def _fingerprint_arrays(value, arrays):
+    """
+    Appends the arrays fingerprinting one input (see _fingerprint_inputs) to
+    arrays. The repr of arrays and Indexes is never used, since numpy and 
+    pandas shorten it for long ones.
+    """
+    
+    tag = lambda text: arrays.append(np.frombuffer(text.encode(), dtype=np.uint8))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        values = value.values
+        if not isinstance(values, np.ndarray) or values.dtype == object:
+            # Strings (and other objects) are hashed by value
+            values = pd.util.hash_pandas_object(value, index=False).values
+        arrays.append(values)
+        axes = [value.index]
+        if isinstance(value, pd.DataFrame):
+            axes.append(value.columns)
+        for axis in axes:
+            arrays.append(pd.util.hash_pandas_object(axis, index=False).values)
+    elif value is None:
+        arrays.append(None)
+    elif isinstance(value, dict):
+        tag('dict{}'.format(len(value)))
+        for item in value.items():
+            _fingerprint_arrays(item, arrays)
+    elif isinstance(value, tuple) or (isinstance(value, list) and any(
+            isinstance(item, (tuple, list, dict)) for item in value)):
+        tag('{}{}'.format(type(value).__name__, len(value)))
+        for item in value:
+            _fingerprint_arrays(item, arrays)
+    elif isinstance(value, (list, np.ndarray, pd.Index)):
+        values = np.asarray(value)
+        tag('{}{}'.format(type(value).__name__, values.shape))
+        if values.dtype.kind in 'biuf':
+            arrays.append(values)
+        else:
+            # Strings, dates and other objects are hashed by value
+            arrays.append(pd.util.hash_pandas_object(pd.Index(values.ravel()),
+                                                     index=False).values)
+    else:
+        tag(repr(value))
+
+
+def _quantiles(values, quantiles):
+    """
+    Calculates quantiles of every column of an array, skipping NaN values and
+    interpolating linearly (as DataFrame.quantile). All the quantiles are taken
+    from a single sort of the array.
+    
+    Parameters
+    ----------
+    values : ndarray
+        2-D array (stocks x months).
+    quantiles : List like
+        Quantiles to be calculated, between 0 and 1.
+        
+    Return
+    ----------
+    breakpoints : ndarray
+        2-D array (quantiles x months) containing the quantiles of each month.
+    """
+    
+    ordered = np.sort(values, axis=0)
+    count = np.sum(~np.isnan(values), axis=0)
+    position = np.asarray(quantiles, dtype=float)[:, np.newaxis]*np.maximum(count - 1, 0)
+    lower = np.floor(position).astype(np.intp)
+    upper = np.ceil(position).astype(np.intp)
+    weight = position - lower
+    
+    below = np.take_along_axis(ordered, lower, axis=0)
+    above = np.take_along_axis(ordered, upper, axis=0)
+    with np.errstate(invalid='ignore'):
+        difference = above - below
+        breakpoints = np.where(weight < 0.5, below + difference*weight, 
+                               above - difference*(1 - weight))
+    breakpoints = np.where(below == above, below, breakpoints)
+    breakpoints[:, count == 0] = np.nan
+    
+    return breakpoints
+
+
+def _valid(values):
+    """
+    Flags the cells of an array holding a value to sort on: finite and not 
+    zero, the value of months without information released (see _align).
+    """
+    
+    return np.isfinite(values) & (values != 0)
+
+
+def _winsorize(values, limits):
+    """
+    Winsorizes every column of an array at the quantiles of the values to sort
+    on (see _valid), as the breakpoints are taken from them. Other cells (NaN,
+    infinite or zero) are left as they are, so they still get the missing 
+    code when sorted.
+    
+    Parameters
+    ----------
+    values : ndarray
+        2-D array (stocks x months).
+    limits : Tuple like
+        Lower and upper quantiles, between 0 and 1.
+        
+    Return
+    ----------
+    winsorized : ndarray
+        2-D array (stocks x months) containing the winsorized values.
+    """
+    
+    values = np.asarray(values, dtype=float)
+    valid = _valid(values)
+    bounds = _quantiles(np.where(valid, values, np.nan), limits)
+    
+    return np.where(valid, np.clip(values, bounds[0], bounds[-1]), values)
+
+
+def _breakpoints(values, quantiles, mask=None):
+    """
+    Calculates the breakpoints of every month, using only the cells flagged by
+    the mask and holding a value to sort on (see _valid). Results are cached by
+    a fingerprint of the inputs, so breakpoints that did not change are not 
+    calculated again.
+    
+    Parameters
+    ----------
+    values : ndarray
+        2-D array (stocks x months) with the characteristic being sorted.
+    quantiles : List like
+        Quantiles to be calculated, between 0 and 1.
+    mask : ndarray
+        Boolean array, broadcastable to values, flagging the cells of the 
+        breakpoints universe. If None, every cell is used.
+        
+    Return
+    ----------
+    breakpoints : ndarray
+        Read only 2-D array (quantiles x months) containing the breakpoints.
+    """
+    
+    values = np.asarray(values, dtype=float)
+    key = (_fingerprint(values, mask), tuple(quantiles))
+    with _breakpoint_lock:
+        if key in _breakpoint_cache:
+            _breakpoint_cache.move_to_end(key)
+            return _breakpoint_cache[key]
+    
+    valid = _valid(values)
+    if mask is not None:
+        valid &= mask
+    breakpoints = _quantiles(np.where(valid, values, np.nan), quantiles)
+    breakpoints.setflags(write=False)
+    
+    with _breakpoint_lock:
+        _breakpoint_cache[key] = breakpoints
+        if len(_breakpoint_cache) > _breakpoint_cache_size:
+            _breakpoint_cache.popitem(last=False)
+    
+    return breakpoints
+
+
+def _universe_mask(universe, panel):
+    """
+    Builds the mask of the breakpoints universe for a panel.
+    
+    Parameters
+    ----------
+    universe : List or DataFrame like
+        Tickers of the universe, or a boolean DataFrame (stocks x months) 
+        flagging it. If None, every security is in the universe.
+    panel : DataFrame like
+        DataFrame (stocks x months) the mask is built for.
+        
+    Return
+    ----------
+    mask : ndarray
+        Boolean array broadcastable to the panel, or None.
+    """
+    
+    if universe is None:
+        return None
+    elif isinstance(universe, pd.DataFrame):
+        return universe.reindex(index=panel.index, columns=panel.columns,
+                                fill_value=False).values.astype(bool)
+    
+    return np.asarray(panel.index.isin(universe))[:, np.newaxis]
+
+
+def _breakpoint_mask(universe, eligible, panel):
+    """
+    Builds the mask of the cells the breakpoints of a panel are calculated on:
+    those of the breakpoints universe (see _universe_mask) eligible on their 
+    month (see HXLFactors._preprocess). None if every cell is used.
+    """
+    
+    mask = _universe_mask(universe, panel)
+    eligible = _universe_mask(eligible, panel)
+    if eligible is None:
+        return mask
+    
+    return eligible if mask is None else mask & eligible
+
+
+def _bucketize(values, breakpoints):
+    """
+    Assigns every cell of a stock x month array to the bucket defined by the
+    per-month breakpoints. A value equal to a breakpoint falls in the lower
+    bucket. Cells without a value to sort on (see _valid) get the missing code
+    (-1).
+    
+    Parameters
+    ----------
+    values : ndarray
+        2-D array (stocks x months) with the characteristic being sorted.
+    breakpoints : List like
+        Ascending list of 1-D arrays (one value per month) with the breakpoints.
+        
+    Return
+    ----------
+    codes : ndarray
+        2-D int8 array containing the bucket of each cell.
+    """
+    
+    codes = np.zeros(values.shape, dtype=np.int8)
+    for breakpoint in breakpoints:
+        codes += ~(values <= np.asarray(breakpoint, dtype=float)[np.newaxis, :])
+    codes[~_valid(values)] = -1
+    
+    return codes
+
+
+def _hold(codes, rebalance):
+    """
+    Carries the codes assigned on rebalancing months forward until the next
+    rebalancing month. Months before the first rebalancing get the missing
+    code (-1).
+    
+    Parameters
+    ----------
+    codes : ndarray
+        2-D array (stocks x rebalancing months) containing the assigned codes.
+    rebalance : Array like
+        Boolean array with one entry per month, flagging the rebalancing months.
+        
+    Return
+    ----------
+    held : ndarray
+        2-D int8 array (stocks x months) containing the held codes.
+    """
+    
+    if not np.any(rebalance):
+        return np.full((codes.shape[0], len(rebalance)), -1, dtype=np.int8)
+    
+    last = _held(rebalance)
+    held = codes[:, np.maximum(last, 0)].astype(np.int8)
+    held[:, last < 0] = -1
+    
+    return held
+
+
+def _held(rebalance):
+    """
+    Position, among the rebalancing months, of the rebalancing in effect on 
+    each month: the last one up to it, -1 before the first.
+    """
+    
+    positions = np.flatnonzero(rebalance)
+    
+    return np.searchsorted(positions, np.arange(len(rebalance)), side='right') - 1
+
+
+def _rebalance_months(columns, schedule):
+    """
+    Flags the rebalancing months of a schedule.
+    
+    Parameters
+    ----------
+    columns : DatetimeIndex
+        Months of the panels.
+    schedule : String, int or List like
+        'monthly' (or None) for every month, 'quarterly' for March, June, 
+        September and December, 'annual' for every June, a month number (e.g.
+        12 for every December) or the dates of the rebalancings.
+        
+    Return
+    ----------
+    rebalance : ndarray
+        Boolean array with one entry per month, flagging the rebalancing 
+        months.
+    """
+    
+    columns = pd.DatetimeIndex(columns)
+    if schedule is None:
+        return np.ones(len(columns), dtype=bool)
+    elif isinstance(schedule, str):
+        if schedule == 'monthly':
+            return np.ones(len(columns), dtype=bool)
+        elif schedule == 'quarterly':
+            return np.asarray(columns.month % 3 == 0)
+        elif schedule == 'annual':
+            return np.asarray(columns.month == 6)
+        raise ValueError('Unknown rebalancing schedule: {}.'.format(schedule))
+    elif isinstance(schedule, (int, np.integer)):
+        return np.asarray(columns.month == schedule)
+    
+    dates = pd.DatetimeIndex(schedule) + MonthEnd(0)
+    
+    return np.asarray((columns + MonthEnd(0)).isin(dates))
+
+
+def _month_numbers(dates):
+    """Months elapsed since year zero of each date, to count months apart."""
+    
+    dates = pd.DatetimeIndex(dates)
+    
+    return np.asarray(dates.year*12 + dates.month - 1)
+
+
+def _scheduled_breakpoints(values, quantiles, mask=None, rebalance=None, 
+                           previous=None):
+    """
+    Calculates the breakpoints of the rebalancing months only (see 
+    _breakpoints) and carries them forward, so every month holds the 
+    breakpoints in effect on it.
+    
+    Parameters
+    ----------
+    values : ndarray
+        2-D array (stocks x months) with the characteristic being sorted.
+    quantiles : List like
+        Quantiles to be calculated, between 0 and 1.
+    mask : ndarray
+        Boolean array, broadcastable to values, flagging the cells of the 
+        breakpoints universe. If None, every cell is used.
+    rebalance : Array like
+        Boolean array with one entry per month, flagging the rebalancing 
+        months. If None, every month.
+    previous : Array like
+        Breakpoints in effect before the first rebalancing month (e.g. when
+        appending a month). If None, those months get NaN.
+        
+    Return
+    ----------
+    breakpoints : ndarray
+        2-D array (quantiles x months) containing the breakpoints in effect.
+    """
+    
+    if rebalance is None or np.all(rebalance):
+        return _breakpoints(values, quantiles, mask)
+    
+    rebalance = np.asarray(rebalance, dtype=bool)
+    if mask is not None and np.ndim(mask) == 2 and np.shape(mask)[1] > 1:
+        mask = mask[:, rebalance]
+    computed = _breakpoints(np.asarray(values)[:, rebalance], quantiles, mask)
+    
+    last = _held(rebalance)
+    held = np.full((len(quantiles), len(rebalance)), np.nan)
+    if computed.shape[1]:
+        held = computed[:, np.maximum(last, 0)]
+    held[:, last < 0] = np.nan
+    if previous is not None:
+        held[:, last < 0] = np.asarray(previous, dtype=float)[:, np.newaxis]
+    
+    return held
+
+
+
+def _sort(values, breakpoints, rebalance=None, mask=None):
+    """
+    Sorts every cell of a stock x month array in buckets. Securities are sorted
+    on the rebalancing months and hold their bucket until the next one; those
+    not flagged by the mask then get the missing code (-1) until the next.
+    
+    Parameters
+    ----------
+    values : ndarray
+        2-D array (stocks x months) with the characteristic being sorted.
+    breakpoints : ndarray
+        2-D array (breakpoints x rebalancing months) with the breakpoints.
+    rebalance : Array like
+        Boolean array with one entry per month, flagging the rebalancing 
+        months. If None, securities are sorted every month.
+    mask : ndarray
+        Boolean array, broadcastable to values, flagging the eligible cells 
+        (see HXLFactors._preprocess). If None, every cell is eligible.
+        
+    Return
+    ----------
+    codes : ndarray
+        2-D int8 array (stocks x months) containing the bucket of each cell.
+    """
+    
+    if mask is not None:
+        values = np.where(mask, values, np.nan)
+    if rebalance is None:
+        return _bucketize(values, breakpoints)
+    
+    rebalance = np.asarray(rebalance, dtype=bool)
+    
+    return _hold(_bucketize(values[:, rebalance], breakpoints), rebalance)
+
+
+def _combine(codes, sizes):
+    """
+    Combines the buckets of several sorts into the code of the cell each 
+    security belongs to, in the order of the product of the sorts' buckets
+    (the last sort varying fastest). Cells missing any sort get the missing
+    code (-1).
+    
+    Parameters
+    ----------
+    codes : List like
+        2-D arrays (stocks x months) containing the buckets of each sort.
+    sizes : List like
+        Number of buckets of each sort.
+        
+    Return
+    ----------
+    combined : ndarray
+        2-D array (stocks x months) containing the cell codes, of the smallest
+        integer type holding them.
+    """
+    
+    combined = np.zeros(np.shape(codes[0]), dtype=np.intp)
+    missing = np.zeros(combined.shape, dtype=bool)
+    for code, size in zip(codes, sizes):
+        combined = combined*size + code
+        missing |= code < 0
+    combined[missing] = -1
+    
+    return combined.astype(np.promote_types(np.int8, 
+                                            np.min_scalar_type(-int(np.prod(sizes)))))
+
+
+def _decode(codes, labels):
+    """
+    Translates integer codes back to their labels. The missing code (-1) is
+    translated to NaN.
+    
+    Parameters
+    ----------
+    codes : DataFrame like
+        DataFrame containing the integer codes.
+    labels : Array like
+        Array containing the label of each code.
+        
+    Return
+    ----------
+    decoded : DataFrame
+        DataFrame containing the labels.
+    """
+    
+    table = np.append(np.asarray(labels, dtype=object), np.nan)
+    
+    return pd.DataFrame(table[codes.values], index=codes.index, 
+                        columns=codes.columns, dtype=object)
+
+
+def _pivot(values, index=None):
+    """
+    Pivots information in long format to a DataFrame with one column per month
+    holding any observation. Dates are lined up to end of month and, when a
+    ticker has several observations on a month, the last one is kept.
+    
+    Parameters
+    ----------
+    values : Series like
+        Series indexed by (ticker, date).
+    index : Array like
+        Tickers of the DataFrame. Defaults to the sorted tickers of values;
+        observations of other tickers are dropped.
+        
+    Return
+    ----------
+    pivoted : DataFrame
+        DataFrame (stocks x months) containing the observations, NaN where a
+        ticker has none.
+    """
+    
+    tickers = values.index.get_level_values(0)
+    dates = pd.DatetimeIndex(values.index.get_level_values(1))
+    if index is None:
+        index = pd.Index(pd.unique(tickers)).sort_values()
+    index = pd.Index(index)
+    months = dates + MonthEnd(0)
+    columns = pd.DatetimeIndex(pd.unique(months)).sort_values()
+    
+    rows = index.get_indexer(tickers)
+    cols = columns.get_indexer(months)
+    
+    # Later observations come last, and the last of each cell is kept
+    order = np.argsort(dates.values, kind='stable')
+    order = order[rows[order] >= 0]
+    cells = rows[order]*len(columns) + cols[order]
+    last = len(cells) - 1 - np.unique(cells[::-1], return_index=True)[1]
+    
+    pivoted = np.full(len(index)*len(columns), np.nan)
+    pivoted[cells[last]] = np.asarray(values.values, dtype=float)[order[last]]
+    
+    return pd.DataFrame(pivoted.reshape(len(index), len(columns)), index=index,
+                        columns=columns)
+
+
+def _align(frame, pattern, method='zero', lag=0):
+    """
+    Aligns a DataFrame released on some months only to a monthly pattern of
+    columns, in a single reindex. Releases are published lag months after their
+    date. The months without a release are filled with zero ('zero') or with the
+    last release published ('ffill').
+    
+    Parameters
+    ----------
+    frame : DataFrame like
+        DataFrame (stocks x release dates) to be aligned.
+    pattern : Array like
+        Array containing the pattern for the columns.
+    method : String
+        Fill method, 'zero' or 'ffill'.
+    lag : int
+        Publication lag, in months.
+        
+    Return
+    ----------
+    aligned : DataFrame
+        DataFrame (stocks x pattern) containing the aligned information.
+    """
+    
+    columns = frame.columns
+    if lag:
+        columns = columns + MonthEnd(lag)
+    
+    if method == 'zero':
+        indexer = columns.get_indexer(pattern)
+        fill = 0
+    elif method == 'ffill':
+        order = np.argsort(columns.values, kind='stable')
+        indexer = pd.Index(columns.values[order]).get_indexer(pattern, method='ffill')
+        if len(order):
+            indexer = np.where(indexer < 0, -1, order[indexer])
+        fill = np.nan
+    else:
+        raise ValueError("Unknown fill method '{}'. Use 'zero' or 'ffill'.".format(method))
+    
+    # A single float block: mixed fills would fragment every panel derived
+    values = np.asarray(frame.values, dtype=float)
+    if values.shape[1]:
+        values = values[:, indexer]
+        values[:, indexer < 0] = fill
+    else:
+        values = np.full((len(frame.index), len(pattern)), fill)
+    
+    return pd.DataFrame(values, index=frame.index, columns=pattern)
+
+
+def _month_end(frame):
+    """
+    Lines the columns of a DataFrame up to the end of their months, on a 
+    shallow copy so the DataFrame itself is not relabeled. Anything else is
+    returned as is.
+    """
+    
+    if not isinstance(frame, pd.DataFrame):
+        return frame
+    
+    lined = frame.copy(deep=False)
+    lined.columns = frame.columns + MonthEnd(0)
+    
+    return lined
+
+
+def _value_weight(codes, returns, weights, n, nan_returns='zero', threads=None):
+    """
+    Calculates the value weighted return of every portfolio on every month.
+    Cells are grouped by (portfolio, month) and reduced with a weighted
+    bincount, so all portfolios are computed at once. Stocks with NaN weights
+    are left out; empty portfolios get NaN. Blocks of months are reduced on
+    parallel threads.
+    
+    Parameters
+    ----------
+    codes : ndarray
+        2-D array (stocks x months) containing the portfolio codes, or an array
+        with leading dimensions (e.g. sorts x stocks x months) sharing the 
+        returns and weights. Negative codes are left out of every portfolio.
+    returns : ndarray
+        2-D array (stocks x months) containing the returns, broadcast to the
+        codes.
+    weights : ndarray
+        2-D array (stocks x months) containing the weights, broadcast to the
+        codes.
+    n : int
+        Number of portfolios.
+    nan_returns : String
+        Treatment of NaN returns: 'zero' counts them as a zero return, keeping
+        their weight in the portfolio; 'drop' leaves the stock out of the 
+        portfolio; 'propagate' makes the portfolio return NaN.
+    threads : int
+        Number of threads. Defaults to the number of CPUs; fewer are used when
+        the blocks of months would be small.
+        
+    Return
+    ----------
+    preturn : ndarray
+        2-D array (portfolios x months) containing the portfolios returns.
+    """
+    
+    if nan_returns not in _nan_returns:
+        raise ValueError('Unknown treatment of NaN returns: {}.'.format(nan_returns))
+    
+    months = codes.shape[-1]
+    threads = min(threads or os.cpu_count() or 1, 
+                  max(codes.size//_value_weight_block, 1), months)
+    if threads > 1:
+        bounds = np.linspace(0, months, threads + 1).astype(int)
+        blocks = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        with ThreadPoolExecutor(threads) as pool:
+            preturn = pool.map(lambda block: _value_weight(codes[..., block], 
+                                                           returns[..., block], 
+                                                           weights[..., block], n, 
+                                                           nan_returns, 1), 
+                               blocks)
+            return np.hstack(list(preturn))
+    
+    # Broadcast views: the returns and weights are not copied for each sort
+    weights = np.asarray(weights, dtype=float)
+    returns = np.asarray(returns, dtype=float)
+    missing = np.broadcast_to(np.isnan(returns), codes.shape)
+    valid = (codes >= 0) & ~np.isnan(weights)
+    weights = np.broadcast_to(weights, codes.shape)
+    returns = np.broadcast_to(returns, codes.shape)
+    if nan_returns == 'drop':
+        valid &= ~missing
+    
+    groups = (codes.astype(np.intp)*months + np.arange(months))[valid]
+    weights = weights[valid]
+    numerator = np.bincount(groups, weights=np.where(missing[valid], 0, 
+                                                     returns[valid]*weights), 
+                            minlength=n*months)
+    denominator = np.bincount(groups, weights=weights, minlength=n*months)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        preturn = numerator/denominator
+    
+    if nan_returns == 'propagate':
+        preturn[np.bincount(groups, weights=missing[valid], minlength=n*months) > 0] = np.nan
+    
+    return preturn.reshape(n, months)
+
+
+class SecuritiesStore(MutableMapping):
+    """
+    Compact, dict like store of the information on stocks. The input panels are
+    kept as contiguous arrays sharing one index of tickers and one index of 
+    dates, and the classifications as int8 codes. The keys derived from them
+    (returns, I/A related information and labeled classifications) are
+    calculated when accessed and are not kept.
+    """
+    
+    panels = ['price', 'marketcap', 'dividends', 'assets', 'ROE']
+    codes = ['sizecode', 'iacode', 'ROEcode', 'clscode']
+    
+    # Derived keys and the stage calculating them
+    returns = ['lprice', 'pdifference', 'gain', 'return', 'lreturn']
+    IA_info = ['lassets', 'investment', 'I/A']
+    labels = {
+            'sizecls': ('sizecode', 'size_labels'),
+            'iacls': ('iacode', 'ia_labels'),
+            'ROEcls': ('ROEcode', 'ROE_labels'),
+            'cls': ('clscode', 'cls_labels')
+            }
+    
+    def __init__(self, securities, dtype=np.float32, winsorize=None):
+        """
+        Parameters
+        ----------
+        securities : Dict like
+            A dict containing the information on stocks, as built by 
+            HXLFactors.calculate_factors.
+        dtype : dtype
+            Type of the numeric panels.
+        winsorize : Tuple like
+            Quantiles (lower, upper) the I/A calculated is winsorized at, as 
+            it was by HXLFactors._preprocess. None to keep it.
+        """
+        
+        self.dtype = dtype
+        self.winsorize = winsorize
+        self.index = securities['clscode'].index
+        self.columns = securities['clscode'].columns
+        self.arrays = {}
+        self.others = {}
+        
+        for key, value in securities.items():
+            self[key] = value
+    
+    def __getitem__(self, key):
+        
+        if key in self.arrays:
+            return pd.DataFrame(self.arrays[key], index=self.index, 
+                                columns=self.columns, copy=False)
+        elif key in self.others:
+            return self.others[key]
+        elif key in self.returns:
+            return HXLFactors._get_return({'price': self['price'],
+                                          'dividends': self['dividends']})[key]
+        elif key in self.IA_info:
+            value = HXLFactors._get_IA_info({'assets': self['assets']})[key]
+            if key == 'I/A' and self.winsorize is not None:
+                value = pd.DataFrame(_winsorize(value.values, self.winsorize),
+                                     index=value.index, columns=value.columns)
+            return value
+        elif key in self.labels:
+            codes, labels = self.labels[key]
+            return _decode(self[codes], getattr(HXLFactors, labels))
+        
+        raise KeyError(key)
+    
+    def __setitem__(self, key, value):
+        
+        self.others.pop(key, None)
+        self.arrays.pop(key, None)
+        
+        if key in self.panels:
+            value = value.reindex(index=self.index, columns=self.columns)
+            self.arrays[key] = np.ascontiguousarray(value.values, dtype=self.dtype)
+        elif key in self.codes:
+            value = value.reindex(index=self.index, columns=self.columns, 
+                                  fill_value=-1)
+            self.arrays[key] = np.ascontiguousarray(value.values, dtype=np.int8)
+        elif key not in self.returns + self.IA_info + list(self.labels):
+            self.others[key] = value
+    
+    def __delitem__(self, key):
+        
+        if key in self.arrays:
+            del self.arrays[key]
+        elif key in self.others:
+            del self.others[key]
+        else:
+            raise KeyError(key)
+    
+    def __iter__(self):
+        
+        for key in self.arrays:
+            yield key
+        if 'price' in self.arrays and 'dividends' in self.arrays:
+            for key in self.returns:
+                yield key
+        if 'assets' in self.arrays:
+            for key in self.IA_info:
+                yield key
+        for key, (codes, labels) in self.labels.items():
+            if codes in self.arrays:
+                yield key
+        for key in self.others:
+            yield key
+    
+    def __len__(self):
+        
+        return sum(1 for key in self)
+    
+    @property
+    def nbytes(self):
+        """
+        Number of bytes held by the stock x month arrays of the store.
+        """
+        
+        return sum(array.nbytes for array in self.arrays.values())
+
+
+class ResultCache(object):
+    """
+    Cache of the results of HXLFactors.calculate_factors, keyed by a 
+    fingerprint of the inputs and parameters, so that repeated calls on the
+    same panels (e.g. a dashboard refreshing) are not calculated again. Entries
+    are kept in memory up to max_bytes, evicting the least recently used, and
+    optionally written to a directory, which is checked when memory misses. 
+    The cache can be shared by several HXLFactors objects and threads.
+    
+    Entries on disk are pickles: only point directory to a trusted location.
+    """
+    
+    def __init__(self, max_bytes=256*2**20, directory=None, max_disk_bytes=None,
+                 classifications=True):
+        """
+        Parameters
+        ----------
+        max_bytes : int
+            Bytes of results kept in memory.
+        directory : String
+            Directory where results are also written. If None, results are 
+            only kept in memory.
+        max_disk_bytes : int
+            Bytes of results kept in directory, evicting the least recently 
+            used. If None, the directory is not bounded.
+        classifications : Boolean
+            If True, the classification codes (stocks x months) are kept with
+            the factors, and restored in securities on a hit.
+        """
+        
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.classifications = classifications
+        
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+    
+    def get(self, key):
+        """
+        Looks for the results of a fingerprint, in memory and then on disk.
+        
+        Parameters
+        ----------
+        key : String
+            Fingerprint of the inputs.
+            
+        Return
+        ----------
+        entry : Dict like
+            The results kept, None if not found.
+        """
+        
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+        
+        entry = None
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    entry = pickle.load(f)
+                os.utime(path)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                entry = None
+        
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, entry)
+        
+        return entry
+    
+    def put(self, key, entry):
+        """
+        Keeps the results of a fingerprint.
+        
+        Parameters
+        ----------
+        key : String
+            Fingerprint of the inputs.
+        entry : Dict like
+            The results to be kept.
+        """
+        
+        with self._lock:
+            self._remember(key, entry)
+        
+        if self.directory is not None:
+            path = self._path(key)
+            temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            with open(temporary, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, path)
+            self._trim_disk()
+    
+    def clear(self):
+        """
+        Empties the cache, in memory and on disk.
+        """
+        
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
+        
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory, name))
+    
+    def _remember(self, key, entry):
+        """
+        Keeps an entry in memory, evicting the least recently used ones beyond
+        max_bytes. Must be called holding the lock.
+        """
+        
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        
+        size = self._nbytes(entry)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (entry, size)
+        self.nbytes += size
+        
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+    
+    def _trim_disk(self):
+        """
+        Removes the least recently used entries beyond max_disk_bytes.
+        """
+        
+        if self.max_disk_bytes is None:
+            return
+        
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+        
+        total = sum(size for mtime, size, name in files)
+        for mtime, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+    
+    def _path(self, key):
+        """Path of the file holding one entry."""
+        
+        return os.path.join(self.directory, key + '.pkl')
+    
+    @staticmethod
+    def _nbytes(value):
+        """Bytes held by the arrays of an entry."""
+        
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return int(value.memory_usage(index=False, deep=False).sum()
+                       if isinstance(value, pd.DataFrame) 
+                       else value.memory_usage(index=False))
+        elif isinstance(value, np.ndarray):
+            return value.nbytes
+        elif isinstance(value, Mapping):
+            return sum(ResultCache._nbytes(item) for item in value.values())
+        
+        return 0
+
+
+class HXLResult(namedtuple('HXLResult', ['HXLInvestment', 'HXLProfit', 
+                                         'securities', 'profile_report'])):
+    """
+    Immutable result of compute_factors. securities is a read only view of
+    the information on stocks; its price and marketcap panels share the 
+    memory of the inputs, so they must not be written to.
+    """
+    
+    __slots__ = ()
+
+
+def compute_factors(prices, dividends, assets, ROE, marketcap, **parameters):
+    """
+    Calculates the HXL Investment and HXL Profitability factors without 
+    keeping any state. The inputs are only read, never modified or copied 
+    whole, so the same panels can be shared by calls running on several 
+    threads (e.g. for different breakpoint universes). The heavy stages are
+    NumPy operations, which release the GIL.
+    
+    Parameters
+    ----------
+    prices, dividends, assets, ROE, marketcap : DataFrame or Series like
+        The inputs, as in HXLFactors.calculate_factors.
+    parameters : Dict like
+        Keyword arguments to HXLFactors. A ResultCache can be shared by the
+        threads; profiling memory ('memory') can not, as tracing is global.
+        
+    Return
+    ----------
+    result : HXLResult
+        The factors, the information on stocks and the profile report (None
+        if not profiled).
+    """
+    
+    hxl = HXLFactors(**parameters)
+    hxl.calculate_factors(prices, dividends, assets, ROE, marketcap)
+    
+    return HXLResult(hxl.HXLInvestment, hxl.HXLProfit, 
+                     MappingProxyType(hxl.securities), hxl.profile_report)
+
+
 class HXLFactors(object):
+    """
+    Calculates the HXL q-factors, Investment and Profitability: stocks are 
+    sorted on size, I/A and ROE (a 2x3x3 sort, size and I/A on every June and
+    ROE monthly by default) and the factors are spreads of the value weighted
+    returns of the 18 portfolios. The sorts are steps of the engine of 
+    HXLSorts.sort_portfolios, with its SORTS configuration and the object's 
+    quantiles and schedules.
+    """
     
     high_ROE = ['BHIAHR', 'BMIAHR', 'BLIAHR', 'SHIAHR', 'SMIAHR', 'SLIAHR']
     low_ROE = ['BHIALR', 'BMIALR', 'BLIALR', 'SHIALR', 'SMIALR', 'SLIALR']
     high_IA = ['BHIAHR', 'BHIAMR', 'BHIALR', 'SHIAHR', 'SHIAMR', 'SHIALR']
     low_IA = ['BLIAHR', 'BLIAMR', 'BLIALR', 'SLIAHR', 'SLIAMR', 'SLIALR']
     
+    # Labels of the integer codes used by the classifications
+    size_labels = ['S', 'B']
+    ia_labels = ['LIA', 'MIA', 'HIA']
+    ROE_labels = ['LR', 'MR', 'HR']
+    cls_labels = ['SLIALR', 'SLIAMR', 'SLIAHR', 'SMIALR', 'SMIAMR', 'SMIAHR', 
+                  'SHIALR', 'SHIAMR', 'SHIAHR', 'BLIALR', 'BLIAMR', 'BLIAHR', 
+                  'BMIALR', 'BMIAMR', 'BMIAHR', 'BHIALR', 'BHIAMR', 'BHIAHR']
+    
+    # Fill policy (method, lag) of the information not released monthly. The
+    # months without a release are filled with zero ('zero') or with the last
+    # release ('ffill'), which is only published lag months after its date.
+    fill = {
+            'dividends': ('zero', 0),
+            'assets': ('zero', 0),
+            'ROE': ('zero', 0)
+            }
+    
+    # Quantiles used as breakpoints of the size, I/A and ROE sorts
+    breakpoints = {
+            'size': [0.5],
+            'IA': [0.3, 0.7],
+            'ROE': [0.3, 0.7]
+            }
+    
+    # Rebalancing schedule of the size, I/A and ROE sorts (see 
+    # _rebalance_months): breakpoints and classes are only calculated on its
+    # months, and held until the next
+    rebalance = {
+            'size': 'annual',
+            'IA': 'annual',
+            'ROE': 'monthly'
+            }
+    
+    # Quantiles (lower, upper) I/A and ROE are winsorized at on every month; 
+    # None keeps them as they are
+    winsorize = {
+            'I/A': None,
+            'ROE': None
+            }
+    
+    # Type of the numeric panels kept by a compact store
+    compact_dtype = np.float32
+    
+    # Months carried from a chunk to the next by stream_factors: they hold the
+    # last June sort and the assets twelve months before it
+    stream_context = 24
+    
+    # Columns of profile_report
+    profile_columns = ['stage', 'wall', 'cpu', 'rss_peak', 'traced_peak', 
+                       'inputs', 'outputs']
+    
+    def __init__(self, fill=None, compact=False, breakpoints=None, 
+                 breakpoint_universe=None, profile=False, profile_callback=None,
+                 cache=None, nan_returns='zero', threads=None, winsorize=None,
+                 min_price=None, min_marketcap=None, rebalance=None):
+        """
+        Parameters
+        ----------
+        fill : Dict like
+            Fill policy (method, lag) of 'dividends', 'assets' and/or 'ROE', 
+            overriding the defaults in HXLFactors.fill.
+        compact : Boolean
+            If True, securities is kept as a SecuritiesStore, which holds only
+            the input panels (as compact_dtype arrays) and the classification
+            codes, and calculates the other keys when accessed.
+        breakpoints : Dict like
+            Quantiles of 'size', 'IA' and/or 'ROE', overriding the defaults in
+            HXLFactors.breakpoints. The number of quantiles of each sort can not
+            change.
+        breakpoint_universe : List or DataFrame like
+            Tickers used to calculate the breakpoints (e.g. NYSE stocks only), 
+            or a boolean DataFrame (stocks x months) flagging them (e.g. big
+            caps only). If None, every security is used.
+        profile : Boolean or String
+            If True, calculate_factors records the wall time, CPU time, growth
+            of the peak RSS and input/output shapes of each stage in 
+            profile_report. If 'memory', the peak memory allocated by each 
+            stage is traced too (with tracemalloc, which slows the stages down).
+        profile_callback : Callable
+            Called with the record of each stage, as it finishes, when 
+            profiling.
+        cache : ResultCache
+            If given, the results of calculate_factors are kept in it and 
+            reused when called again with the same inputs and parameters.
+        nan_returns : String
+            Treatment of the NaN returns of stocks in the value weighted 
+            portfolio returns: 'zero' (a zero return, keeping the stock's 
+            weight), 'drop' (the stock is left out) or 'propagate' (the 
+            portfolio return is NaN).
+        threads : int
+            Number of threads reducing the portfolio returns. Defaults to the
+            number of CPUs.
+        winsorize : Dict like
+            Quantiles (lower, upper) 'I/A' and/or 'ROE' are winsorized at on 
+            every month, overriding the defaults in HXLFactors.winsorize.
+        min_price : float
+            Least price of the stocks eligible on a month. If None, there is 
+            no minimum.
+        min_marketcap : float
+            Least marketcap of the stocks eligible on a month. If None, there
+            is no minimum.
+        rebalance : Dict like
+            Rebalancing schedule of 'size', 'IA' and/or 'ROE' ('monthly', 
+            'quarterly', 'annual', a month number or a list of dates), 
+            overriding the defaults in HXLFactors.rebalance. stream_factors 
+            and append_month need a rebalancing at least every twelve months
+            (see _check_rebalance).
+        """
+        
+        self.fill = dict(self.fill, **(fill or {}))
+        self.compact = compact
+        
+        self.breakpoints = dict(self.breakpoints, **(breakpoints or {}))
+        for sort, quantiles in self.breakpoints.items():
+            if len(quantiles) != len(HXLFactors.breakpoints[sort]):
+                raise ValueError('The {} sort needs {} breakpoints, got {}.'.format(
+                        sort, len(HXLFactors.breakpoints[sort]), len(quantiles)))
+        self.breakpoint_universe = breakpoint_universe
+        
+        self.profile = profile
+        self.profile_callback = profile_callback
+        self.profile_report = None
+        
+        self.cache = cache
+        
+        if nan_returns not in _nan_returns:
+            raise ValueError('Unknown treatment of NaN returns: {}.'.format(nan_returns))
+        self.nan_returns = nan_returns
+        self.threads = threads
+        
+        unknown = [key for key in (winsorize or {}) if key not in self.winsorize]
+        if unknown:
+            raise ValueError('Only I/A and ROE can be winsorized, got {}.'.format(
+                    unknown))
+        self.winsorize = dict(self.winsorize, **(winsorize or {}))
+        self.min_price = min_price
+        self.min_marketcap = min_marketcap
+        
+        unknown = [key for key in (rebalance or {}) if key not in self.rebalance]
+        if unknown:
+            raise ValueError('Unknown sorts: {}.'.format(unknown))
+        self.rebalance = dict(self.rebalance, **(rebalance or {}))
+        for schedule in self.rebalance.values():
+            _rebalance_months([], schedule)
+    
     
     def calculate_factors(self, prices, dividends, assets, ROE, marketcap):
+        """
+        Calculates the HXL Investment and HXL Profitability factors, kept in
+        HXLInvestment and HXLProfit. The information on stocks gathered along
+        the way is kept in securities.
+        
+        Parameters
+        ----------
+        prices : DataFrame like
+            Dataframe (stocks x months) containing the prices.
+        dividends : DataFrame or Series like
+            Dataframe (stocks x dates) containing the dividends, or a Series
+            indexed by (ticker, date) holding them in long format.
+        assets : DataFrame or Series like
+            Dataframe (stocks x release dates) containing the total assets, or
+            a Series indexed by (ticker, date) holding them in long format.
+        ROE : DataFrame or Series like
+            Dataframe (stocks x release dates) containing the ROE, or a Series
+            indexed by (ticker, date) holding it in long format.
+        marketcap : DataFrame like
+            Dataframe (stocks x months) containing the marketcap.
+            
+        Long information (see HXLLoader.from_long) is only expanded to the 
+        tickers of prices and to the months of the pattern when aligned. The
+        inputs are not modified.
+        
+        With a cache, results found in it are restored instead (the factors,
+        the portfolio returns and, if kept, the classifications); securities 
+        then holds only those, and nothing is profiled.
+        """
+        
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(prices, dividends, assets, ROE, marketcap)
+            entry = self.cache.get(key)
+            if entry is not None:
+                return self._restore(entry)
+        
+        self._profiled('calculate_factors', self._calculate_factors, prices, 
+                       dividends, assets, ROE, marketcap)
+        
+        if key is not None:
+            self.cache.put(key, self._get_entry())
+    
+    def _cache_key(self, prices, dividends, assets, ROE, marketcap):
+        """
+        Key of the results of the inputs in the cache, fingerprinting them and
+        the parameters they depend on.
+        """
+        
+        return _fingerprint_inputs(prices, dividends, assets, ROE, marketcap,
+                                   self._parameters())
+    
+    def _parameters(self):
+        """
+        The parameters the factors and the information on stocks depend on,
+        as plain values (dicts sorted into lists of items), to be 
+        fingerprinted. The cache, profiling, threads and compaction do not 
+        change the results and are left out.
+        """
+        
+        return [('fill', sorted(self.fill.items())),
+                ('breakpoints', sorted(self.breakpoints.items())),
+                ('breakpoint_universe', self.breakpoint_universe),
+                ('nan_returns', self.nan_returns),
+                ('winsorize', sorted(self.winsorize.items())),
+                ('min_price', self.min_price),
+                ('min_marketcap', self.min_marketcap),
+                ('rebalance', sorted(self.rebalance.items()))]
+    
+    def _calculate_factors(self, prices, dividends, assets, ROE, marketcap, 
+                           fill=None, finish=True, prepared=None):
+        
+        fill = dict(self.fill, **(fill or {}))
         
-        # Lining up dates to end of month
-        prices.columns = prices.columns + MonthEnd(0)
-        dividends.columns = dividends.columns + MonthEnd(0)
-        assets.columns = assets.columns + MonthEnd(0)
-        ROE.columns = ROE.columns + MonthEnd(0)
-        marketcap.columns = marketcap.columns + MonthEnd(0)
+        # The price stages need only prices and dividends: they may come 
+        # prepared, e.g. while the other inputs are still loading (see 
+        # HXLSources)
+        if prepared is None:
+            prepared = self._prepare_prices(prices, dividends, fill)
+        pattern, index = prepared['price'].columns, prepared['price'].index
         
-        # Padronizing columns
-        dividends, assets, ROE = self._padronize_columns(prices.columns, 
-                                                         dividends,
-                                                         assets,
-                                                         ROE)
+        # Padronizing columns, lined up to end of month on shallow copies (long
+        # information is lined up when pivoted)
+        stage = self._run_stage
+        assets = stage('_get_aligned[assets]', self._get_aligned, 
+                       _month_end(assets), pattern, fill['assets'], index)
+        ROE = stage('_get_aligned[ROE]', self._get_aligned, _month_end(ROE), 
+                    pattern, fill['ROE'], index)
+        self.alignment_nbytes = {
+                'dividends': int(prepared['dividends'].memory_usage(index=False)
+                                 .sum()),
+                'assets': int(assets.memory_usage(index=False).sum()),
+                'ROE': int(ROE.memory_usage(index=False).sum())
+                }
         
         # Basic information
-        self.securities = {
+        self.securities = dict({
                 'assets': assets,
                 'ROE': ROE,
+                'marketcap': _month_end(marketcap)
+                }, **prepared)
+        
+        # Gathering info
+        self.securities = stage('_get_IA_info', self._get_IA_info, self.securities)
+        self.securities = stage('_preprocess', self._preprocess, self.securities,
+                                self.winsorize, self.min_price, 
+                                self.min_marketcap)
+        self.securities = stage('_get_benchmarks', self._get_benchmarks, 
+                                self.securities, self.breakpoints,
+                                self.breakpoint_universe, self.rebalance)
+        self.securities['sizecode'] = stage('_get_sizecls', self._get_sizecls, 
+                                            self.securities, self.rebalance['size'])
+        self.securities['iacode'] = stage('_get_iacls', self._get_iacls, 
+                                          self.securities, self.rebalance['IA'])
+        self.securities['ROEcode'] = stage('_get_ROEcls', self._get_ROEcls, 
+                                           self.securities, self.rebalance['ROE'])
+        self.securities['clscode'] = stage('_get_cls', self._get_cls, 
+                                           self.securities)
+        
+        # Calculating factors
+        self.securities['preturn'] = stage('_get_portfolio_returns', 
+                                           self._get_portfolio_returns, 
+                                           self.securities, self.nan_returns,
+                                           self.threads)
+        self.HXLInvestment = stage('get_investment', self.get_investment)
+        self.HXLProfit = stage('get_profit', self.get_profit)
+        
+        # State needed to append the following months
+        self._state = stage('_get_state', self._get_state, self.securities)
+        
+        if finish:
+            self._finish()
+    
+    def _prepare_prices(self, prices, dividends, fill=None):
+        """
+        Runs the stages of calculate_factors that need only prices and 
+        dividends: lining them up to end of month, aligning the dividends and
+        calculating the returns.
+        
+        Parameters
+        ----------
+        prices, dividends : DataFrame or Series like
+            The inputs, as in calculate_factors.
+        fill : Dict like
+            Fill policy of each information (see _get_aligned). Defaults to 
+            the object's.
+            
+        Return
+        ----------
+        securities : Dict
+            A dict containing price, the aligned dividends and the return 
+            related information.
+        """
+        
+        fill = dict(self.fill, **(fill or {}))
+        prices, dividends = _month_end(prices), _month_end(dividends)
+        dividends = self._run_stage('_get_aligned[dividends]', self._get_aligned,
+                                    dividends, prices.columns, fill['dividends'],
+                                    prices.index)
+        securities = {
                 'price': prices,
-                'marketcap': marketcap,
                 'dividends': dividends
                 }
         
-        # Gathering info
-        self.securities = self._get_IA_info(self.securities)
-        self.securities = self._get_return(self.securities)
-        self.securities = self._get_benchmarks(self.securities)
-        self.securities['sizecls'] = self._get_sizecls(self.securities)
-        self.securities['iacls'] = self._get_iacls(self.securities)
-        self.securities['ROEcls'] = self._get_ROEcls(self.securities)
-        self.securities['cls'] = self.securities['sizecls'] + self.securities['iacls'] + self.securities['ROEcls']
+        return self._run_stage('_get_return', self._get_return, securities)
+    
+    def _finish(self):
+        """
+        Compacts securities or labels its classifications, as requested.
+        """
         
-        # Calculating factors
-        self.HXLInvestment = self.get_investment()
-        self.HXLProfit = self.get_profit()
+        stage = self._run_stage
+        if self.compact:
+            self.securities = stage('SecuritiesStore', SecuritiesStore, 
+                                    self.securities, self.compact_dtype,
+                                    self.winsorize['I/A'])
+        else:
+            # Labeled classifications
+            self.securities.update(stage('_get_labels', self._get_labels, 
+                                         self.securities))
     
-    def get_profit(self):
+    def evaluate(self, outputs, prices, dividends, assets, ROE, marketcap):
+        """
+        Calculates only the requested outputs of the pipeline. The pipeline is
+        a graph of named nodes (see _get_graph); only the nodes the outputs 
+        depend on are calculated, each once, and every intermediate node is
+        released as soon as the last node using it is calculated. Nothing is 
+        kept in the object, besides profile_report when profiling.
+        
+        Parameters
+        ----------
+        outputs : List like
+            Names of the nodes requested: 'price', 'marketcap', 'dividends', 
+            'assets', 'ROE', 'lprice', 'return', 'lreturn', 'lassets', 'I/A',
+            'eligible', 'sizebreaks', 'IAbreaks', 'ROEbreaks', 'sizecode', 'iacode', 
+            'ROEcode', 'clscode', 'sizecls', 'iacls', 'ROEcls', 'cls', 
+            'preturn', 'HXLInvestment' and 'HXLProfit'.
+        prices, dividends, assets, ROE, marketcap : DataFrame or Series like
+            The inputs, as in calculate_factors.
+            
+        Return
+        ----------
+        results : Dict
+            A dict containing the requested outputs.
+            
+        The HXL factors are spreads of the size x I/A x ROE portfolios, so 
+        HXLProfit needs the I/A sort too; e.g. 'ROEcode' alone skips the 
+        returns and the I/A branch.
+        """
+        
+        graph = self._get_graph(prices, dividends, assets, ROE, marketcap)
+        unknown = [output for output in outputs if output not in graph]
+        if unknown:
+            raise ValueError('Unknown outputs: {}.'.format(unknown))
+        
+        # Nodes needed, each after the nodes it depends on
+        order = []
+        def visit(node):
+            if node not in order:
+                for dependency in graph[node][0]:
+                    visit(dependency)
+                order.append(node)
+        for output in outputs:
+            visit(output)
+        consumers = {node: 0 for node in order}
+        for node in order:
+            for dependency in graph[node][0]:
+                consumers[dependency] += 1
+        
+        def run():
+            values = {}
+            for node in order:
+                dependencies, method = graph[node]
+                values[node] = self._run_stage(node, method, 
+                                               *[values[dependency] 
+                                                 for dependency in dependencies])
+                for dependency in dependencies:
+                    consumers[dependency] -= 1
+                    if not consumers[dependency] and dependency not in outputs:
+                        del values[dependency]
+            return {output: values[output] for output in outputs}
+        
+        return self._profiled('evaluate', run)
+    
+    def _get_graph(self, prices, dividends, assets, ROE, marketcap):
+        """
+        Builds the graph of the pipeline on the inputs, following the 
+        parameters of the object.
+        
+        Parameters
+        ----------
+        prices, dividends, assets, ROE, marketcap : DataFrame or Series like
+            The inputs, as in calculate_factors.
+            
+        Return
+        ----------
+        graph : Dict
+            A dict mapping each node to the nodes it depends on and the 
+            function calculating it from them.
+        """
+        
+        prices, marketcap, dividends, assets, ROE = [
+                _month_end(frame) for frame in (prices, marketcap, dividends, 
+                                                assets, ROE)]
+        pattern, index = prices.columns, prices.index
+        aligned = lambda values, field: lambda: self._get_aligned(
+                values, pattern, self.fill[field], index)
+        
+        def winsorized(key, calculate):
+            def preprocess(*args):
+                panel = calculate(*args)
+                return pd.DataFrame(_winsorize(panel.values, self.winsorize[key]),
+                                    index=panel.index, columns=panel.columns)
+            return preprocess if self.winsorize[key] is not None else calculate
+        
+        def eligible(price, marketcap):
+            return self._preprocess({'price': price, 'marketcap': marketcap}, 
+                                    None, self.min_price, 
+                                    self.min_marketcap)['eligible']
+        
+        def breaks(sort):
+            def calculate(panel, eligible):
+                from HXLSorts import SORTS, sort_breakpoints
+                config = dict(SORTS[sort], quantiles=self.breakpoints[sort],
+                              rebalance=self.rebalance[sort])
+                return sort_breakpoints(panel, config, self.breakpoint_universe,
+                                        eligible)
+            return calculate
+        
+        decode = lambda labels: lambda codes: _decode(codes, labels)
+        
+        return {
+                'price': ([], lambda: prices),
+                'marketcap': ([], lambda: marketcap),
+                'dividends': ([], aligned(dividends, 'dividends')),
+                'assets': ([], aligned(assets, 'assets')),
+                'ROE': ([], winsorized('ROE', aligned(ROE, 'ROE'))),
+                'lprice': (['price'], lambda price: price.shift(1, axis=1)),
+                'return': (['price', 'lprice', 'dividends'],
+                           lambda price, lprice, dividends: 
+                               (dividends + (price - lprice))/lprice),
+                'lreturn': (['return'], lambda returns: returns.shift(-1, axis=1)),
+                'lassets': (['assets'], lambda assets: assets.shift(12, axis=1)),
+                'I/A': (['assets', 'lassets'], 
+                        winsorized('I/A', lambda assets, lassets: 
+                                       (assets - lassets)/lassets)),
+                'eligible': (['price', 'marketcap'], eligible),
+                'sizebreaks': (['marketcap', 'eligible'], breaks('size')),
+                'IAbreaks': (['I/A', 'eligible'], breaks('IA')),
+                'ROEbreaks': (['ROE', 'eligible'], breaks('ROE')),
+                'sizecode': (['marketcap', 'sizebreaks', 'eligible'], 
+                             lambda marketcap, sizebreaks, eligible: self._get_sizecls(
+                                     {'marketcap': marketcap, 'sizebreaks': sizebreaks,
+                                      'eligible': eligible}, self.rebalance['size'])),
+                'iacode': (['I/A', 'IAbreaks', 'eligible'], 
+                           lambda iaratio, IAbreaks, eligible: self._get_iacls(
+                                   {'I/A': iaratio, 'IAbreaks': IAbreaks, 
+                                    'eligible': eligible}, self.rebalance['IA'])),
+                'ROEcode': (['ROE', 'ROEbreaks', 'eligible'], 
+                            lambda ROE, ROEbreaks, eligible: self._get_ROEcls(
+                                    {'ROE': ROE, 'ROEbreaks': ROEbreaks,
+                                     'eligible': eligible}, self.rebalance['ROE'])),
+                'clscode': (['sizecode', 'iacode', 'ROEcode', 'eligible'],
+                            lambda sizecode, iacode, ROEcode, eligible: self._get_cls(
+                                    {'sizecode': sizecode, 'iacode': iacode, 
+                                     'ROEcode': ROEcode, 'eligible': eligible})),
+                'sizecls': (['sizecode'], decode(self.size_labels)),
+                'iacls': (['iacode'], decode(self.ia_labels)),
+                'ROEcls': (['ROEcode'], decode(self.ROE_labels)),
+                'cls': (['clscode'], decode(self.cls_labels)),
+                'preturn': (['clscode', 'lreturn', 'marketcap'],
+                            lambda clscode, lreturn, marketcap: 
+                                self._get_portfolio_returns(
+                                        {'clscode': clscode, 'lreturn': lreturn,
+                                         'marketcap': marketcap}, 
+                                        self.nan_returns, self.threads)),
+                'HXLInvestment': (['preturn'], lambda preturn: self._get_spread(
+                        preturn, self.high_IA, self.low_IA)),
+                'HXLProfit': (['preturn'], lambda preturn: self._get_spread(
+                        preturn, self.high_ROE, self.low_ROE))
+                }
+    
+    def _profiled(self, stage, method, *args):
+        """
+        Runs a method as the outermost stage of a profile, when profiling, and
+        gathers profile_report.
+        """
+        
+        if not self.profile:
+            return method(*args)
+        
+        self._profile = []
+        self._traced_peak = 0
+        tracing = self.profile == 'memory' and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        try:
+            result = self._run_stage(stage, method, *args)
+        finally:
+            if tracing:
+                tracemalloc.stop()
+        
+        self.profile_report = pd.DataFrame(self._profile, 
+                                           columns=self.profile_columns)
+        
+        return result
+    
+    def _get_entry(self):
+        """
+        Gathers the results kept by the cache: copies of the factors, the 
+        portfolio returns, the state and, if requested, the classifications.
+        """
+        
+        entry = {
+                'HXLInvestment': self.HXLInvestment.copy(),
+                'HXLProfit': self.HXLProfit.copy(),
+                'preturn': self.securities['preturn'].copy(),
+                'state': dict(self._state)
+                }
+        if self.cache.classifications:
+            for key in SecuritiesStore.codes:
+                entry[key] = self.securities[key].copy()
+        
+        return entry
+    
+    def _restore(self, entry):
+        """
+        Restores the results of a cache entry, as calculate_factors would have
+        left them.
+        """
+        
+        self.HXLInvestment = entry['HXLInvestment'].copy()
+        self.HXLProfit = entry['HXLProfit'].copy()
+        self.securities = {'preturn': entry['preturn'].copy()}
+        self._state = dict(entry['state'])
+        
+        self.profile_report = None
+        
+        if 'clscode' in entry:
+            for key in SecuritiesStore.codes:
+                self.securities[key] = entry[key].copy()
+            if self.compact:
+                self.securities = SecuritiesStore(self.securities, self.compact_dtype,
+                                                  self.winsorize['I/A'])
+            else:
+                self.securities.update(self._get_labels(self.securities))
+    
+    def stream_factors(self, chunks):
+        """
+        Calculates the factors chunk by chunk of months, so that only one chunk
+        (plus the stream_context months before it) is in memory at a time. 
+        Each chunk is calculated together with the last months of the previous
+        one, which hold the last rebalancing of the sorts, the lagged assets and
+        the previous prices, so the factors are the same as calculate_factors 
+        would give on the whole history. After the stream, securities and the state used by
+        append_month refer to the last chunk.
+        
+        Parameters
+        ----------
+        chunks : Iterable
+            Dicts keyed as the arguments of calculate_factors, holding 
+            consecutive months of prices and marketcap, and the dividends, 
+            assets and ROE released along them (see HXLLoader.iter_chunks).
+            
+        Return
+        ----------
+        factors : Generator
+            DataFrames containing the HXLInvestment and HXLProfit of the months
+            finished by each chunk. A month is finished once the returns of the
+            next month are known: the last month of a chunk comes with the next
+            chunk, and the last month of the stream after the last chunk.
+            
+        Raises
+        ----------
+        ValueError
+            If a sort rebalancing on a list of dates goes more than 
+            stream_context - 12 months without a rebalancing (see 
+            _check_rebalance).
+        """
+        
+        self._check_rebalance()
+        
+        # Releases are aligned here, so the pipeline gets complete months
+        aligned = {field: ('zero', 0) for field in self.fill}
+        fields = ['prices', 'dividends', 'assets', 'ROE', 'marketcap']
+        keys = ['price', 'dividends', 'assets', 'ROE', 'marketcap']
+        context = None
+        pending = {}
+        finished = None
+        if self.profile:
+            self._profile = []
+            self._traced_peak = 0
+        
+        for chunk in chunks:
+            index = chunk['prices'].index if context is None else context['price'].index
+            months = chunk['prices'].columns + MonthEnd(0)
+            self._check_rebalance(months)
+            panels = {
+                    'prices': chunk['prices'].reindex(index).set_axis(months, axis=1),
+                    'marketcap': chunk['marketcap'].reindex(index).set_axis(
+                            chunk['marketcap'].columns + MonthEnd(0), axis=1)
+                    }
+            for field, (method, lag) in self.fill.items():
+                releases = chunk[field].reindex(index)
+                releases = releases.set_axis(releases.columns + MonthEnd(0) 
+                                             + MonthEnd(lag), axis=1)
+                if field in pending:
+                    releases = pd.concat([pending[field], releases], axis=1)
+                panel = _align(releases, months, method)
+                if method == 'ffill' and context is not None:
+                    # Months before the chunk's first release keep the last one
+                    lead = np.ones(len(months), dtype=bool)
+                    if len(releases.columns):
+                        lead = months < releases.columns.min()
+                    panel.loc[:, lead] = np.repeat(context[field].values[:, -1:],
+                                                   lead.sum(), axis=1)
+                pending[field] = releases.loc[:, releases.columns > months[-1]]
+                panels[field] = panel
+            
+            if context is not None:
+                panels = {field: pd.concat([context[key], panels[field]], axis=1)
+                          for field, key in zip(fields, keys)}
+            
+            args = [panels[field] for field in fields]
+            if self.profile:
+                self._run_stage('calculate_factors', self._calculate_factors, 
+                                *args, aligned, False)
+            else:
+                self._calculate_factors(*args, fill=aligned, finish=False)
+            context = {key: self.securities[key].iloc[:, -self.stream_context:].copy()
+                       for key in keys}
+            self._finish()
+            
+            factors = pd.DataFrame({'HXLInvestment': self.HXLInvestment,
+                                    'HXLProfit': self.HXLProfit})
+            start = 0 if finished is None else factors.index.get_loc(finished)
+            if start < len(factors) - 1:
+                yield factors.iloc[start:-1]
+            finished = factors.index[-1]
+        
+        if self.profile:
+            self.profile_report = pd.DataFrame(self._profile, 
+                                               columns=self.profile_columns)
+        if finished is not None:
+            yield factors.iloc[-1:]
+    
+    def _check_rebalance(self, months=None):
+        """
+        Checks that the sorts rebalancing on a list of dates do not go more 
+        than stream_context - 12 months without a rebalancing: the months 
+        stream_factors carries between chunks must hold the last rebalancing 
+        and the assets twelve months before it. The other schedules rebalance
+        at least every twelve months.
+        
+        Parameters
+        ----------
+        months : Array like
+            Months being calculated, each checked against the last rebalancing
+            up to it. If None, the gaps between the dates of the schedules are
+            checked.
+            
+        Raises
+        ----------
+        ValueError
+            If a gap is longer than the limit.
+        """
         
-        lreturns = self.securities['lreturn']
-        stocks_cls = self.securities['cls']
-        marketcap = self.securities['marketcap']
-        HXLProfit = pd.Series(index=stocks_cls.columns)
-        
-        for c in stocks_cls.columns:
-            phigh_returns = []
-            plow_returns = []
-            for scls in self.high_ROE:
-                high_investment = stocks_cls[stocks_cls[c] == scls].index
-                high_returns = lreturns.loc[high_investment, c]
-                phigh_returns.append(np.sum(high_returns*marketcap.loc[high_investment, c])/np.sum(marketcap.loc[high_investment, c]))
-
-            for scls in self.low_ROE:            
-                low_investment = stocks_cls[stocks_cls[c] == scls].index
-                low_returns = lreturns.loc[low_investment, c]
-                plow_returns.append(np.sum(low_returns*marketcap.loc[low_investment, c])/np.sum(marketcap.loc[low_investment, c]))
+        limit = self.stream_context - 12
+        for sort, schedule in self.rebalance.items():
+            if schedule is None or isinstance(schedule, (str, int, np.integer)):
+                continue
+            
+            dates = np.unique(_month_numbers(schedule))
+            if not len(dates):
+                continue
+            gaps = np.diff(dates)
+            if months is not None:
+                numbers = _month_numbers(months)
+                last = np.searchsorted(dates, numbers, side='right') - 1
+                gaps = (numbers - dates[np.maximum(last, 0)])[last >= 0]
+            if np.any(gaps > limit):
+                raise ValueError('The {} sort goes {} months without a rebalancing; '
+                                 'stream_factors and append_month need one at '
+                                 'least every {} months.'.format(sort, gaps.max(),
+                                                                 limit))
+    
+    def _run_stage(self, stage, method, *args):
+        """
+        Runs one stage of calculate_factors. If profiling, records its wall 
+        time, CPU time, growth of the peak RSS, traced peak memory (if tracing)
+        and the shapes of its inputs and outputs.
+    
+        Parameters
+        ----------
+        stage : String
+            Name of the stage.
+        method : Callable
+            Function running the stage.
+        args : 
+            Arguments of the stage.
             
-            factor = np.mean(phigh_returns) - np.mean(plow_returns)
+        Return
+        ----------
+        result : 
+            The result of the stage.
+        """
+        
+        if not self.profile:
+            return method(*args)
+        
+        # Stages can be nested: the peak of the enclosing stage is kept aside
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            enclosing = max(self._traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+            self._traced_peak = 0
+        rss = _peak_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        
+        result = method(*args)
+        
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        traced_peak = None
+        if tracing:
+            peak = max(self._traced_peak, tracemalloc.get_traced_memory()[1])
+            traced_peak = peak - traced
+            self._traced_peak = max(enclosing, peak)
+        
+        outputs = result
+        if isinstance(result, dict) and args and isinstance(args[0], dict):
+            # Stages updating securities: only the keys they added
+            outputs = {key: value for key, value in result.items() 
+                       if args[0].get(key) is not value}
+        
+        record = {
+                'stage': stage,
+                'wall': wall,
+                'cpu': cpu,
+                'rss_peak': None if rss is None else _peak_rss() - rss,
+                'traced_peak': traced_peak,
+                'inputs': _shapes(args),
+                'outputs': _shapes(outputs)
+                }
+        self._profile.append(record)
+        if self.profile_callback is not None:
+            self.profile_callback(record)
+        
+        return result
+    
+    def append_month(self, date, prices, marketcap, dividends=None, assets=None, 
+                     ROE=None):
+        """
+        Adds one month to the factors calculated by calculate_factors. Only the
+        new month is processed, using the state kept from the previous month
+        (prices, marketcap, the last twelve months of assets and the current
+        classifications). The factors of the previous month are updated too, as
+        they depend on the returns of the new month. The stock level panels of
+        securities are not extended; the breakpoints and portfolio returns are.
+        The universe is fixed when calculate_factors is called: tickers not in
+        it are dropped, with a warning.
+        
+        Parameters
+        ----------
+        date : Timestamp like
+            Date of the new month, which must be the month after the last one
+            calculated.
+        prices : Series like
+            Series containing the prices of the securities on the new month.
+        marketcap : Series like
+            Series containing the marketcap of the securities on the new month.
+        dividends : Series like
+            Series containing the dividends of the securities on the new month.
+            If None, the month is filled following the fill policy.
+        assets : Series like
+            Series containing the assets of the securities on the new month. If
+            None, the month is filled following the fill policy.
+        ROE : Series like
+            Series containing the ROE of the securities on the new month. If 
+            None, the month is filled following the fill policy.
             
-            HXLProfit.at[c] = factor
+        With a publication lag, the information passed is the one published on
+        the new month. As with stream_factors, a sort rebalancing on a list of
+        dates must not go more than stream_context - 12 months without a 
+        rebalancing, or ValueError is raised.
+        """
+        
+        state = self._state
+        date = pd.Timestamp(date) + MonthEnd(0)
+        if date != state['date'] + MonthEnd(1):
+            raise ValueError('Month {} is not the month after the last month '
+                             'calculated ({}).'.format(date.date(), 
+                                                       state['date'].date()))
+        self._check_rebalance()
+        self._check_rebalance([date])
+        
+        # Basic information, as single month DataFrames
+        index = state['index']
+        columns = pd.DatetimeIndex([date])
+        month = {
+                'price': prices,
+                'marketcap': marketcap,
+                'dividends': dividends,
+                'assets': assets,
+                'ROE': ROE
+                }
+        securities = {}
+        for field, values in month.items():
+            if values is None and self.fill[field][0] == 'ffill':
+                values = state[field]
+            elif values is None:
+                values = np.zeros(len(index))
+            else:
+                values = pd.Series(values)
+                new = values.index.difference(index)
+                if len(new):
+                    warnings.warn('Dropping {} tickers of {} not in the universe '
+                                  'of calculate_factors: {}.'.format(
+                                          len(new), field, list(new[:5])))
+                values = values.reindex(index).values
+            securities[field] = pd.DataFrame(values.astype(float)[:, np.newaxis],
+                                             index=index, columns=columns)
+        
+        # Gathering info, carrying the lagged information from the state
+        securities['lassets'] = pd.DataFrame(state['assets12'][:, :1], index=index,
+                                             columns=columns)
+        securities['lprice'] = pd.DataFrame(state['price'][:, np.newaxis], 
+                                            index=index, columns=columns)
+        securities['investment'] = securities['assets'] - securities['lassets']
+        securities['I/A'] = securities['investment']/securities['lassets']
+        securities['return'] = (securities['dividends'] + securities['price'] 
+                                - securities['lprice'])/securities['lprice']
+        securities['lreturn'] = securities['return']*np.nan
+        securities = self._preprocess(securities, self.winsorize, self.min_price,
+                                      self.min_marketcap)
+        securities = self._get_benchmarks(securities, self.breakpoints,
+                                          self.breakpoint_universe, self.rebalance,
+                                          {sort: state[sort + 'breaks'] 
+                                           for sort in self.rebalance})
+        
+        # Sorts rebalancing on the new month, the others hold their classes
+        for sort, key, method in [('size', 'sizecode', self._get_sizecls), 
+                                  ('IA', 'iacode', self._get_iacls),
+                                  ('ROE', 'ROEcode', self._get_ROEcls)]:
+            if _rebalance_months(columns, self.rebalance[sort])[0]:
+                securities[key] = method(securities, self.rebalance[sort])
+            else:
+                securities[key] = pd.DataFrame(state[key][:, np.newaxis],
+                                               index=index, columns=columns)
+        securities['clscode'] = self._get_cls(securities)
+        
+        # Portfolio returns of the previous month, now that its returns are known
+        labels = self.cls_labels
+        lpreturn = _value_weight(state['clscode'][:, np.newaxis], 
+                                 securities['return'].values,
+                                 state['marketcap'][:, np.newaxis], len(labels),
+                                 self.nan_returns, 1)
+        lpreturn = pd.DataFrame(lpreturn, index=labels, 
+                                columns=pd.DatetimeIndex([state['date']]))
+        preturn = self._get_portfolio_returns(securities, self.nan_returns, 1)
+        preturn = pd.concat([lpreturn, preturn], axis=1)
+        
+        # Calculating factors
+        self.securities['preturn'] = pd.concat([self.securities['preturn'].iloc[:, :-1],
+                                                preturn], axis=1)
+        self.HXLInvestment = pd.concat([self.HXLInvestment.iloc[:-1], 
+                                        self._get_spread(preturn, self.high_IA, 
+                                                         self.low_IA)])
+        self.HXLProfit = pd.concat([self.HXLProfit.iloc[:-1], 
+                                    self._get_spread(preturn, self.high_ROE, 
+                                                     self.low_ROE)])
+        for key in ['sizebreaks', 'IAbreaks', 'ROEbreaks']:
+            if key in self.securities:
+                self.securities[key] = pd.concat([self.securities[key], 
+                                                  securities[key]], axis=1)
+        
+        # Moving the state to the new month
+        self._state = {
+                'date': date,
+                'index': index,
+                'price': securities['price'].values[:, 0],
+                'marketcap': securities['marketcap'].values[:, 0],
+                'assets': securities['assets'].values[:, 0],
+                'assets12': np.hstack([state['assets12'][:, 1:], 
+                                       securities['assets'].values]),
+                'dividends': securities['dividends'].values[:, 0],
+                'ROE': securities['ROE'].values[:, 0],
+                'sizecode': securities['sizecode'].values[:, 0],
+                'iacode': securities['iacode'].values[:, 0],
+                'ROEcode': securities['ROEcode'].values[:, 0],
+                'clscode': securities['clscode'].values[:, 0],
+                'sizebreaks': securities['sizebreaks'].values[:, 0],
+                'IAbreaks': securities['IAbreaks'].values[:, 0],
+                'ROEbreaks': securities['ROEbreaks'].values[:, 0]
+                }
+    
+    def get_profit(self):
+        """
+        Calculates the HXL Profitability factor: the average return of the high
+        ROE portfolios minus the average return of the low ROE portfolios.
             
-        return HXLProfit
+        Return
+        ----------
+        HXLProfit : Series
+            A Series containing the factor value for each month.
+        """
+        
+        return self._get_spread(self.securities['preturn'], self.high_ROE, 
+                                self.low_ROE)
     
     def get_investment(self):
+        """
+        Calculates the HXL Investment factor: the average return of the high
+        I/A portfolios minus the average return of the low I/A portfolios.
+            
+        Return
+        ----------
+        HXLInvestment : Series
+            A Series containing the factor value for each month.
+        """
+        
+        return self._get_spread(self.securities['preturn'], self.high_IA, 
+                                self.low_IA)
+    
+    @staticmethod
+    def _get_spread(preturn, high, low):
+        """
+        Calculates the difference between the average return of two groups of
+        portfolios. If any portfolio of a group has no return on a month, the
+        spread of that month is NaN.
+    
+        Parameters
+        ----------
+        preturn : DataFrame like
+            A DataFrame containing the portfolios returns (portfolios x months).
+        high : List like
+            Labels of the portfolios on the long side.
+        low : List like
+            Labels of the portfolios on the short side.
+            
+        Return
+        ----------
+        spread : Series
+            A Series containing the spread for each month.
+        """
+        
+        return preturn.loc[high].mean(skipna=False) - preturn.loc[low].mean(skipna=False)
+    
+    @staticmethod
+    def _get_portfolio_returns(securities, nan_returns='zero', threads=None):
+        """
+        Calculates the value weighted return of every portfolio on every month
+        in a single grouped reduction over the portfolio codes, leaving out the
+        securities not eligible on a month.
+    
+        Parameters
+        ----------
+        securities : Dict like
+            A dict containing the information on stocks. 
+        nan_returns : String
+            Treatment of NaN returns ('zero', 'drop' or 'propagate').
+        threads : int
+            Number of threads. Defaults to the number of CPUs.
+            
+        Return
+        ----------
+        preturn : DataFrame
+            A DataFrame containing the portfolios returns (portfolios x months).
+        """
         
-        lreturns = self.securities['lreturn']
-        stocks_cls = self.securities['cls']
-        marketcap = self.securities['marketcap']
-        HXLInvestment = pd.Series(index=stocks_cls.columns)
-        
-        for c in stocks_cls.columns:
-            phigh_returns = []
-            plow_returns = []
-            for scls in self.high_IA:
-                high_investment = stocks_cls[stocks_cls[c] == scls].index
-                high_returns = lreturns.loc[high_investment, c]
-                phigh_returns.append(np.sum(high_returns*marketcap.loc[high_investment, c])/np.sum(marketcap.loc[high_investment, c]))
-
-            for scls in self.low_IA:            
-                low_investment = stocks_cls[stocks_cls[c] == scls].index
-                low_returns = lreturns.loc[low_investment, c]
-                plow_returns.append(np.sum(low_returns*marketcap.loc[low_investment, c])/np.sum(marketcap.loc[low_investment, c]))
+        codes = securities['clscode']
+        labels = HXLFactors.cls_labels
+        lreturns = securities['lreturn'].reindex(index=codes.index, 
+                                                 columns=codes.columns)
+        marketcap = securities['marketcap'].reindex(index=codes.index, 
+                                                    columns=codes.columns)
+        eligible = _universe_mask(securities.get('eligible'), codes)
+        preturn = _value_weight(codes.values if eligible is None else
+                                np.where(eligible, codes.values, -1), 
+                                lreturns.values, marketcap.values, len(labels), 
+                                nan_returns, threads)
+        
+        return pd.DataFrame(preturn, index=labels, columns=codes.columns)
             
-            factor = np.mean(phigh_returns) - np.mean(plow_returns)
+        
+    @staticmethod
+    def _get_labels(securities):
+        """
+        Translates the classification codes to their labels.
+    
+        Parameters
+        ----------
+        securities : Dict like
+            A dict containing the information on stocks. 
             
-            HXLInvestment.at[c] = factor
+        Return
+        ----------
+        labels : Dict
+            A dict containing the sizecls, iacls, ROEcls and cls DataFrames.
+        """
+        
+        return {
+                'sizecls': _decode(securities['sizecode'], HXLFactors.size_labels),
+                'iacls': _decode(securities['iacode'], HXLFactors.ia_labels),
+                'ROEcls': _decode(securities['ROEcode'], HXLFactors.ROE_labels),
+                'cls': _decode(securities['clscode'], HXLFactors.cls_labels)
+                }
+    
+    @staticmethod
+    def _get_state(securities):
+        """
+        Gathers the information of the last month that is needed to calculate
+        the following months (see append_month).
+    
+        Parameters
+        ----------
+        securities : Dict like
+            A dict containing the information on stocks. 
             
-        return HXLInvestment
+        Return
+        ----------
+        state : Dict
+            A dict containing the last month information, aligned to the 
+            securities in the portfolio codes.
+        """
+        
+        codes = securities['clscode']
+        index = codes.index
+        
+        # Twelve months of assets, padded with NaN if the history is shorter
+        assets12 = securities['assets'].reindex(index).values[:, -12:]
+        assets12 = np.hstack([np.full((len(index), 12 - assets12.shape[1]), np.nan),
+                              assets12])
+        
+        return {
+                'date': codes.columns[-1],
+                'index': index,
+                'price': securities['price'].iloc[:, -1].reindex(index).values,
+                'marketcap': securities['marketcap'].iloc[:, -1].reindex(index).values,
+                'assets': assets12[:, -1],
+                'assets12': assets12,
+                'dividends': securities['dividends'].iloc[:, -1].reindex(index).values,
+                'ROE': securities['ROE'].iloc[:, -1].reindex(index).values,
+                'sizecode': securities['sizecode'].iloc[:, -1].values,
+                'iacode': securities['iacode'].iloc[:, -1].reindex(index, fill_value=-1).values,
+                'ROEcode': securities['ROEcode'].iloc[:, -1].reindex(index, fill_value=-1).values,
+                'clscode': codes.iloc[:, -1].values,
+                'sizebreaks': securities['sizebreaks'].values[:, -1],
+                'IAbreaks': securities['IAbreaks'].values[:, -1],
+                'ROEbreaks': securities['ROEbreaks'].values[:, -1]
+                }
+    
+    @staticmethod
+    def _get_cls(securities):
+        """
+        Combines the size, I/A and ROE classifications into the code of the
+        portfolio each security belongs to (size*9 + I/A*3 + ROE), following the
+        order of cls_labels. Securities not eligible on a month are in no 
+        portfolio (-1).
+    
+        Parameters
+        ----------
+        securities : Dict like
+            A dict containing the information on stocks. 
             
+        Return
+        ----------
+        clscode : DataFrame
+            A DataFrame containing the stocks portfolio codes.
+        """
         
+        from HXLSorts import sort_cells
         
+        sizecode = securities['sizecode']
+        codes = [securities[key].reindex(index=sizecode.index, 
+                                         columns=sizecode.columns,
+                                         fill_value=-1).values
+                 for key in ['sizecode', 'iacode', 'ROEcode']]
+        sizes = [len(HXLFactors.size_labels), len(HXLFactors.ia_labels),
+                 len(HXLFactors.ROE_labels)]
+        clscode = sort_cells(codes, sizes, 
+                             _universe_mask(securities.get('eligible'), sizecode))
+        
+        return pd.DataFrame(clscode, index=sizecode.index, 
+                            columns=sizecode.columns)
+    
     @staticmethod
-    def _get_ROEcls(securities):
+    def _get_ROEcls(securities, rebalance='monthly'):
         """
-        Divides the securities in High, Medium and Low, based on the percentiles of the
-        ROE (30% and 70%).
+        Divides the securities in High (2), Medium (1) and Low (0), based on the 
+        percentiles of the ROE (30% and 70%). Securities are sorted on the 
+        rebalancing months (by default every month) and hold their class until
+        the next.
     
         Parameters
         ----------
         securities : Dict like
             A dict containing the information on stocks. 
+        rebalance : String, int or List like
+            Rebalancing schedule (see _rebalance_months).
             
         Return
         ----------
         ROEcls : DataFrame
-            A DataFrame containing the stocks classification.
+            A DataFrame containing the stocks classification codes.
         """        
         
-        ROEcls = pd.DataFrame(index=securities['ROE'].index, 
-                             columns=securities['ROE'].columns)
-        ROE30 = securities['ROE30']
-        ROE70 = securities['ROE70']
-        
-        for i in securities['ROE'].index:
-            indicator = np.nan
-            for c in securities['ROE'].columns:
-                
-                benchmark30 = ROE30[c]
-                benchmark70 = ROE70[c]
-                stock_ROE = securities['ROE'].loc[i, c]
-                
-                if stock_ROE == np.nan or stock_ROE == 0:
-                    indicator = ROEcls.loc[i][-1]
-                elif stock_ROE <= benchmark30:
-                    indicator = 'LR'
-                elif stock_ROE <= benchmark70:
-                    indicator = 'MR'
-                else:
-                    indicator = 'HR'
-                    
-                ROEcls.at[i, c] = indicator
+        from HXLSorts import SORTS, sort_buckets
+        
+        ROE = securities['ROE']
+        codes = sort_buckets(ROE, securities['ROEbreaks'], 
+                             dict(SORTS['ROE'], rebalance=rebalance),
+                             securities.get('eligible'))
                     
-        return ROEcls
+        return pd.DataFrame(codes, index=ROE.index, columns=ROE.columns)
     
     @staticmethod
-    def _get_iacls(securities):
+    def _get_iacls(securities, rebalance='annual'):
         """
-        Divides the securities in High, Medium and Low, based on the percentiles of the
-        Investment over Assets ratio (30% and 70%).
+        Divides the securities in High (2), Medium (1) and Low (0), based on the 
+        percentiles of the Investment over Assets ratio (30% and 70%). Securities
+        are sorted on the rebalancing months (by default at the end of June) 
+        and hold their class until the next.
     
         Parameters
         ----------
         securities : Dict like
             A dict containing the information on stocks. 
+        rebalance : String, int or List like
+            Rebalancing schedule (see _rebalance_months).
             
         Return
         ----------
         iacls : DataFrame
-            A DataFrame containing the stocks classification.
+            A DataFrame containing the stocks classification codes.
         """        
         
-        iacls = pd.DataFrame(index=securities['I/A'].index, 
-                             columns=securities['I/A'].columns)
-        ia30 = securities['IA30']
-        ia70 = securities['IA70']
-        
-        for i in securities['I/A'].index:
-            indicator = np.nan            
-            for c in securities['I/A'].columns:
-                
-                benchmark30 = ia30[c]
-                benchmark70 = ia70[c]
-                stock_ia = securities['I/A'].loc[i, c]
-                
-                if c.month == 6:
-                    if stock_ia == np.nan or stock_ia == 0:
-                        indicator = np.nan
-                    elif stock_ia <= benchmark30:
-                        indicator = 'LIA'
-                    elif stock_ia <= benchmark70:
-                        indicator = 'MIA'
-                    else:
-                        indicator = 'HIA'
-                
-                iacls.at[i, c] = indicator
+        from HXLSorts import SORTS, sort_buckets
+        
+        iaratio = securities['I/A']
+        codes = sort_buckets(iaratio, securities['IAbreaks'], 
+                             dict(SORTS['IA'], rebalance=rebalance),
+                             securities.get('eligible'))
                     
-        return iacls
+        return pd.DataFrame(codes, index=iaratio.index, columns=iaratio.columns)
     
     @staticmethod
-    def _get_sizecls(securities):
+    def _get_sizecls(securities, rebalance='annual'):
         """
-        Divides the securities in Big and Small, based on the median of the
-        marketcap.
+        Divides the securities in Big (1) and Small (0), based on the median of 
+        the marketcap. Securities are sorted on the rebalancing months (by 
+        default at the end of June) and hold their class until the next.
     
         Parameters
         ----------
         securities : Dict like
             A dict containing the information on stocks. 
+        rebalance : String, int or List like
+            Rebalancing schedule (see _rebalance_months).
             
         Return
         ----------
         sizecls : DataFrame
-            A DataFrame containing the stocks classification.
+            A DataFrame containing the stocks classification codes.
         """        
         
-        sizecls = pd.DataFrame(index=securities['marketcap'].index, 
-                               columns=securities['marketcap'].columns)
-        sizemedian = securities['mkmedian']
-        
-        for i in sizecls.index:
-            indicator = np.nan
-            for c in sizecls.columns:
-                
-                benchmark = sizemedian[c]
-                stock_size = securities['marketcap'].loc[i, c]
-                
-                if c.month == 6:
-                    if stock_size == np.nan or stock_size == 0:
-                        indicator = np.nan
-                    elif stock_size <= benchmark:
-                        indicator = 'S'
-                    else:
-                        indicator = 'B'
-                        
-                sizecls.at[i, c] = indicator
+        from HXLSorts import SORTS, sort_buckets
+        
+        marketcap = securities['marketcap']
+        codes = sort_buckets(marketcap, securities['sizebreaks'], 
+                             dict(SORTS['size'], rebalance=rebalance),
+                             securities.get('eligible'))
                     
-        return sizecls
+        return pd.DataFrame(codes, index=marketcap.index, columns=marketcap.columns)
         
     
-    @staticmethod        
-    def _get_benchmarks(securities):
+    @staticmethod
+    def _preprocess(securities, winsorize=None, min_price=None, min_marketcap=None):
         """
-        Calculates the benchmarks that will be used to sort the securities.
+        Prepares the sorts in one vectorized pass over every stock and month:
+        I/A and ROE are winsorized on each month, and the stocks eligible on 
+        each month are flagged. A stock is eligible with a positive marketcap,
+        at least min_marketcap, and a price of at least min_price. Breakpoints,
+        classifications and portfolio returns use only the eligible stocks 
+        (besides holding a value to sort on, see _valid).
     
         Parameters
         ----------
         securities : Dict like
             A dict containing the information on stocks. 
+        winsorize : Dict like
+            Quantiles (lower, upper) 'I/A' and/or 'ROE' are winsorized at, None
+            to keep them.
+        min_price : float
+            Least price of the eligible stocks, or None.
+        min_marketcap : float
+            Least marketcap of the eligible stocks, or None.
             
         Return
         ----------
         n_securities : Dict
-            Updated dict containing the benchmarks.
+            Updated dict containing the winsorized I/A and ROE and eligible, 
+            a boolean DataFrame (stocks x months).
         """
         
-        iaratio = securities['I/A']
-        marketcap = securities['marketcap']
-        ROE = securities['ROE']
+        n_securities = securities.copy()
+        
+        for key, limits in (winsorize or {}).items():
+            if limits is not None:
+                panel = n_securities[key]
+                n_securities[key] = pd.DataFrame(_winsorize(panel.values, limits),
+                                                 index=panel.index, 
+                                                 columns=panel.columns)
         
-        iapercentiles = iaratio.describe(percentiles=[0.3, 0.7]).loc[['30%', '70%']]
-        ia30 = iapercentiles.loc['30%']
-        ia70 = iapercentiles.loc['70%']
+        marketcap = n_securities['marketcap']
+        values = np.asarray(marketcap.values, dtype=float)
+        eligible = np.isfinite(values) & (values > 0)
+        if min_marketcap is not None:
+            eligible &= values >= min_marketcap
+        if min_price is not None:
+            prices = n_securities['price'].reindex(index=marketcap.index, 
+                                                   columns=marketcap.columns)
+            eligible &= prices.values >= min_price
+        n_securities['eligible'] = pd.DataFrame(eligible, index=marketcap.index,
+                                                columns=marketcap.columns)
         
-        marketcapmedian = marketcap.describe().loc['50%']
+        return n_securities
+    
+    @staticmethod        
+    def _get_benchmarks(securities, breakpoints=None, universe=None, 
+                        rebalance=None, previous=None):
+        """
+        Calculates the benchmarks that will be used to sort the securities. Only 
+        the requested quantiles of the rebalancing months are calculated, all 
+        those months at once, and they are cached by a fingerprint of their 
+        inputs. The other months hold the benchmarks of the last rebalancing.
+    
+        Parameters
+        ----------
+        securities : Dict like
+            A dict containing the information on stocks. 
+        breakpoints : Dict like
+            Quantiles of 'size', 'IA' and/or 'ROE'. Defaults to 
+            HXLFactors.breakpoints.
+        universe : List or DataFrame like
+            Tickers used to calculate the breakpoints, or a boolean DataFrame
+            (stocks x months) flagging them. If None, every security is used.
+        rebalance : Dict like
+            Rebalancing schedule of 'size', 'IA' and/or 'ROE'. Defaults to 
+            HXLFactors.rebalance.
+        previous : Dict like
+            Breakpoints of 'size', 'IA' and/or 'ROE' in effect before the 
+            first month (see append_month).
+            
+        Return
+        ----------
+        n_securities : Dict
+            Updated dict containing the benchmarks. sizebreaks, IAbreaks and
+            ROEbreaks hold every breakpoint (quantiles x months); mkmedian,
+            IA30, IA70, ROE30 and ROE70 hold the lower and upper ones. Each 
+            month holds the breakpoints in effect, those of the last 
+            rebalancing (with the defaults, mkmedian, IA30 and IA70 hold the 
+            values of the last June, NaN before the first one), not those of
+            its own cross-section.
+        """
         
-        ROEpercentiles = ROE.describe(percentiles=[0.3, 0.7]).loc[['30%', '70%']]
-        ROE30 = ROEpercentiles.loc['30%']
-        ROE70 = ROEpercentiles.loc['70%']
+        # HXLSorts builds on this module, so it is imported when sorting
+        from HXLSorts import SORTS, sort_breakpoints
         
+        breakpoints = dict(HXLFactors.breakpoints, **(breakpoints or {}))
+        rebalance = dict(HXLFactors.rebalance, **(rebalance or {}))
+        previous = previous or {}
         n_securities = securities.copy()
-        n_securities['IA30'] = ia30
-        n_securities['IA70'] = ia70
-        n_securities['mkmedian'] = marketcapmedian
-        n_securities['ROE30'] = ROE30
-        n_securities['ROE70'] = ROE70
+        
+        for sort, config in SORTS.items():
+            config = dict(config, quantiles=breakpoints[sort], 
+                          rebalance=rebalance[sort])
+            n_securities[sort + 'breaks'] = sort_breakpoints(
+                    securities[config['on']], config, universe, 
+                    securities.get('eligible'), previous.get(sort))
+        
+        n_securities['IA30'] = n_securities['IAbreaks'].iloc[0]
+        n_securities['IA70'] = n_securities['IAbreaks'].iloc[-1]
+        n_securities['mkmedian'] = n_securities['sizebreaks'].iloc[0]
+        n_securities['ROE30'] = n_securities['ROEbreaks'].iloc[0]
+        n_securities['ROE70'] = n_securities['ROEbreaks'].iloc[-1]
         
         return n_securities
     
@@ -329,61 +2495,34 @@ class HXLFactors(object):
         return n_securities
     
     @staticmethod
-    def _padronize_columns(pattern, dividends, assets, ROE):
+    def _get_aligned(values, pattern, fill, index=None):
         """
-        Padronizes information that is not released monthly. In that way, we do not
-        encounter problems while manipulating data.
+        Aligns one piece of information that is not released monthly to the 
+        pattern in one reindex, following its fill policy. Information in long 
+        format (Series indexed by ticker and date) is only expanded here, to 
+        its release months first (see _pivot) and then to a dense panel 
+        (stocks x pattern): the sorts and returns of the pipeline use every 
+        month, so the long format saves memory until the alignment only.
         
         Parameters
         ----------
+        values : DataFrame or Series like
+            Dataframe containing the information, or a Series indexed by 
+            (ticker, date) holding it in long format.
         pattern : Array like
             Array containing the pattern for the columns
-        dividends : DataFrame like
-            Dataframe containing information on dividends
-        assets : DataFrame like
-            Dataframe containing information on assets
-        ROE : DataFrame like
-            Dataframe containing information on ROE
+        fill : Tuple
+            Fill policy (method, lag) of the information.
+        index : Array like
+            Tickers the information in long format is expanded to.
             
         Return
         ----------
-        ndividends : Dataframe like
-            Updated Dataframe containing information on dividends
-        nassets : Dataframe like
-            Updated Dataframe containing information on assets
-        nROE : Dataframe like
-            Updated Dataframe containing information on ROE
+        aligned : DataFrame
+            Dataframe containing the aligned information.
         """
         
-        ndividends = pd.DataFrame(index=dividends.index)
-        nassets = pd.DataFrame(index=assets.index)
-        nROE = pd.DataFrame(index=ROE.index)
+        if isinstance(values, pd.Series):
+            values = _pivot(values, index)
         
-        for date in pattern:
-            
-            if date in dividends.columns:
-                ndividends[date] = dividends[date]
-            else:
-                ndividends[date] = 0
-                
-            if date in assets.columns:
-                nassets[date] = assets[date]
-                nROE[date] = ROE[date]
-            else:
-                nassets[date] = 0
-                nROE[date] = 0
-            
-        return ndividends, nassets, nROE
-            
-                
-    
-"""
-TO DO:
-    IA cls is rebalancing every month. Need to change it so it rebalances only at the end of June.
-    Same thing is happening to Size cls.
-    
-    Write the description of get_profit and get_investment functions.
-    Write the description of the calculate_factors function.
-    Write the description of the Class.
-"""
-    
+        return _align(values, pattern, *fill)
@@ -0,0 +1,428 @@
+"""
+@author: Vitor Eller - @VFermat
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+
+from HXLFactors import _pivot
+
+# Sheet of the workbook holding each input of HXLFactors.calculate_factors,
+# by name (matched ignoring case and surrounding spaces)
+SHEETS = {
+        'dividends': 'dividendspershare',
+        'ROE': 'roe',
+        'assets': 'assets',
+        'marketcap': 'marketcap',
+        'prices': 'price'
+        }
+
+MANIFEST = 'manifest.json'
+
+
+def load_workbook(path, cache_dir=None, mmap=True, sheets=None, processes=None):
+    """
+    Loads the inputs of the factors from an Excel workbook. On the first load
+    the sheets are parsed (optionally on a pool of processes), validated 
+    and saved to a columnar cache (one .npy file per array plus a manifest).
+    Later loads read the cache, which is checked against the workbook's mtime
+    and hash, and only parse the workbook again if it changed.
+
+    Parameters
+    ----------
+    path : String
+        Path to the workbook.
+    cache_dir : String
+        Directory holding the cache. Defaults to the workbook path followed by
+        '.hxlcache'.
+    mmap : Boolean
+        If True, the cached values are memory-mapped (read only) instead of
+        being read into memory.
+    sheets : Dict like
+        Names of the sheets holding 'dividends', 'ROE', 'assets', 'marketcap'
+        and/or 'prices', overriding the defaults in SHEETS.
+    processes : int
+        Number of processes parsing the sheets. Defaults to one, parsing them
+        in this process. With more, the calling script must be guarded by
+        if __name__ == '__main__' where processes are spawned (Windows and 
+        macOS); if the pool cannot start, the sheets are parsed in this
+        process.
+
+    Return
+    ----------
+    panels : Dict
+        A dict containing one DataFrame (stocks x dates) for each input, keyed
+        as the arguments of HXLFactors.calculate_factors.
+    """
+
+    if cache_dir is None:
+        cache_dir = path + '.hxlcache'
+    sheets = dict(SHEETS, **(sheets or {}))
+
+    if not _is_fresh(path, cache_dir, sheets):
+        _build_cache(path, cache_dir, sheets, processes)
+
+    return {field: _load_panel(cache_dir, field, mmap) for field in SHEETS}
+
+
+def from_long(records):
+    """
+    Builds the inputs of the factors from information in long format. Prices 
+    and marketcap are pivoted to DataFrames (stocks x months). Dividends, 
+    assets and ROE are kept in long format, holding only their releases, and
+    are expanded by HXLFactors.calculate_factors when aligned.
+    
+    Parameters
+    ----------
+    records : DataFrame or Dict like
+        A DataFrame with columns ticker, date, field and value, where field is
+        one of the arguments of HXLFactors.calculate_factors. Or a dict with,
+        for each field, a Series (or a one column DataFrame) indexed by 
+        (ticker, date).
+        
+    Return
+    ----------
+    panels : Dict
+        A dict containing the inputs, keyed as the arguments of 
+        HXLFactors.calculate_factors.
+    """
+    
+    if isinstance(records, pd.DataFrame):
+        records = {field: group.set_index(['ticker', 'date'])['value']
+                   for field, group in records.groupby('field')}
+    
+    panels = {}
+    for field in SHEETS:
+        values = records[field]
+        if isinstance(values, pd.DataFrame):
+            values = values.iloc[:, 0]
+        panels[field] = values
+    
+    panels['prices'] = _pivot(panels['prices'])
+    panels['marketcap'] = _pivot(panels['marketcap'], panels['prices'].index)
+    panels['marketcap'] = panels['marketcap'].reindex(columns=panels['prices'].columns)
+    
+    return panels
+
+
+def iter_chunks(panels, months=120):
+    """
+    Splits the inputs of the factors in chunks of consecutive months, for 
+    HXLFactors.stream_factors. Each chunk holds the prices and marketcap of its
+    months and the dividends, assets and ROE released along them (the first
+    chunk also holds the releases before the first month). When the panels are
+    memory-mapped (see load_workbook), only the chunk being read is loaded.
+    
+    Parameters
+    ----------
+    panels : Dict like
+        A dict containing one DataFrame (stocks x dates) for each input, keyed
+        as the arguments of HXLFactors.calculate_factors.
+    months : int
+        Number of months of each chunk.
+        
+    Return
+    ----------
+    chunks : Generator
+        Dicts keyed as the arguments of HXLFactors.calculate_factors.
+    """
+    
+    dates = panels['prices'].columns + MonthEnd(0)
+    for start in range(0, len(dates), months):
+        window = dates[start:start + months]
+        chunk = {}
+        for field, panel in panels.items():
+            released = panel.columns + MonthEnd(0)
+            keep = released <= window[-1]
+            if start:
+                keep &= released >= window[0]
+            chunk[field] = panel.loc[:, keep].copy()
+        yield chunk
+
+
+def _is_fresh(path, cache_dir, sheets):
+    """
+    Checks if the cache is up to date with the workbook. The cheap mtime and
+    size check is tried first; if it fails, the workbook's hash decides, so
+    touching the workbook does not invalidate the cache.
+
+    Parameters
+    ----------
+    path : String
+        Path to the workbook.
+    cache_dir : String
+        Directory holding the cache.
+    sheets : Dict like
+        Name of the sheet holding each input.
+
+    Return
+    ----------
+    fresh : Boolean
+        True if the cache can be used.
+    """
+
+    manifest_path = os.path.join(cache_dir, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if manifest.get('sheets') != sheets:
+        return False
+
+    stat = os.stat(path)
+    if manifest['mtime'] == stat.st_mtime and manifest['size'] == stat.st_size:
+        return True
+
+    if manifest['hash'] != _hash_file(path):
+        return False
+
+    # Same content with a new mtime: records it so the next check is cheap
+    manifest['mtime'] = stat.st_mtime
+    manifest['size'] = stat.st_size
+    _write_manifest(cache_dir, manifest)
+
+    return True
+
+
+def _build_cache(path, cache_dir, sheets, processes=None):
+    """
+    Parses and validates every sheet of the workbook and saves it to the cache.
+
+    Parameters
+    ----------
+    path : String
+        Path to the workbook.
+    cache_dir : String
+        Directory holding the cache.
+    sheets : Dict like
+        Name of the sheet holding each input.
+    processes : int
+        Number of processes parsing the sheets.
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    stat = os.stat(path)
+    digest = _hash_file(path)
+
+    panels = _validate(_parse_sheets(path, sheets, processes))
+
+    # The old cache is not trusted while its files are replaced
+    try:
+        os.remove(os.path.join(cache_dir, MANIFEST))
+    except FileNotFoundError:
+        pass
+    for field, panel in panels.items():
+        values = panel.values
+        index = np.asarray(panel.index, dtype=str)
+        columns = panel.columns.values.astype('datetime64[ns]')
+
+        _save(_panel_path(cache_dir, field, 'values'), values)
+        _save(_panel_path(cache_dir, field, 'index'), index)
+        _save(_panel_path(cache_dir, field, 'columns'), columns)
+
+    # The manifest is written last, so an interrupted build is never trusted
+    _write_manifest(cache_dir, {
+            'sheets': sheets,
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'hash': digest
+            })
+
+
+def _parse_sheets(path, sheets, processes=None):
+    """
+    Parses the sheets holding the inputs. The workbook is opened once to find
+    them by name; the sheets are then parsed on a pool of processes (parsing
+    holds the GIL), or in this process if only one is asked for or the pool
+    breaks. The calamine engine is used if installed, as it is much faster 
+    than openpyxl.
+
+    Parameters
+    ----------
+    path : String
+        Path to the workbook.
+    sheets : Dict like
+        Name of the sheet holding each input.
+    processes : int
+        Number of processes. Defaults to one.
+
+    Return
+    ----------
+    panels : Dict
+        A dict containing the DataFrame parsed for each input.
+    """
+
+    engine = 'calamine' if importlib.util.find_spec('python_calamine') else None
+    processes = min(processes or 1, len(sheets))
+
+    with pd.ExcelFile(path, engine=engine) as workbook:
+        names = {name.strip().lower(): name for name in workbook.sheet_names}
+        missing = [sheet for sheet in sheets.values() 
+                   if sheet.strip().lower() not in names]
+        if missing:
+            raise ValueError('Sheets {} not found in {} (sheets: {}).'.format(
+                    missing, path, workbook.sheet_names))
+        found = {field: names[sheet.strip().lower()] for field, sheet in sheets.items()}
+
+        if processes < 2:
+            return {field: workbook.parse(name, index_col=0) 
+                    for field, name in found.items()}
+
+    try:
+        with ProcessPoolExecutor(processes) as pool:
+            parsed = pool.map(_parse_sheet, [path]*len(found), found.values(),
+                              [engine]*len(found))
+            return dict(zip(found, parsed))
+    except BrokenProcessPool:
+        # Workers that cannot start (e.g. spawned from an unguarded script)
+        return {field: _parse_sheet(path, name, engine) 
+                for field, name in found.items()}
+
+
+def _parse_sheet(path, name, engine):
+    """Parses one sheet of the workbook, in a worker process."""
+
+    return pd.read_excel(path, sheet_name=name, index_col=0, engine=engine)
+
+
+def _validate(panels):
+    """
+    Checks the axes and values of the parsed sheets, so that a misaligned
+    workbook is rejected before the factors are calculated. Tickers must be 
+    unique and not empty, dates must be valid, increasing and one per month,
+    and values numeric (errors such as '#N/A N/A' are read as NaN). Marketcap
+    must cover the tickers and months of prices, and dividends, assets and ROE
+    only tickers of prices.
+
+    Parameters
+    ----------
+    panels : Dict like
+        A dict containing the DataFrame parsed for each input.
+
+    Return
+    ----------
+    panels : Dict
+        A dict containing, for each input, a float DataFrame (stocks x dates)
+        with string tickers and a DatetimeIndex.
+    """
+
+    validated = {}
+    for field, panel in panels.items():
+        error = lambda message: ValueError('Sheet of {}: {}.'.format(field, message))
+
+        index = panel.index
+        if index.isna().any() or (index.astype(str).str.strip() == '').any():
+            raise error('empty tickers')
+        index = index.astype(str).str.strip()
+        if index.duplicated().any():
+            raise error('repeated tickers {}'.format(list(index[index.duplicated()][:5])))
+
+        try:
+            columns = pd.DatetimeIndex(pd.to_datetime(panel.columns))
+        except (TypeError, ValueError) as e:
+            raise error('invalid dates ({})'.format(e))
+        if not columns.is_monotonic_increasing:
+            raise error('dates are not increasing')
+        months = columns + MonthEnd(0)
+        if months.duplicated().any():
+            raise error('more than one date on {}'.format(
+                    list(months[months.duplicated()].strftime('%Y-%m')[:5])))
+
+        values = panel.apply(pd.to_numeric, errors='coerce')
+        wrong = values.isna() & panel.notna()
+        if wrong.values.any():
+            row, column = np.argwhere(wrong.values)[0]
+            raise error('value {!r} of {} on {} is not a number'.format(
+                    panel.iat[row, column], index[row], columns[column].date()))
+
+        validated[field] = pd.DataFrame(values.values.astype(float), index=index,
+                                        columns=columns)
+
+    prices = validated['prices']
+    marketcap = validated['marketcap']
+    if not marketcap.index.sort_values().equals(prices.index.sort_values()):
+        raise ValueError('Sheets of marketcap and prices hold different tickers.')
+    if not (marketcap.columns + MonthEnd(0)).equals(prices.columns + MonthEnd(0)):
+        raise ValueError('Sheets of marketcap and prices hold different months.')
+    for field in ['dividends', 'assets', 'ROE']:
+        unknown = validated[field].index.difference(prices.index)
+        if len(unknown):
+            raise ValueError('Sheet of {} holds tickers not in prices: {}.'.format(
+                    field, list(unknown[:5])))
+
+    return validated
+
+
+def _load_panel(cache_dir, field, mmap):
+    """
+    Loads one input from the cache.
+
+    Parameters
+    ----------
+    cache_dir : String
+        Directory holding the cache.
+    field : String
+        Name of the input.
+    mmap : Boolean
+        If True, the values are memory-mapped.
+
+    Return
+    ----------
+    panel : DataFrame
+        A DataFrame (stocks x dates) containing the input.
+    """
+
+    values = np.load(_panel_path(cache_dir, field, 'values'),
+                     mmap_mode='r' if mmap else None)
+    index = np.load(_panel_path(cache_dir, field, 'index'))
+    columns = np.load(_panel_path(cache_dir, field, 'columns'))
+
+    return pd.DataFrame(values, index=pd.Index(index.astype(object)),
+                        columns=pd.DatetimeIndex(columns), copy=False)
+
+
+def _panel_path(cache_dir, field, part):
+    """Path of the .npy file holding one part of a cached input."""
+
+    return os.path.join(cache_dir, '{}.{}.npy'.format(field, part))
+
+
+def _save(path, values):
+    """
+    Atomically replaces a .npy file of the cache. Panels loaded from the old 
+    file, memory-mapped, keep reading it.
+    """
+
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, values)
+    os.replace(path + '.tmp', path)
+
+
+def _write_manifest(cache_dir, manifest):
+    """Atomically replaces the manifest of the cache."""
+
+    manifest_path = os.path.join(cache_dir, MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def _hash_file(path):
+    """SHA-256 of a file, read in blocks."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
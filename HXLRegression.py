@@ -0,0 +1,167 @@
+"""
+@author: Vitor Eller - @VFermat
+"""
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+
+FACTORS = ['HXLInvestment', 'HXLProfit']
+
+
+def factor_regression(hxl, window=36, min_periods=None, returns=None, **parameters):
+    """
+    Regresses the returns of the stocks (or of any assets) on the HXL
+    factors over rolling windows (see rolling_regression). The factors are
+    labeled by the month their portfolios are formed, so they are moved one
+    month forward, to the month their returns are realized.
+
+    Parameters
+    ----------
+    hxl : HXLFactors
+        An HXLFactors object whose factors were calculated.
+    window : int
+        Number of months of each window.
+    min_periods : int
+        Least number of months with returns needed in a window. Defaults to
+        window.
+    returns : DataFrame like
+        DataFrame (assets x months) containing the returns regressed. Defaults
+        to the returns of the stocks, securities['return'].
+    parameters : Dict like
+        Keyword arguments to rolling_regression.
+
+    Return
+    ----------
+    regression : Dict
+        As returned by rolling_regression.
+    """
+
+    if returns is None:
+        returns = hxl.securities['return']
+    factors = pd.DataFrame({factor: getattr(hxl, factor).astype(float)
+                            for factor in FACTORS})
+    factors.index = factors.index + MonthEnd(1)
+
+    return rolling_regression(returns, factors, window, min_periods, **parameters)
+
+
+def rolling_regression(returns, factors, window=36, min_periods=None, chunk=512,
+                       dtype=np.float32):
+    """
+    Calculates rolling OLS regressions of the returns of every asset on the
+    factors (plus an intercept). Instead of fitting each window, the sums of
+    X'X, X'y and y'y over the windows are taken from cumulative sums along
+    the months, and all the windows of a chunk of assets are solved in one
+    batched operation. Months in which an asset or any factor has no return
+    are left out of the asset's windows.
+
+    Parameters
+    ----------
+    returns : DataFrame like
+        DataFrame (assets x months) containing the returns of the assets.
+    factors : DataFrame like
+        DataFrame (months x factors) containing the returns of the factors,
+        labeled by the month they are realized.
+    window : int
+        Number of months of each window.
+    min_periods : int
+        Least number of months with returns needed in a window. Defaults to
+        window.
+    chunk : int
+        Number of assets processed at once, bounding the memory used.
+    dtype : dtype
+        Type of the arrays returned.
+
+    Return
+    ----------
+    regression : Dict
+        A dict containing 'alpha', 'residual_vol' (standard deviation of the
+        residuals) and 'observations', arrays (assets x months) holding the
+        regression of the window ending on each month, 'betas', an array
+        (assets x months x factors), and the 'index', 'columns' and 'factors'
+        labeling them. Windows with too few observations, or whose factors
+        are collinear, are NaN.
+    """
+
+    min_periods = window if min_periods is None else min_periods
+    columns = returns.columns
+    X = factors.reindex(columns).values.astype(float)
+    Y = np.asarray(returns.values, dtype=float)
+    assets, months = Y.shape
+    p = X.shape[1] + 1
+
+    # Regressors with an intercept, zeroed on months without factors
+    X = np.hstack([np.ones((months, 1)), X])
+    available = ~np.isnan(X).any(axis=1)
+    X[~available] = 0
+    XX = X[:, :, np.newaxis]*X[:, np.newaxis, :]
+
+    regression = {
+            'alpha': np.full((assets, months), np.nan, dtype=dtype),
+            'betas': np.full((assets, months, p - 1), np.nan, dtype=dtype),
+            'residual_vol': np.full((assets, months), np.nan, dtype=dtype),
+            'observations': np.zeros((assets, months), dtype=np.int32)
+            }
+
+    for start in range(0, assets, chunk):
+        y = Y[start:start + chunk]
+        used = ~np.isnan(y) & available
+        y = np.where(used, y, 0)
+
+        n = _window_sum(used.astype(float), window)
+        sxx = _window_sum(used[:, :, np.newaxis, np.newaxis]*XX, window)
+        sxy = _window_sum(y[:, :, np.newaxis]*X, window)
+        syy = _window_sum(y**2, window)
+
+        # Singular windows (too few months or collinear factors) are solved
+        # against the identity and discarded
+        diagonal = np.prod(np.diagonal(sxx, axis1=2, axis2=3), axis=2)
+        with np.errstate(invalid='ignore'):
+            valid = ((n >= max(min_periods, p + 1))
+                     & (np.abs(np.linalg.det(sxx)) > 1e-12*diagonal))
+        sxx[~valid] = np.eye(p)
+        coefficients = np.linalg.solve(sxx, sxy[..., np.newaxis])[..., 0]
+
+        residual = np.maximum(syy - np.sum(coefficients*sxy, axis=2), 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            volatility = np.sqrt(residual/(n - p))
+        coefficients[~valid] = np.nan
+        volatility[~valid] = np.nan
+
+        rows = slice(start, start + len(y))
+        regression['alpha'][rows] = coefficients[:, :, 0]
+        regression['betas'][rows] = coefficients[:, :, 1:]
+        regression['residual_vol'][rows] = volatility
+        regression['observations'][rows] = n
+
+    regression.update({'index': returns.index, 'columns': columns,
+                       'factors': list(factors.columns)})
+
+    return regression
+
+
+def _window_sum(values, window):
+    """
+    Sums an array over rolling windows along its second axis (months), from
+    its cumulative sum.
+
+    Parameters
+    ----------
+    values : ndarray
+        Array (assets x months x ...) to be summed.
+    window : int
+        Number of months of each window.
+
+    Return
+    ----------
+    sums : ndarray
+        Array of the same shape, holding the sum of the window ending on each
+        month.
+    """
+
+    cumulative = np.cumsum(values, axis=1)
+    sums = cumulative.copy()
+    sums[:, window:] -= cumulative[:, :-window]
+
+    return sums
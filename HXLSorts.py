@@ -0,0 +1,278 @@
+"""
+@author: Vitor Eller - @VFermat
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from HXLFactors import (HXLFactors, _breakpoint_mask, _combine, _rebalance_months,
+                        _scheduled_breakpoints, _sort, _universe_mask, 
+                        _value_weight)
+
+# Sorts of the HXL factors: the characteristic sorted on, its quantiles, the
+# rebalancing schedule and bucket labels
+SORTS = {
+        'size': {'on': 'marketcap', 'quantiles': HXLFactors.breakpoints['size'],
+                 'rebalance': HXLFactors.rebalance['size'], 
+                 'labels': HXLFactors.size_labels},
+        'IA': {'on': 'I/A', 'quantiles': HXLFactors.breakpoints['IA'],
+               'rebalance': HXLFactors.rebalance['IA'], 
+               'labels': HXLFactors.ia_labels},
+        'ROE': {'on': 'ROE', 'quantiles': HXLFactors.breakpoints['ROE'],
+                'rebalance': HXLFactors.rebalance['ROE'], 
+                'labels': HXLFactors.ROE_labels}
+        }
+
+# HXL factors: the sorts crossed into portfolios and the sort whose high
+# bucket is bought and low bucket is sold, averaging over the other sorts
+FACTORS = {
+        'HXLInvestment': {'sorts': ['size', 'IA', 'ROE'], 'spread': 'IA'},
+        'HXLProfit': {'sorts': ['size', 'IA', 'ROE'], 'spread': 'ROE'}
+        }
+
+
+def sort_portfolios(characteristics, returns, weights, sorts=None, factors=None,
+                    universe=None, nan_returns='zero', threads=None, eligible=None):
+    """
+    Builds factors from portfolios sorted on any number of characteristics.
+    Each sort is calculated once, however many portfolios use it; factors
+    crossing the same sorts share their portfolios; and the returns of every
+    portfolio are aggregated in a single pass. With the default sorts and
+    factors, the HXL factors are built; HXLFactors sorts with the same steps
+    (sort_breakpoints, sort_buckets and sort_cells).
+
+    Parameters
+    ----------
+    characteristics : Dict like
+        A dict containing the DataFrames (stocks x months) sorted on, keyed as
+        the 'on' entries of sorts. HXLFactors.securities holds the ones of the
+        HXL sorts; further characteristics can be chained to it with
+        collections.ChainMap, without copying it.
+    returns : DataFrame like
+        DataFrame (stocks x months) containing the returns of the month
+        following each month (as securities['lreturn']).
+    weights : DataFrame like
+        DataFrame (stocks x months) containing the weights (e.g. marketcap).
+        Portfolios are built on its stocks and months.
+    sorts : Dict like
+        Sorts by name, each a dict with 'on' (key of the characteristic),
+        'quantiles' (breakpoints), 'rebalance' (schedule of the months 
+        securities are sorted on, holding their bucket until the next one: 
+        'monthly' or None, 'quarterly', 'annual', a month number or a list of
+        dates) and optionally 'labels' (one per bucket). Defaults to SORTS.
+    factors : Dict like
+        Factors by name, each a dict with 'sorts' (names of the sorts crossed)
+        and 'spread' (name of the sort whose buckets are spread), and
+        optionally 'high' and 'low' (buckets bought and sold, by default the
+        last and the first). Defaults to FACTORS.
+    universe : List or DataFrame like
+        Tickers used to calculate the breakpoints, or a boolean DataFrame
+        (stocks x months) flagging them. If None, every security is used.
+    nan_returns : String
+        Treatment of NaN returns ('zero', 'drop' or 'propagate').
+    threads : int
+        Number of threads aggregating the portfolios.
+    eligible : DataFrame like
+        Boolean DataFrame (stocks x months) flagging the stocks eligible on
+        each month (e.g. securities['eligible'], as HXLFactors uses it). The 
+        others are left out of the breakpoints and of every portfolio. If None,
+        every stock is eligible.
+
+    Return
+    ----------
+    results : Dict
+        A dict containing 'codes' and 'preturn', dicts keyed by the tuple of
+        sorts crossed holding the cell codes (stocks x months) and the cell
+        returns (cells x months), and 'factors', a DataFrame (months x
+        factors).
+    """
+
+    sorts = SORTS if sorts is None else sorts
+    factors = FACTORS if factors is None else factors
+    index, columns = weights.index, weights.columns
+
+    # Portfolios of each combination of sorts, and the sorts they need
+    portfolios = list(OrderedDict.fromkeys(tuple(factor['sorts'])
+                                           for factor in factors.values()))
+    needed = list(OrderedDict.fromkeys(name for portfolio in portfolios
+                                       for name in portfolio))
+    buckets = {}
+    for name in needed:
+        panel = characteristics[sorts[name]['on']]
+        breakpoints = sort_breakpoints(panel, sorts[name], universe, eligible)
+        codes = sort_buckets(panel, breakpoints, sorts[name], eligible)
+        buckets[name] = pd.DataFrame(codes, index=panel.index, 
+                                     columns=panel.columns).reindex(
+                index=index, columns=columns, fill_value=-1).values
+    eligible = _universe_mask(eligible, weights)
+
+    # Cell codes of every portfolio, offset so all cells are aggregated at once
+    codes, stacked, labels, offset = {}, [], {}, 0
+    for portfolio in portfolios:
+        sizes = [len(sorts[name]['quantiles']) + 1 for name in portfolio]
+        cells = sort_cells([buckets[name] for name in portfolio], sizes, eligible)
+        codes[portfolio] = pd.DataFrame(cells, index=index, columns=columns)
+        labels[portfolio] = _cell_labels([_bucket_labels(name, sorts[name])
+                                          for name in portfolio])
+        stacked.append(np.where(cells >= 0, cells.astype(np.intp) + offset, -1))
+        offset += len(labels[portfolio])
+
+    # Portfolios x stocks x months, sharing the returns and weights
+    stacked = (np.stack(stacked) if stacked 
+               else np.empty((0, len(index), len(columns)), np.intp))
+    returns = returns.reindex(index=index, columns=columns).values
+    preturns = _value_weight(stacked, returns, weights.values, offset, nan_returns,
+                             threads)
+    preturn, start = {}, 0
+    for portfolio in portfolios:
+        stop = start + len(labels[portfolio])
+        preturn[portfolio] = pd.DataFrame(preturns[start:stop],
+                                          index=labels[portfolio], columns=columns)
+        start = stop
+
+    # Factors, spreading the high and low cells of the portfolios
+    series = {}
+    for name, factor in factors.items():
+        portfolio = tuple(factor['sorts'])
+        sizes = [len(sorts[sort]['quantiles']) + 1 for sort in portfolio]
+        dimension = portfolio.index(factor['spread'])
+        bucket = np.unravel_index(np.arange(len(labels[portfolio])), sizes)[dimension]
+        high = factor.get('high', -1) % sizes[dimension]
+        low = factor.get('low', 0) % sizes[dimension]
+        cells = np.asarray(labels[portfolio], dtype=object)
+        series[name] = HXLFactors._get_spread(preturn[portfolio],
+                                              list(cells[bucket == high]),
+                                              list(cells[bucket == low]))
+
+    return {
+            'codes': codes,
+            'preturn': preturn,
+            'factors': pd.DataFrame(series, index=columns, columns=list(factors))
+            }
+
+
+def sort_breakpoints(panel, sort, universe=None, eligible=None, previous=None):
+    """
+    Calculates the breakpoints of a sort on its rebalancing months only, and 
+    holds them until the next, so every month has the breakpoints in effect.
+
+    Parameters
+    ----------
+    panel : DataFrame like
+        DataFrame (stocks x months) containing the characteristic.
+    sort : Dict like
+        The sort, as in sort_portfolios.
+    universe : List or DataFrame like
+        Tickers used to calculate the breakpoints, or a boolean DataFrame
+        flagging them. If None, every security is used.
+    eligible : DataFrame like
+        Boolean DataFrame flagging the eligible stocks, the only ones used. If
+        None, every stock is eligible.
+    previous : Array like
+        Breakpoints in effect before the first rebalancing month (e.g. when
+        appending a month). If None, those months get NaN.
+
+    Return
+    ----------
+    breakpoints : DataFrame
+        DataFrame (quantiles x months) containing the breakpoints in effect.
+    """
+
+    values = _scheduled_breakpoints(np.asarray(panel.values, dtype=float), 
+                                    sort['quantiles'],
+                                    _breakpoint_mask(universe, eligible, panel),
+                                    _rebalance_months(panel.columns, 
+                                                      sort.get('rebalance')),
+                                    previous)
+
+    return pd.DataFrame(values, index=sort['quantiles'], columns=panel.columns)
+
+
+def sort_buckets(panel, breakpoints, sort, eligible=None):
+    """
+    Sorts the securities on one characteristic: on the rebalancing months of
+    the sort, with the breakpoints in effect on them, holding their bucket 
+    until the next.
+
+    Parameters
+    ----------
+    panel : DataFrame like
+        DataFrame (stocks x months) containing the characteristic.
+    breakpoints : DataFrame like
+        DataFrame (quantiles x months) containing the breakpoints in effect 
+        (see sort_breakpoints).
+    sort : Dict like
+        The sort, as in sort_portfolios.
+    eligible : DataFrame like
+        Boolean DataFrame flagging the eligible stocks. If None, every stock is
+        eligible.
+
+    Return
+    ----------
+    codes : ndarray
+        2-D int8 array (stocks x months) containing the buckets.
+    """
+
+    values = np.asarray(panel.values, dtype=float)
+    breakpoints = np.asarray(breakpoints, dtype=float)
+    rebalance = _rebalance_months(panel.columns, sort.get('rebalance'))
+    mask = _universe_mask(eligible, panel)
+    if rebalance.all():
+        return _sort(values, breakpoints, mask=mask)
+
+    return _sort(values, breakpoints[:, rebalance], rebalance, mask)
+
+
+def sort_cells(buckets, sizes, eligible=None):
+    """
+    Crosses the buckets of several sorts into the code of the cell each 
+    security belongs to (see HXLFactors' _combine). Securities not eligible on
+    a month are in no cell (-1).
+
+    Parameters
+    ----------
+    buckets : List like
+        2-D arrays (stocks x months) containing the buckets of each sort.
+    sizes : List like
+        Number of buckets of each sort.
+    eligible : ndarray
+        Boolean array, broadcastable to the buckets, flagging the eligible 
+        stocks. If None, every stock is eligible.
+
+    Return
+    ----------
+    cells : ndarray
+        2-D array (stocks x months) containing the cell codes.
+    """
+
+    cells = _combine(buckets, sizes)
+    if eligible is not None:
+        cells = np.where(eligible, cells, -1).astype(cells.dtype)
+
+    return cells
+
+
+def _bucket_labels(name, sort):
+    """Labels of the buckets of a sort, by default its name and position."""
+
+    labels = sort.get('labels')
+    if labels is None:
+        labels = ['{}{}'.format(name, bucket + 1)
+                  for bucket in range(len(sort['quantiles']) + 1)]
+
+    return list(labels)
+
+
+def _cell_labels(labels):
+    """
+    Labels of the cells crossing several sorts, joining the labels of their
+    buckets in the order of the cell codes (see HXLFactors' _combine).
+    """
+
+    cells = ['']
+    for sort in labels:
+        cells = [cell + label for cell in cells for label in sort]
+
+    return cells
@@ -0,0 +1,303 @@
+"""
+@author: Vitor Eller - @VFermat
+"""
+
+import asyncio
+import importlib.util
+import os
+import sqlite3
+
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+
+from HXLFactors import _pivot
+
+# Inputs of HXLFactors.calculate_factors
+FIELDS = ['prices', 'dividends', 'assets', 'ROE', 'marketcap']
+
+
+class Source(object):
+    """
+    Adapter fetching one input of the factors from a data source. Subclasses
+    implement read, which blocks; fetch runs it on a thread, so the inputs
+    are fetched concurrently (see load_sources and calculate_from_sources).
+
+    The information is read either wide (a DataFrame, stocks x dates) or long
+    (a DataFrame with columns ticker, date and value, kept as a Series indexed
+    by (ticker, date), as in HXLLoader.from_long).
+    """
+
+    def __init__(self, long=False):
+        """
+        Parameters
+        ----------
+        long : Boolean
+            If True, the information read is in long format.
+        """
+
+        self.long = long
+
+    def read(self):
+        """
+        Reads the information, blocking.
+
+        Return
+        ----------
+        values : DataFrame like
+            The information as stored by the source.
+        """
+
+        raise NotImplementedError
+
+    async def fetch(self):
+        """
+        Reads the information on a thread.
+
+        Return
+        ----------
+        values : DataFrame or Series like
+            A DataFrame (stocks x dates), or a Series indexed by (ticker, date)
+            if the information is long.
+        """
+
+        return self._frame(await asyncio.to_thread(self.read))
+
+    def _frame(self, values):
+        """Shapes the information read as an input of the factors."""
+
+        if self.long:
+            values = values.assign(date=pd.to_datetime(values['date']))
+            return values.set_index(['ticker', 'date'])['value'].astype(float)
+
+        values = values.copy(deep=False)
+        values.columns = pd.to_datetime(values.columns)
+
+        return values.astype(float)
+
+
+class FileSource(Source):
+    """
+    Reads one input from a file: CSV (first column holding the tickers, if
+    wide), pickle or an Excel sheet, by its extension.
+    """
+
+    def __init__(self, path, long=False, **options):
+        """
+        Parameters
+        ----------
+        path : String
+            Path to the file.
+        long : Boolean
+            If True, the information read is in long format.
+        options : Dict like
+            Keyword arguments to the pandas reader (e.g. sheet_name).
+        """
+
+        super().__init__(long)
+        self.path = path
+        self.options = options
+
+    def read(self):
+
+        extension = os.path.splitext(self.path)[1].lower()
+        if extension in ('.pkl', '.pickle'):
+            return pd.read_pickle(self.path, **self.options)
+
+        options = dict({} if self.long else {'index_col': 0}, **self.options)
+        if extension in ('.xlsx', '.xlsm', '.xls'):
+            return pd.read_excel(self.path, **options)
+
+        return pd.read_csv(self.path, **options)
+
+
+class SQLiteSource(Source):
+    """
+    Reads one input from a SQLite database, by a query returning its
+    information in long format (columns ticker, date and value). Each fetch
+    opens its own connection.
+    """
+
+    def __init__(self, database, query, parameters=()):
+        """
+        Parameters
+        ----------
+        database : String
+            Path to the database.
+        query : String
+            Query returning the columns ticker, date and value.
+        parameters : Tuple like
+            Parameters of the query.
+        """
+
+        super().__init__(long=True)
+        self.database = database
+        self.query = query
+        self.parameters = parameters
+
+    def read(self):
+
+        connection = sqlite3.connect(self.database)
+        try:
+            return pd.read_sql_query(self.query, connection, params=self.parameters)
+        finally:
+            connection.close()
+
+
+class ParquetSource(Source):
+    """
+    Reads one input from a Parquet file. Needs pyarrow or fastparquet.
+    """
+
+    def __init__(self, path, long=False, **options):
+        """
+        Parameters
+        ----------
+        path : String
+            Path to the file. If wide, the tickers are its index and the dates
+            its column names.
+        long : Boolean
+            If True, the information read is in long format.
+        options : Dict like
+            Keyword arguments to pandas.read_parquet (e.g. columns).
+        """
+
+        if not any(importlib.util.find_spec(engine) is not None
+                   for engine in ('pyarrow', 'fastparquet')):
+            raise ImportError('ParquetSource needs pyarrow or fastparquet.')
+
+        super().__init__(long)
+        self.path = path
+        self.options = options
+
+    def read(self):
+
+        return pd.read_parquet(self.path, **self.options)
+
+
+def load_sources(sources):
+    """
+    Fetches the inputs of the factors concurrently, so loading takes about as
+    long as the slowest source. Must not be called from a running event
+    loop; await fetch_sources there.
+
+    Parameters
+    ----------
+    sources : Dict like
+        A dict containing a Source for each input, keyed as the arguments of
+        HXLFactors.calculate_factors.
+
+    Return
+    ----------
+    panels : Dict
+        A dict containing the inputs, keyed as the arguments of
+        HXLFactors.calculate_factors.
+    """
+
+    return asyncio.run(fetch_sources(sources))
+
+
+async def fetch_sources(sources):
+    """
+    Coroutine fetching the inputs of the factors concurrently (see
+    load_sources).
+    """
+
+    tasks = _start(sources)
+    values = await asyncio.gather(*[tasks[field] for field in FIELDS])
+
+    return dict(zip(FIELDS, values))
+
+
+def calculate_from_sources(hxl, sources):
+    """
+    Fetches the inputs of the factors concurrently and calculates the factors
+    as they arrive (see calculate_factors_async). Must not be called from a
+    running event loop; await calculate_factors_async there.
+
+    Parameters
+    ----------
+    hxl : HXLFactors
+        The HXLFactors object calculating the factors.
+    sources : Dict like
+        A dict containing a Source for each input, keyed as the arguments of
+        HXLFactors.calculate_factors.
+
+    Return
+    ----------
+    hxl : HXLFactors
+        The object, holding the factors as after calculate_factors.
+    """
+
+    return asyncio.run(calculate_factors_async(hxl, sources))
+
+
+async def calculate_factors_async(hxl, sources):
+    """
+    Coroutine fetching the inputs of the factors concurrently and calculating
+    them, as HXLFactors.calculate_factors does, overlapping loading with
+    computing: the returns are calculated as soon as prices and dividends
+    arrive, while marketcap, assets and ROE are still loading. With a cache,
+    results found in it are restored once every input arrived.
+    """
+
+    tasks = _start(sources)
+    prices, dividends = await asyncio.gather(tasks['prices'], tasks['dividends'])
+    profiled = lambda stage, method, *args: asyncio.to_thread(hxl._profiled, stage,
+                                                              method, *args)
+    prepared = await profiled('_prepare_prices', hxl._prepare_prices, prices,
+                              dividends)
+    report = hxl.profile_report
+
+    assets, ROE, marketcap = await asyncio.gather(tasks['assets'], tasks['ROE'],
+                                                  tasks['marketcap'])
+    key = None
+    if hxl.cache is not None:
+        key = hxl._cache_key(prices, dividends, assets, ROE, marketcap)
+        entry = hxl.cache.get(key)
+        if entry is not None:
+            hxl._restore(entry)
+            return hxl
+
+    calculate = lambda: hxl._calculate_factors(prices, dividends, assets, ROE,
+                                               marketcap, prepared=prepared)
+    await profiled('calculate_factors', calculate)
+    if hxl.profile:
+        hxl.profile_report = pd.concat([report, hxl.profile_report],
+                                       ignore_index=True)
+    if key is not None:
+        hxl.cache.put(key, hxl._get_entry())
+
+    return hxl
+
+
+def _start(sources):
+    """
+    Starts fetching every input, returning the tasks by input. Prices and
+    marketcap read in long format are pivoted, marketcap to the tickers and
+    months of prices.
+    """
+
+    missing = [field for field in FIELDS if field not in sources]
+    if missing:
+        raise ValueError('No source for {}.'.format(missing))
+
+    tasks = {field: asyncio.ensure_future(sources[field].fetch())
+             for field in FIELDS}
+
+    async def prices():
+        values = await tasks['prices']
+        return _pivot(values) if isinstance(values, pd.Series) else values
+
+    async def marketcap():
+        values = await tasks['marketcap']
+        if isinstance(values, pd.Series):
+            reference = await wide['prices']
+            values = _pivot(values, reference.index).reindex(
+                    columns=reference.columns + MonthEnd(0))
+        return values
+
+    wide = dict(tasks)
+    wide['prices'] = asyncio.ensure_future(prices())
+    wide['marketcap'] = asyncio.ensure_future(marketcap())
+
+    return wide
@@ -0,0 +1,294 @@
+"""
+@author: Vitor Eller - @VFermat
+"""
+
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: the single writer is not enforced there
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+
+from HXLFactors import HXLFactors
+
+MANIFEST = 'manifest.json'
+LOCK = 'writer.lock'
+DATES = 'dates.bin'
+COLUMN = 'column{}.bin'
+
+FACTORS = ['HXLInvestment', 'HXLProfit']
+
+
+class FactorStore(object):
+    """
+    Persistent, append-only store of monthly results: the factors, the
+    returns of the size/I/A/ROE portfolios and the breakpoints. Each column
+    is a file of raw float64 values, appended month by month, next to a file
+    of dates. A manifest holds the columns and the number of months
+    committed; it is replaced only after the values are on disk, so readers
+    never see a partial append. Readers memory-map the months they query,
+    without loading the history. One writer at a time can append, while any
+    number of readers (in any process) read.
+    """
+
+    def __init__(self, directory, mode='r'):
+        """
+        Parameters
+        ----------
+        directory : String
+            Directory holding the store.
+        mode : String
+            'r' to read or 'a' to append (creating the store if needed). A
+            writer holds a lock on the store until closed.
+        """
+
+        if mode not in ('r', 'a'):
+            raise ValueError('Unknown mode: {}.'.format(mode))
+
+        self.directory = directory
+        self.mode = mode
+        self._lock = None
+
+        if mode == 'a':
+            os.makedirs(directory, exist_ok=True)
+            self._lock = open(os.path.join(directory, LOCK), 'w')
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    self._lock.close()
+                    raise RuntimeError('The store {} has another writer.'.format(directory))
+            self.refresh()
+            self._truncate()
+        else:
+            self.refresh()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+    def close(self):
+        """
+        Releases the writer's lock.
+        """
+
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    def refresh(self):
+        """
+        Reads the manifest again, so a reader sees the months appended since
+        it was opened.
+        """
+
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                manifest = json.load(f)
+        except OSError:
+            if self.mode == 'r':
+                raise
+            manifest = {'columns': [], 'rows': 0}
+
+        self.columns = manifest['columns']
+        self.rows = manifest['rows']
+        self.dates = pd.DatetimeIndex(self._map(DATES, 'datetime64[ns]'))
+
+    def read(self, columns=None, start=None, end=None):
+        """
+        Reads a range of months, memory-mapping only that range.
+
+        Parameters
+        ----------
+        columns : List like or String
+            Columns to read (e.g. 'HXLProfit', 'preturn/BHIAHR' or
+            'breakpoints/ROE/0.7'). Defaults to every column; a string gives
+            a Series.
+        start : Timestamp like
+            First month read. Defaults to the first month stored.
+        end : Timestamp like
+            Last month read. Defaults to the last month committed.
+
+        Return
+        ----------
+        values : DataFrame or Series
+            The values (months x columns), backed by the files.
+        """
+
+        names = self.columns if columns is None else columns
+        single = isinstance(names, str)
+        names = [names] if single else list(names)
+        unknown = [name for name in names if name not in self.columns]
+        if unknown:
+            raise KeyError(unknown)
+
+        first = 0 if start is None else self.dates.searchsorted(
+                pd.Timestamp(start) + MonthEnd(0), side='left')
+        last = self.rows if end is None else self.dates.searchsorted(
+                pd.Timestamp(end) + MonthEnd(0), side='right')
+        last = max(first, last)
+        dates = self.dates[first:last]
+
+        values = {name: self._map(self._file(name), np.float64, first, last)
+                  for name in names}
+        if single:
+            return pd.Series(values[names[0]], index=dates, name=names[0], copy=False)
+
+        return pd.DataFrame(values, index=dates, columns=names, copy=False)
+
+    def append(self, values):
+        """
+        Appends months to the store. The first append sets the columns;
+        columns missing from later appends are stored as NaN.
+
+        Parameters
+        ----------
+        values : DataFrame like
+            DataFrame (months x columns) containing the new months, which
+            must come after the last month stored.
+        """
+
+        if self.mode != 'a':
+            raise ValueError('The store was not opened to append.')
+        if not len(values):
+            return
+
+        dates = pd.DatetimeIndex(values.index) + MonthEnd(0)
+        if not dates.is_monotonic_increasing or dates.has_duplicates:
+            raise ValueError('Months to append must be increasing.')
+        if self.rows and dates[0] <= self.dates[-1]:
+            raise ValueError('Month {} is not after the last month stored ({}).'.format(
+                    dates[0].date(), self.dates[-1].date()))
+
+        columns = self.columns or [str(column) for column in values.columns]
+        unknown = [column for column in values.columns if column not in columns]
+        if unknown:
+            raise ValueError('Columns not in the store: {}.'.format(unknown))
+        values = values.reindex(columns=columns)
+
+        # Values first, then the manifest that commits them, after dropping
+        # what a failed append left behind
+        self._truncate()
+        self._write(DATES, dates.values.astype('datetime64[ns]'))
+        for i, column in enumerate(columns):
+            self._write(COLUMN.format(i), values[column].values.astype(np.float64))
+
+        manifest = {'columns': columns, 'rows': self.rows + len(dates)}
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        self.refresh()
+
+    def append_factors(self, hxl, finished=True):
+        """
+        Appends the results of an HXLFactors object for the months after the
+        last month stored: the factors, the portfolio returns (as
+        'preturn/<portfolio>') and the breakpoints (as
+        'breakpoints/<sort>/<quantile>').
+
+        Parameters
+        ----------
+        hxl : HXLFactors
+            An HXLFactors object whose factors were calculated.
+        finished : Boolean
+            If True, the last month is left out: its portfolio returns depend
+            on the returns of the next month, which are not known yet (see
+            HXLFactors.append_month).
+        """
+
+        values = results_frame(hxl)
+        if finished:
+            values = values.iloc[:-1]
+        if self.rows:
+            values = values.loc[values.index > self.dates[-1]]
+
+        self.append(values)
+
+    def _map(self, name, dtype, first=0, last=None):
+        """
+        Memory-maps the committed rows [first, last) of a file.
+        """
+
+        last = self.rows if last is None else last
+        if last <= first:
+            return np.empty(0, dtype=dtype)
+
+        return np.memmap(os.path.join(self.directory, name), dtype=dtype, mode='r',
+                         offset=first*np.dtype(dtype).itemsize, shape=(last - first,))
+
+    def _write(self, name, values):
+        """Appends values to a file and flushes them to disk."""
+
+        with open(os.path.join(self.directory, name), 'ab') as f:
+            f.write(np.ascontiguousarray(values).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _truncate(self):
+        """
+        Drops values appended after the last commit (by a writer that did not
+        finish), so the files line up with the manifest again. Files of
+        columns not committed are deleted.
+        """
+
+        committed = [DATES] + [self._file(column) for column in self.columns]
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name in committed:
+                if os.path.getsize(path) > self.rows*8:
+                    with open(path, 'r+b') as f:
+                        f.truncate(self.rows*8)
+            elif name.startswith('column') and name.endswith('.bin'):
+                os.remove(path)
+
+    def _file(self, column):
+        """Name of the file holding a column."""
+
+        return COLUMN.format(self.columns.index(column))
+
+
+def results_frame(hxl):
+    """
+    Gathers the monthly results of an HXLFactors object in a single
+    DataFrame, as stored by FactorStore.
+
+    Parameters
+    ----------
+    hxl : HXLFactors
+        An HXLFactors object whose factors were calculated.
+
+    Return
+    ----------
+    values : DataFrame
+        A DataFrame (months x columns) containing the factors, the portfolio
+        returns and the breakpoints (if calculated).
+    """
+
+    columns = {factor: getattr(hxl, factor).astype(float) for factor in FACTORS}
+
+    preturn = hxl.securities['preturn']
+    for portfolio in HXLFactors.cls_labels:
+        columns['preturn/' + portfolio] = preturn.loc[portfolio]
+
+    for sort in ['size', 'IA', 'ROE']:
+        key = sort + 'breaks'
+        if key in hxl.securities:
+            breaks = hxl.securities[key]
+            for quantile in breaks.index:
+                columns['breakpoints/{}/{}'.format(sort, quantile)] = breaks.loc[quantile]
+
+    return pd.DataFrame(columns)
@@ -6,18 +6,21 @@ Created on Tue Dec 11 11:57:02 2018
 """
 
 from HXLFactors import HXLFactors
-import pandas as pd
+from HXLLoader import load_workbook
 
-prices = pd.read_excel('DataSetSPX.xlsx', sheet_name=5, index_col=0)
-marketcap = pd.read_excel('DataSetSPX.xlsx', sheet_name=4, index_col=0)
-assets = pd.read_excel('DataSetSPX.xlsx', sheet_name=3, index_col=0)
-ROE = pd.read_excel('DataSetSPX.xlsx', sheet_name=2, index_col=0)
-dividends = pd.read_excel('DataSetSPX.xlsx', sheet_name=1, index_col=0)
+if __name__ == '__main__':
+    inputs = load_workbook('DataSetSPX.xlsx')
 
-hxl = HXLFactors()
+    prices = inputs['prices']
+    marketcap = inputs['marketcap']
+    assets = inputs['assets']
+    ROE = inputs['ROE']
+    dividends = inputs['dividends']
 
-hxl.calculate_factors(prices, dividends, assets, ROE, marketcap)
+    hxl = HXLFactors()
 
-securities = hxl.securities
+    hxl.calculate_factors(prices, dividends, assets, ROE, marketcap)
 
-HXLInvestment = hxl.HXLInvestment
+    securities = hxl.securities
+
+    HXLInvestment = hxl.HXLInvestment
@@ -0,0 +1,20 @@
+"""
+@author: Vitor Eller - @VFermat
+"""
+
+import os
+import sys
+
+import pytest
+
+# The modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from HXLBenchmark import generate_panels
+
+
+@pytest.fixture(scope='session')
+def panels():
+    """Synthetic inputs shared by the tests, which must not modify them."""
+
+    return generate_panels(400, 72, seed=1)
@@ -0,0 +1,37 @@
+"""
+@author: Vitor Eller - @VFermat
+
+Tests of HXLBatch: every job of a batch against calculate_factors.
+"""
+
+import numpy as np
+import pandas as pd
+
+from HXLBatch import run_batch
+from HXLFactors import HXLFactors
+
+
+def test_run_batch_matches_calculate_factors(panels):
+
+    tickers = list(panels['prices'].index)
+    jobs = {
+            'all': (None, {}),
+            'half': (tickers[::2], {'fill': {'assets': ('ffill', 0), 
+                                             'ROE': ('ffill', 0)}}),
+            'quartiles': (tickers[:300], {'breakpoints': {'IA': [0.25, 0.75]}})
+            }
+    factors = run_batch(panels, jobs, processes=2)
+
+    assert set(factors['job']) == set(jobs)
+    for name, (universe, parameters) in jobs.items():
+        inputs = {field: values if universe is None else values.loc[
+                          values.index.isin(universe)]
+                  for field, values in panels.items()}
+        hxl = HXLFactors(**parameters)
+        hxl.calculate_factors(**inputs)
+        job = factors[factors['job'] == name].pivot(index='date', columns='factor',
+                                                    values='value')
+        for factor in ['HXLInvestment', 'HXLProfit']:
+            expected = getattr(hxl, factor).astype(float)
+            assert job.index.equals(pd.DatetimeIndex(expected.index))
+            np.testing.assert_array_equal(job[factor].values, expected.values)
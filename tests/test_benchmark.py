@@ -0,0 +1,64 @@
+"""
+@author: Vitor Eller - @VFermat
+
+Tests of HXLBenchmark: the comparison of benchmark results.
+"""
+
+import json
+
+from HXLBenchmark import VERSION, compare, main
+
+
+def result(*records):
+
+    return {'results': [{'stocks': 100, 'months': 60, 'stage': stage, 'wall': wall}
+                        for stage, wall in records]}
+
+
+def test_compare_flags_slower_stages():
+
+    baseline = result(('_get_return', 1.), ('_get_cls', 1.), ('_get_labels', 1.))
+    current = result(('_get_return', 1.2), ('_get_cls', 1.3), ('_get_labels', 0.5),
+                     ('_get_new', 9.))
+
+    assert compare(baseline, current) == [{'stocks': 100, 'months': 60,
+                                           'stage': '_get_cls', 'baseline': 1.,
+                                           'current': 1.3}]
+    assert [regression['stage'] for regression in 
+            compare(baseline, current, tolerance=0.1)] == ['_get_return', '_get_cls']
+
+
+def test_compare_renames_stages_of_older_versions():
+
+    # Before version 2 the alignments of dividends, assets and ROE were 
+    # timed as three '_get_aligned' stages
+    baseline = result(('_get_aligned', 1.), ('_get_return', 1.), 
+                      ('_get_aligned', 2.), ('_get_aligned', 3.))
+    current = dict(result(('_get_aligned[dividends]', 1.1), ('_get_return', 1.),
+                          ('_get_aligned[assets]', 3.), ('_get_aligned[ROE]', 3.)),
+                   version=VERSION)
+
+    assert compare(baseline, current) == [{'stocks': 100, 'months': 60,
+                                           'stage': '_get_aligned[assets]', 
+                                           'baseline': 2., 'current': 3.}]
+    assert compare(dict(baseline, version=VERSION), current) == []
+
+
+def test_main_fails_on_regressions(tmp_path):
+
+    path = str(tmp_path / 'bench.json')
+    assert main(['--stocks', '50', '--months', '36', '--no-memory', 
+                 '--output', path]) == 0
+    with open(path) as f:
+        current = json.load(f)
+    stages = {record['stage'] for record in current['results']}
+    assert current['version'] == VERSION
+    assert {'calculate_factors', '_get_cls', '_get_aligned[ROE]'} <= stages
+
+    # A baseline ten times faster on every stage
+    for record in current['results']:
+        record['wall'] /= 10
+    with open(path, 'w') as f:
+        json.dump(current, f)
+    assert main(['--stocks', '50', '--months', '36', '--no-memory', 
+                 '--baseline', path]) == 1
@@ -0,0 +1,42 @@
+"""
+@author: Vitor Eller - @VFermat
+
+Tests of HXLBootstrap on the factors of synthetic panels.
+"""
+
+import numpy as np
+import pytest
+
+from HXLBootstrap import _stock_factors, _stock_panels, bootstrap
+from HXLFactors import HXLFactors
+
+
+@pytest.mark.parametrize('nan_returns', ['zero', 'drop', 'propagate'])
+def test_whole_universe_gives_the_factors(panels, nan_returns):
+
+    hxl = HXLFactors(nan_returns=nan_returns)
+    hxl.calculate_factors(**panels)
+    stock_panels = _stock_panels(hxl)
+
+    # Each stock drawn once, or twice: the same portfolios
+    counts = np.vstack([np.ones(stock_panels['stocks']), 
+                        np.full(stock_panels['stocks'], 2)])
+    factors = _stock_factors(counts, stock_panels)
+    for resample in factors.transpose(1, 0, 2):
+        np.testing.assert_allclose(resample, 
+                                   np.vstack([hxl.HXLInvestment.values.astype(float),
+                                              hxl.HXLProfit.values.astype(float)]),
+                                   rtol=1e-9, atol=1e-15)
+
+
+@pytest.mark.parametrize('method', ['stocks', 'months'])
+def test_bootstrap_does_not_depend_on_threads(panels, method):
+
+    hxl = HXLFactors()
+    hxl.calculate_factors(**panels)
+    single = bootstrap(hxl, 120, method=method, block=6, batch=25, threads=1, seed=3)
+    threaded = bootstrap(hxl, 120, method=method, block=6, batch=25, threads=4, seed=3)
+
+    assert single.shape == (120, 6)
+    assert single.notna().values.all()
+    np.testing.assert_array_equal(single.values, threaded.values)
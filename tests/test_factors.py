@@ -0,0 +1,657 @@
+"""
+@author: Vitor Eller - @VFermat
+
+Regression tests of HXLFactors on synthetic panels: the classes and the
+portfolio returns against the first, loop based HXLFactors and a direct
+reference, and every other way of calculating them against 
+calculate_factors.
+"""
+
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.tseries.offsets import MonthEnd
+
+import HXLFactors as factors_module
+from HXLFactors import (HXLFactors, ResultCache, SecuritiesStore, _value_weight,
+                        _winsorize, compute_factors)
+from HXLFactors_original import HXLFactors as OriginalFactors
+from HXLLoader import iter_chunks
+from HXLSorts import SORTS, sort_portfolios
+
+FACTORS = ['HXLInvestment', 'HXLProfit']
+
+# Assets and ROE filled forward, so most months hold every sort
+FILL = {'assets': ('ffill', 0), 'ROE': ('ffill', 0)}
+
+
+@pytest.fixture(scope='module')
+def hxl(panels):
+
+    hxl = HXLFactors(fill=FILL)
+    hxl.calculate_factors(**panels)
+
+    return hxl
+
+
+def clean_panels(stocks=150, months=40, seed=3):
+    """
+    Inputs the first HXLFactors handles as intended: every stock has a 
+    positive price, marketcap, assets, ROE and dividends on every month.
+    """
+
+    rng = np.random.default_rng(seed)
+    tickers = ['S{:03d}'.format(i) for i in range(stocks)]
+    dates = pd.date_range('2001-01-31', periods=months, freq=MonthEnd())
+    frame = lambda values: pd.DataFrame(values, index=tickers, columns=dates)
+    walk = lambda drift, size: np.exp(np.cumsum(rng.normal(drift, size, 
+                                                           (stocks, months)), 
+                                                axis=1))
+
+    prices = frame(20*walk(0.01, 0.06))
+
+    return {
+            'prices': prices,
+            'dividends': frame(rng.uniform(0.001, 0.2, (stocks, months))),
+            'assets': frame(walk(0.01, 0.05)*rng.lognormal(20, 1, (stocks, 1))),
+            'ROE': frame(rng.normal(0.12, 0.15, (stocks, months))),
+            'marketcap': prices*rng.lognormal(18, 1.5, (stocks, 1))
+            }
+
+
+def reference_codes(panel, quantiles, months, eligible, universe=None):
+    """
+    Sorts a characteristic month by month: on the rebalancing months, the
+    eligible stocks with a finite, non zero value are bucketed by the
+    quantiles of those stocks (of those in the universe, if given); the other
+    months hold the last buckets.
+    """
+
+    codes = pd.DataFrame(-1, index=panel.index, columns=panel.columns)
+    current = pd.Series(-1, index=panel.index)
+    for month in panel.columns:
+        if month in months:
+            values = panel[month]
+            valid = np.isfinite(values) & (values != 0) & eligible[month]
+            sorted_on = valid if universe is None else valid & values.index.isin(universe)
+            breakpoints = values[sorted_on].quantile(quantiles)
+            buckets = sum((values > breakpoint).astype(int)
+                          for breakpoint in breakpoints)
+            current = buckets.where(valid, -1)
+        codes[month] = current
+
+    return codes
+
+
+def reference_preturn(securities):
+    """
+    Value weighted returns of the portfolios, month by month, counting NaN
+    returns as zero.
+    """
+
+    preturn = pd.DataFrame(np.nan, index=HXLFactors.cls_labels,
+                           columns=securities['cls'].columns)
+    for month in preturn.columns:
+        stocks = pd.DataFrame({'cls': securities['cls'][month],
+                               'return': securities['lreturn'][month].fillna(0),
+                               'weight': securities['marketcap'][month]}).dropna()
+        for label, group in stocks.groupby('cls'):
+            preturn.loc[label, month] = (np.sum(group['return']*group['weight'])
+                                         /np.sum(group['weight']))
+
+    return preturn
+
+
+def assert_factors(factors, hxl):
+    """Checks factors (months x factors) against those of hxl."""
+
+    for factor in FACTORS:
+        expected = getattr(hxl, factor).astype(float)
+        np.testing.assert_allclose(np.asarray(factors[factor], dtype=float),
+                                   expected.reindex(factors.index).values,
+                                   rtol=0, atol=1e-12)
+
+
+def frame(hxl):
+    """The factors of hxl, as a DataFrame (months x factors)."""
+
+    return pd.DataFrame({factor: getattr(hxl, factor).astype(float)
+                         for factor in FACTORS})
+
+
+def test_classes_match_original():
+
+    panels = clean_panels()
+    original = OriginalFactors()
+    with warnings.catch_warnings():
+        # Empty portfolios before the first June divide zero by zero
+        warnings.simplefilter('ignore', RuntimeWarning)
+        # The first HXLFactors changes the columns of its inputs
+        original.calculate_factors(**{field: values.copy()
+                                      for field, values in panels.items()})
+    hxl = HXLFactors()
+    hxl.calculate_factors(**panels)
+
+    # The first June has no I/A (no assets a year before), which the first
+    # HXLFactors sorts as high I/A
+    start = panels['prices'].columns[17]
+    assert start.month == 6
+    for key in ['sizecls', 'iacls', 'ROEcls', 'cls']:
+        pd.testing.assert_frame_equal(hxl.securities[key].loc[:, start:].astype(object),
+                                      original.securities[key].loc[:, start:],
+                                      check_freq=False)
+    for factor in FACTORS:
+        expected = getattr(original, factor).loc[start:].astype(float)
+        assert expected.notna().all()
+        np.testing.assert_allclose(getattr(hxl, factor).loc[start:].values,
+                                   expected.values, rtol=0, atol=1e-12)
+
+
+def test_classes_match_reference(hxl):
+
+    securities = hxl.securities
+    eligible = securities['eligible']
+    june = securities['marketcap'].columns[securities['marketcap'].columns.month == 6]
+    for field, sort, key, months in [('marketcap', 'size', 'sizecls', june),
+                                     ('I/A', 'IA', 'iacls', june),
+                                     ('ROE', 'ROE', 'ROEcls', eligible.columns)]:
+        codes = reference_codes(securities[field], HXLFactors.breakpoints[sort],
+                                months, eligible)
+        labels = getattr(HXLFactors, {'size': 'size_labels', 'IA': 'ia_labels',
+                                      'ROE': 'ROE_labels'}[sort])
+        expected = codes.apply(lambda column: column.map(dict(enumerate(labels))))
+        assert (codes >= 0).values.any()
+        pd.testing.assert_frame_equal(securities[key].astype(object),
+                                      expected.astype(object), check_freq=False)
+
+    expected = (securities['sizecls'] + securities['iacls']
+                + securities['ROEcls']).where(eligible)
+    pd.testing.assert_frame_equal(securities['cls'].astype(object),
+                                  expected.astype(object), check_freq=False)
+
+
+def test_portfolio_returns_match_reference(hxl):
+
+    preturn = reference_preturn(hxl.securities)
+    np.testing.assert_allclose(hxl.securities['preturn'].values, preturn.values,
+                               rtol=0, atol=1e-12)
+    spread = lambda high, low: (preturn.loc[high].mean(skipna=False)
+                                - preturn.loc[low].mean(skipna=False))
+    assert_factors(pd.DataFrame({
+            'HXLInvestment': spread(HXLFactors.high_IA, HXLFactors.low_IA),
+            'HXLProfit': spread(HXLFactors.high_ROE, HXLFactors.low_ROE)}), hxl)
+    assert hxl.HXLProfit.notna().sum() > 40
+
+
+def test_append_month_matches_full_recalculation(hxl, panels):
+
+    months = panels['prices'].columns[-15:]
+    part = lambda values: values.loc[:, values.columns < months[0]]
+    appended = HXLFactors(fill=FILL)
+    appended.calculate_factors(**{field: part(values)
+                                  for field, values in panels.items()})
+    for month in months:
+        released = lambda field: (panels[field][month]
+                                  if month in panels[field].columns else None)
+        appended.append_month(month, panels['prices'][month],
+                              panels['marketcap'][month], released('dividends'),
+                              released('assets'), released('ROE'))
+
+    assert_factors(frame(appended), hxl)
+    np.testing.assert_allclose(appended.securities['preturn'].values,
+                               hxl.securities['preturn'].values, rtol=0, atol=1e-12)
+
+
+def test_append_month_rejects_skipped_month(panels):
+
+    months = panels['prices'].columns
+    part = lambda values: values.loc[:, values.columns < months[-2]]
+    hxl = HXLFactors(fill=FILL)
+    hxl.calculate_factors(**{field: part(values) for field, values in panels.items()})
+    with pytest.raises(ValueError):
+        hxl.append_month(months[-1], panels['prices'][months[-1]],
+                         panels['marketcap'][months[-1]])
+
+
+def test_append_month_drops_new_tickers(panels):
+
+    months = panels['prices'].columns
+    part = lambda values: values.loc[:, values.columns < months[-1]]
+    hxl = HXLFactors(fill=FILL)
+    hxl.calculate_factors(**{field: part(values) for field, values in panels.items()})
+    prices = panels['prices'][months[-1]].copy()
+    prices['NEW US Equity'] = 10.
+    with pytest.warns(UserWarning, match='NEW US Equity'):
+        hxl.append_month(months[-1], prices, panels['marketcap'][months[-1]])
+
+
+def test_alignment_matches_original(panels):
+
+    pattern = panels['prices'].columns
+    expected = OriginalFactors._padronize_columns(pattern, panels['dividends'],
+                                                  panels['assets'], panels['ROE'])
+    for field, values in zip(['dividends', 'assets', 'ROE'], expected):
+        aligned = HXLFactors._get_aligned(panels[field], pattern, ('zero', 0))
+        pd.testing.assert_frame_equal(aligned, values.astype(float),
+                                      check_freq=False)
+
+    # Filled forward, each month holds the last release (even if missing), 
+    # published lag months after its date
+    aligned = HXLFactors._get_aligned(panels['assets'], pattern, ('ffill', 3))
+    published = panels['assets'].set_axis(panels['assets'].columns + MonthEnd(3),
+                                          axis=1)
+    expected = published.reindex(columns=pattern, method='ffill')
+    pd.testing.assert_frame_equal(aligned, expected, check_freq=False)
+
+
+def test_compact_store_matches_dict(hxl, panels):
+
+    compact = HXLFactors(fill=FILL, compact=True)
+    compact.compact_dtype = np.float64
+    compact.calculate_factors(**panels)
+    store = compact.securities
+
+    assert set(store) == set(hxl.securities)
+    assert_factors(frame(compact), hxl)
+    for key, expected in hxl.securities.items():
+        value = store[key]
+        if isinstance(expected, pd.DataFrame) and expected.dtypes.eq(object).any():
+            pd.testing.assert_frame_equal(value.astype(object), expected,
+                                          check_freq=False)
+        elif isinstance(expected, (pd.DataFrame, pd.Series)):
+            np.testing.assert_array_equal(np.asarray(value, dtype=float), 
+                                          np.asarray(expected, dtype=float), 
+                                          err_msg=key)
+        else:
+            assert value == expected, key
+
+    # Float32 panels: the inputs are rounded, the codes and factors are not
+    compact = HXLFactors(fill=FILL, compact=True)
+    compact.calculate_factors(**panels)
+    store = compact.securities
+
+    assert store.nbytes < sum(hxl.securities[key].values.nbytes 
+                              for key in store.arrays)
+    assert_factors(frame(compact), hxl)
+    for key in SecuritiesStore.panels:
+        np.testing.assert_allclose(store[key].values, hxl.securities[key].values,
+                                   rtol=1e-7, err_msg=key)
+    for key in SecuritiesStore.codes:
+        np.testing.assert_array_equal(store[key].values, hxl.securities[key].values)
+
+
+def test_breakpoints_and_universe(panels):
+
+    universe = list(panels['prices'].index[::3])
+    breakpoints = {'size': [0.4], 'IA': [0.2, 0.8], 'ROE': [0.25, 0.75]}
+    hxl = HXLFactors(fill=FILL, breakpoints=breakpoints, breakpoint_universe=universe)
+    hxl.calculate_factors(**panels)
+
+    securities = hxl.securities
+    eligible = securities['eligible']
+    june = eligible.columns[eligible.columns.month == 6]
+    for field, sort, key, months in [('marketcap', 'size', 'sizecode', june),
+                                     ('I/A', 'IA', 'iacode', june),
+                                     ('ROE', 'ROE', 'ROEcode', eligible.columns)]:
+        values = securities[field]
+        valid = (np.isfinite(values) & (values != 0) & eligible).loc[universe]
+        expected = values.loc[universe].where(valid).quantile(breakpoints[sort])
+        # Held from the last rebalancing, NaN before the first
+        expected.loc[:, ~expected.columns.isin(months)] = np.nan
+        np.testing.assert_allclose(securities[sort + 'breaks'].values, 
+                                   expected.ffill(axis=1).values, rtol=1e-12)
+        codes = reference_codes(values, breakpoints[sort], months, eligible,
+                                universe)
+        np.testing.assert_array_equal(securities[key].values, codes.values)
+
+
+@pytest.mark.parametrize('profile', [True, 'memory'])
+def test_profile_report(hxl, panels, profile):
+
+    records = []
+    profiled = HXLFactors(fill=FILL, profile=profile, profile_callback=records.append)
+    profiled.calculate_factors(**panels)
+    report = profiled.profile_report
+
+    assert list(report.columns) == HXLFactors.profile_columns
+    assert list(report['stage']) == [
+            '_get_aligned[dividends]', '_get_return', '_get_aligned[assets]',
+            '_get_aligned[ROE]', '_get_IA_info', '_preprocess', '_get_benchmarks', '_get_sizecls',
+            '_get_iacls', '_get_ROEcls', '_get_cls', '_get_portfolio_returns',
+            'get_investment', 'get_profit', '_get_state', '_get_labels', 
+            'calculate_factors']
+    assert [record['stage'] for record in records] == list(report['stage'])
+    assert (report[['wall', 'cpu']] >= 0).values.all()
+    assert report['wall'].iloc[-1] >= report['wall'].iloc[:-1].max()
+    assert report['traced_peak'].notna().all() == (profile == 'memory')
+    assert report.set_index('stage').loc['_get_cls', 'outputs'] == (400, 72)
+    assert_factors(frame(profiled), hxl)
+
+
+@pytest.mark.parametrize('months', [1, 13, 40])
+def test_stream_factors_matches_calculate_factors(hxl, panels, months):
+
+    streamed = HXLFactors(fill=FILL)
+    factors = pd.concat(list(streamed.stream_factors(iter_chunks(panels, months))))
+
+    assert factors.index.equals(hxl.HXLInvestment.index)
+    assert_factors(factors, hxl)
+
+
+def test_stream_factors_rejects_long_rebalancing_gaps(panels):
+
+    # Twelve months apart: the context holds the last rebalancing
+    dates = pd.date_range('2000-06-30', periods=6, freq='12ME')
+    expected = HXLFactors(fill=FILL, rebalance={'size': dates})
+    expected.calculate_factors(**panels)
+    streamed = HXLFactors(fill=FILL, rebalance={'size': dates})
+    factors = pd.concat(list(streamed.stream_factors(iter_chunks(panels, 13))))
+    assert_factors(factors, expected)
+
+    # Twenty four months apart, or a stream going on a year after the last date
+    for dates in [pd.date_range('2000-06-30', periods=3, freq='24ME'),
+                  pd.date_range('2000-06-30', periods=3, freq='12ME')]:
+        streamed = HXLFactors(fill=FILL, rebalance={'size': dates})
+        with pytest.raises(ValueError, match='size sort'):
+            list(streamed.stream_factors(iter_chunks(panels, 13)))
+
+    months = panels['prices'].columns
+    part = lambda values: values.loc[:, values.columns < months[-1]]
+    appended = HXLFactors(fill=FILL, rebalance={'size': dates})
+    appended.calculate_factors(**{field: part(values) 
+                                  for field, values in panels.items()})
+    with pytest.raises(ValueError, match='size sort'):
+        appended.append_month(months[-1], panels['prices'][months[-1]],
+                              panels['marketcap'][months[-1]])
+
+
+def test_cache_reuses_results(hxl, panels):
+
+    cache = ResultCache()
+    HXLFactors(fill=FILL, cache=cache).calculate_factors(**panels)
+    cached = HXLFactors(fill=FILL, cache=cache, profile=True)
+    cached.calculate_factors(**panels)
+
+    # Restored: nothing was calculated, so nothing was profiled
+    assert cached.profile_report is None
+    assert_factors(frame(cached), hxl)
+
+    changed = {field: values.copy() for field, values in panels.items()}
+    prices = changed['prices']
+    prices.loc[prices.iloc[:, -2].notna(), prices.columns[-2]] *= 2
+    expected = HXLFactors(fill=FILL)
+    expected.calculate_factors(**changed)
+    recalculated = HXLFactors(fill=FILL, cache=cache, profile=True)
+    recalculated.calculate_factors(**changed)
+    assert recalculated.profile_report is not None
+    assert_factors(frame(recalculated), expected)
+
+
+def test_cache_tells_long_universes_apart(panels):
+
+    tickers = list(panels['prices'].index)
+    first = pd.Index(tickers[:300])
+    second = pd.Index(tickers[:150] + tickers[250:390] + tickers[290:300])
+    # Same length and ends: their reprs are the same
+    assert repr(first) == repr(second) and not first.equals(second)
+
+    cache = ResultCache()
+    HXLFactors(fill=FILL, cache=cache, breakpoint_universe=first).calculate_factors(
+            **panels)
+    cached = HXLFactors(fill=FILL, cache=cache, breakpoint_universe=second)
+    cached.calculate_factors(**panels)
+    expected = HXLFactors(fill=FILL, breakpoint_universe=second)
+    expected.calculate_factors(**panels)
+
+    assert_factors(frame(cached), expected)
+
+
+@pytest.mark.parametrize('nan_returns', ['zero', 'drop', 'propagate'])
+def test_value_weight_nan_returns(nan_returns, monkeypatch):
+
+    rng = np.random.default_rng(0)
+    codes = rng.integers(-1, 6, (300, 40))
+    returns = rng.normal(0, 0.1, codes.shape)
+    returns[rng.random(codes.shape) < 0.05] = np.nan
+    weights = rng.lognormal(0, 1, codes.shape)
+    weights[rng.random(codes.shape) < 0.05] = np.nan
+    # An empty portfolio
+    codes[codes == 5] = 4
+
+    expected = np.full((6, 40), np.nan)
+    for portfolio in range(6):
+        for month in range(40):
+            stocks = (codes[:, month] == portfolio) & ~np.isnan(weights[:, month])
+            ret, weight = returns[stocks, month], weights[stocks, month]
+            if nan_returns == 'zero':
+                ret = np.nan_to_num(ret)
+            elif nan_returns == 'drop':
+                ret, weight = ret[~np.isnan(ret)], weight[~np.isnan(ret)]
+            if len(weight):
+                expected[portfolio, month] = np.sum(ret*weight)/np.sum(weight)
+
+    preturn = _value_weight(codes, returns, weights, 6, nan_returns, threads=1)
+    np.testing.assert_allclose(preturn, expected, rtol=1e-12, atol=1e-15)
+    assert np.isnan(preturn[5]).all()
+
+    # Blocks small enough to be reduced on four threads
+    monkeypatch.setattr(factors_module, '_value_weight_block', 1000)
+    np.testing.assert_array_equal(_value_weight(codes, returns, weights, 6, 
+                                                nan_returns, threads=4), preturn)
+
+
+def test_threads_match_single_thread(hxl, panels, monkeypatch):
+
+    monkeypatch.setattr(factors_module, '_value_weight_block', 1000)
+    threaded = HXLFactors(fill=FILL, threads=4)
+    threaded.calculate_factors(**panels)
+    single = HXLFactors(fill=FILL, threads=1)
+    single.calculate_factors(**panels)
+
+    np.testing.assert_array_equal(threaded.securities['preturn'].values,
+                                  single.securities['preturn'].values)
+    assert_factors(frame(single), hxl)
+
+
+def test_sort_portfolios_matches_calculate_factors(hxl):
+
+    securities = hxl.securities
+    result = sort_portfolios(securities, securities['lreturn'],
+                             securities['marketcap'], eligible=securities['eligible'])
+
+    np.testing.assert_array_equal(result['codes'][('size', 'IA', 'ROE')].values,
+                                  securities['clscode'].values)
+    np.testing.assert_array_equal(result['preturn'][('size', 'IA', 'ROE')].values,
+                                  securities['preturn'].values)
+    assert_factors(result['factors'], hxl)
+
+
+def test_sort_portfolios_on_other_characteristics(hxl):
+
+    securities = hxl.securities
+    sorts = {
+            'size': {'on': 'marketcap', 'quantiles': [0.5], 'rebalance': 'annual'},
+            'momentum': {'on': 'momentum', 'quantiles': [0.2, 0.4, 0.6, 0.8],
+                         'rebalance': 'monthly'}
+            }
+    factors = {'UMD': {'sorts': ['size', 'momentum'], 'spread': 'momentum'},
+               'SMB': {'sorts': ['size', 'momentum'], 'spread': 'size', 
+                       'high': 0, 'low': 1}}
+    characteristics = dict(securities, momentum=securities['price'].pct_change(
+            11, axis=1, fill_method=None))
+    result = sort_portfolios(characteristics, securities['lreturn'], 
+                             securities['marketcap'], sorts, factors, 
+                             eligible=securities['eligible'])
+
+    eligible = securities['eligible']
+    june = eligible.columns[eligible.columns.month == 6]
+    size = reference_codes(securities['marketcap'], [0.5], june, eligible)
+    momentum = reference_codes(characteristics['momentum'], 
+                               sorts['momentum']['quantiles'], eligible.columns,
+                               eligible)
+    cells = (size*5 + momentum).where((size >= 0) & (momentum >= 0) & eligible, -1)
+    codes = result['codes'][('size', 'momentum')]
+    np.testing.assert_array_equal(codes.values, cells.values)
+    assert (codes.values >= 0).any()
+
+    preturn = result['preturn'][('size', 'momentum')]
+    assert list(preturn.index) == ['size1momentum{}'.format(bucket) 
+                                   for bucket in range(1, 6)] + \
+                                  ['size2momentum{}'.format(bucket) 
+                                   for bucket in range(1, 6)]
+    spread = lambda high, low: (preturn.iloc[high].mean(skipna=False) 
+                                - preturn.iloc[low].mean(skipna=False))
+    np.testing.assert_array_equal(result['factors']['UMD'].values, 
+                                  spread([4, 9], [0, 5]).values)
+    np.testing.assert_array_equal(result['factors']['SMB'].values,
+                                  spread(list(range(5)), list(range(5, 10))).values)
+
+
+def test_compute_factors_matches_calculate_factors(hxl, panels):
+
+    copies = {field: values.copy() for field, values in panels.items()}
+    universes = [None, list(panels['prices'].index[::2]), 
+                 list(panels['prices'].index[1::2])]
+    with ThreadPoolExecutor(3) as pool:
+        results = list(pool.map(lambda universe: compute_factors(
+                fill=FILL, breakpoint_universe=universe, **panels), universes))
+
+    # Shared inputs are left as they were
+    for field, values in panels.items():
+        pd.testing.assert_frame_equal(values, copies[field])
+    for universe, result in zip(universes, results):
+        expected = HXLFactors(fill=FILL, breakpoint_universe=universe)
+        expected.calculate_factors(**panels)
+        assert_factors(pd.DataFrame({factor: getattr(result, factor)
+                                     for factor in FACTORS}), expected)
+    assert_factors(pd.DataFrame({factor: getattr(results[0], factor)
+                                 for factor in FACTORS}), hxl)
+    with pytest.raises(TypeError):
+        results[0].securities['price'] = None
+
+
+def test_evaluate_matches_calculate_factors(hxl, panels):
+
+    outputs = FACTORS + ['cls', 'clscode', 'preturn', 'ROEbreaks']
+    results = HXLFactors(fill=FILL).evaluate(outputs, **panels)
+
+    assert sorted(results) == sorted(outputs)
+    assert_factors(pd.DataFrame({factor: results[factor] for factor in FACTORS}),
+                   hxl)
+    for name in outputs[2:]:
+        pd.testing.assert_frame_equal(results[name], hxl.securities[name],
+                                      check_index_type=False,
+                                      check_column_type=False)
+
+    # Only the nodes a sort on ROE depends on are calculated
+    partial = HXLFactors(fill=FILL, profile=True)
+    codes = partial.evaluate(['ROEcode'], **panels)['ROEcode']
+    np.testing.assert_array_equal(codes.values, hxl.securities['ROEcode'].values)
+    stages = set(partial.profile_report['stage'])
+    assert stages.isdisjoint({'return', 'I/A', 'preturn', 'HXLProfit'})
+    with pytest.raises(ValueError):
+        partial.evaluate(['momentum'], **panels)
+
+
+def reference_winsorize(panel, limits):
+    """
+    Clips the finite, non zero values of each month at their quantiles,
+    leaving the other cells as they are.
+    """
+
+    valid = np.isfinite(panel) & (panel != 0)
+    bounds = panel.where(valid).quantile(list(limits))
+
+    return panel.where(~valid, panel.clip(bounds.iloc[0], bounds.iloc[-1], axis=1))
+
+
+def test_winsorize_skips_invalid_cells():
+
+    values = np.array([[1., 5, np.nan],
+                       [2, 0, np.inf],
+                       [3, 6, 1],
+                       [np.nan, 7, 4],
+                       [100, 8, -np.inf],
+                       [0, 9, 0]])
+    winsorized = _winsorize(values, (0.1, 0.9))
+
+    panel = pd.DataFrame(values)
+    np.testing.assert_array_equal(winsorized, 
+                                  reference_winsorize(panel, (0.1, 0.9)).values)
+    # Zeros are not raised to the lower bound, nor infinite values clipped
+    invalid = ~np.isfinite(values) | (values == 0)
+    np.testing.assert_array_equal(winsorized[invalid], values[invalid])
+    assert winsorized[4, 0] < 100 and winsorized[0, 0] > 1
+
+
+def test_breakpoints_skip_zeros(hxl):
+
+    securities = hxl.securities
+    ROE = securities['ROE']
+    eligible = securities['eligible']
+    quantiles = HXLFactors.breakpoints['ROE']
+    expected = ROE.where(np.isfinite(ROE) & (ROE != 0) & eligible).quantile(quantiles)
+    np.testing.assert_allclose(securities['ROEbreaks'].values, expected.values,
+                               rtol=1e-12)
+
+    # Counting the zeros would move the breakpoints
+    zeros = ROE.where(np.isfinite(ROE) & eligible).quantile(quantiles)
+    assert ((ROE == 0) & eligible).any().any()
+    assert not np.allclose(zeros.values, expected.values, equal_nan=True)
+
+
+def test_preprocess_winsorizes_and_screens_stocks(hxl, panels):
+
+    winsorize = {'I/A': (0.05, 0.95), 'ROE': (0.01, 0.99)}
+    min_marketcap = hxl.securities['marketcap'].stack().quantile(0.2)
+    screened = HXLFactors(fill=FILL, winsorize=winsorize, min_price=10, 
+                          min_marketcap=min_marketcap)
+    screened.calculate_factors(**panels)
+    securities = screened.securities
+
+    for field, limits in winsorize.items():
+        np.testing.assert_array_equal(
+                securities[field].values,
+                reference_winsorize(hxl.securities[field], limits).values)
+
+    marketcap, price = securities['marketcap'], securities['price']
+    eligible = (marketcap > 0) & (marketcap >= min_marketcap) & (price >= 10)
+    np.testing.assert_array_equal(securities['eligible'].values, eligible.values)
+    assert (eligible != hxl.securities['eligible']).any().any()
+    assert (securities['clscode'].values[~eligible.values] == -1).all()
+
+    # The breakpoints are taken from the eligible stocks only
+    ROE = securities['ROE']
+    quantiles = HXLFactors.breakpoints['ROE']
+    expected = ROE.where(np.isfinite(ROE) & (ROE != 0) & eligible).quantile(quantiles)
+    np.testing.assert_allclose(securities['ROEbreaks'].values, expected.values,
+                               rtol=1e-12)
+    assert not np.allclose(securities['ROEbreaks'].values,
+                           hxl.securities['ROEbreaks'].values, equal_nan=True)
+    codes = reference_codes(ROE, quantiles, ROE.columns, eligible)
+    np.testing.assert_array_equal(securities['ROEcode'].values, codes.values)
+
+
+def test_rebalance_dates(hxl, panels):
+
+    dates = pd.date_range('2000-09-30', periods=8, freq='9ME')
+    scheduled = HXLFactors(fill=FILL, rebalance={'IA': dates})
+    scheduled.calculate_factors(**panels)
+    listed = HXLFactors(fill=FILL, rebalance={'IA': list(dates)})
+    listed.calculate_factors(**panels)
+
+    assert_factors(frame(listed), scheduled)
+    securities = scheduled.securities
+    codes = reference_codes(securities['I/A'], HXLFactors.breakpoints['IA'],
+                            dates + MonthEnd(0), securities['eligible'])
+    np.testing.assert_array_equal(securities['iacode'].values, codes.values)
+    assert not np.array_equal(codes.values, hxl.securities['iacode'].values)
+
+    sorts = dict(SORTS, IA=dict(SORTS['IA'], rebalance=dates))
+    result = sort_portfolios(securities, securities['lreturn'],
+                             securities['marketcap'], sorts=sorts,
+                             eligible=securities['eligible'])
+    assert_factors(result['factors'], scheduled)
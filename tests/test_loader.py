@@ -0,0 +1,169 @@
+"""
+@author: Vitor Eller - @VFermat
+
+Tests of HXLLoader: the cache of the workbook, with the parsing of its 
+sheets replaced by synthetic panels.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import HXLLoader
+from HXLFactors import HXLFactors
+from HXLLoader import load_workbook
+
+
+@pytest.fixture
+def workbook(tmp_path, monkeypatch, panels):
+    """
+    A workbook whose sheets parse as the first stocks of the shared panels,
+    scaled by the number of times it was parsed.
+    """
+
+    path = str(tmp_path / 'workbook.xlsx')
+    with open(path, 'wb') as f:
+        f.write(b'first')
+    parsed = []
+
+    def parse_sheets(path, sheets, processes=None):
+        parsed.append(path)
+        return {field: panels[field].iloc[:20]*len(parsed) for field in sheets}
+
+    monkeypatch.setattr(HXLLoader, '_parse_sheets', parse_sheets)
+
+    return path, parsed
+
+
+def test_cache_is_reused_when_fresh(workbook, panels):
+
+    path, parsed = workbook
+    first = load_workbook(path, mmap=False)
+    second = load_workbook(path)
+
+    assert len(parsed) == 1
+    for field, panel in first.items():
+        pd.testing.assert_frame_equal(second[field], panel)
+        np.testing.assert_array_equal(panel.values, panels[field].iloc[:20].values)
+
+
+def test_cache_survives_touch(workbook):
+
+    path, parsed = workbook
+    load_workbook(path)
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    load_workbook(path)
+    load_workbook(path)
+
+    assert len(parsed) == 1
+
+
+@pytest.mark.parametrize('content', [b'second', b'other'])
+def test_cache_rebuilds_on_change(workbook, panels, content):
+
+    path, parsed = workbook
+    old = load_workbook(path)
+    # b'second' changes the size, b'other' only the content (and the mtime)
+    stat = os.stat(path)
+    with open(path, 'wb') as f:
+        f.write(content)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    new = load_workbook(path)
+
+    assert len(parsed) == 2
+    np.testing.assert_array_equal(new['prices'].values,
+                                  2*panels['prices'].iloc[:20].values)
+    # The memory-mapped panels of the old cache still read its values
+    np.testing.assert_array_equal(old['prices'].values,
+                                  panels['prices'].iloc[:20].values)
+
+
+@pytest.mark.parametrize('fill', [None, {'assets': ('ffill', 3), 'ROE': ('ffill', 0)}])
+def test_long_inputs_match_wide(panels, fill):
+
+    records = pd.concat([values.stack().rename('value').rename_axis(
+                                 ['ticker', 'date']).reset_index().assign(field=field)
+                         for field, values in panels.items()], ignore_index=True)
+    long = HXLLoader.from_long(records.sample(frac=1, random_state=0))
+    assert isinstance(long['assets'], pd.Series)
+
+    wide = HXLFactors(fill=fill)
+    wide.calculate_factors(**panels)
+    hxl = HXLFactors(fill=fill)
+    hxl.calculate_factors(**long)
+
+    for factor in ['HXLInvestment', 'HXLProfit']:
+        np.testing.assert_array_equal(getattr(hxl, factor).values, 
+                                      getattr(wide, factor).values)
+    np.testing.assert_array_equal(
+            hxl.securities['clscode'].reindex(wide.securities['clscode'].index).values,
+            wide.securities['clscode'].values)
+
+
+def sheets(panels):
+    """Parsed sheets of the first stocks of panels, as read from a workbook."""
+
+    return {field: panels[field].iloc[:10].copy() for field in HXLLoader.SHEETS}
+
+
+def test_validate_accepts_sheets(panels):
+
+    parsed = sheets(panels)
+    # Numbers read as text
+    parsed['assets'] = parsed['assets'].astype(str).replace('nan', np.nan)
+    parsed['prices'].index = [' {} '.format(ticker) for ticker in parsed['prices'].index]
+    validated = HXLLoader._validate(parsed)
+
+    assert validated['prices'].index.equals(panels['prices'].index[:10])
+    pd.testing.assert_frame_equal(validated['assets'], panels['assets'].iloc[:10],
+                                  check_freq=False)
+
+
+@pytest.mark.parametrize('field, change, message', [
+        ('prices', lambda sheet: sheet.rename(index={sheet.index[1]: sheet.index[0]}),
+         'repeated tickers'),
+        ('assets', lambda sheet: sheet.rename(index={sheet.index[1]: ' '}), 
+         'empty tickers'),
+        ('ROE', lambda sheet: sheet.set_axis(['x'] + list(sheet.columns[1:]), axis=1),
+         'invalid dates'),
+        ('prices', lambda sheet: sheet.iloc[:, ::-1], 'not increasing'),
+        ('prices', lambda sheet: sheet.set_axis(
+                [sheet.columns[0] - pd.Timedelta(days=10)] + list(sheet.columns[:1])
+                + list(sheet.columns[2:]), axis=1), 'more than one date'),
+        ('marketcap', lambda sheet: sheet.astype(object).where(
+                sheet.notna(), 'n/a'), 'is not a number'),
+        ('marketcap', lambda sheet: sheet.iloc[1:], 'different tickers'),
+        ('marketcap', lambda sheet: sheet.iloc[:, 1:], 'different months'),
+        ('ROE', lambda sheet: sheet.rename(index={sheet.index[0]: 'OTHER'}),
+         'not in prices')])
+@pytest.mark.filterwarnings('ignore:Could not infer format')
+def test_validate_rejects_sheets(panels, field, change, message):
+
+    parsed = sheets(panels)
+    parsed[field] = change(parsed[field])
+    with pytest.raises(ValueError, match=message):
+        HXLLoader._validate(parsed)
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_load_workbook_parses_sheets(tmp_path, panels, processes):
+
+    pytest.importorskip('openpyxl')
+    path = str(tmp_path / 'workbook.xlsx')
+    names = {'dividends': 'DividendsPerShare', 'ROE': 'ROE', 'assets': 'Assets',
+             'marketcap': ' Marketcap', 'prices': 'Price'}
+    with pd.ExcelWriter(path) as writer:
+        for field, name in names.items():
+            panels[field].iloc[:10].to_excel(writer, sheet_name=name)
+
+    loaded = load_workbook(path, processes=processes)
+    for field, panel in loaded.items():
+        pd.testing.assert_frame_equal(panel, panels[field].iloc[:10], 
+                                      check_freq=False, check_column_type=False)
+
+    with pytest.raises(ValueError, match='not found'):
+        load_workbook(path, cache_dir=str(tmp_path / 'other'), 
+                      sheets={'prices': 'Prices'})
@@ -0,0 +1,70 @@
+"""
+@author: Vitor Eller - @VFermat
+
+Tests of HXLRegression: the rolling regressions against a least squares fit
+of each window.
+"""
+
+import numpy as np
+import pandas as pd
+
+from HXLRegression import rolling_regression
+
+
+def test_rolling_regression_matches_lstsq():
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2000-01-31', periods=60, freq='ME')
+    factors = pd.DataFrame(rng.normal(0, 0.04, (60, 2)), index=dates,
+                           columns=['HXLInvestment', 'HXLProfit'])
+    factors.iloc[7] = np.nan
+    returns = pd.DataFrame(0.002 + factors.values @ rng.normal(1, 0.5, (2, 5))
+                           + rng.normal(0, 0.02, (60, 5)), index=dates).T
+    returns.iloc[1, 20:30] = np.nan
+    # A constant return, fitted by the intercept alone
+    returns.iloc[2, :] = np.nan
+    returns.iloc[2, 40:] = 0.01
+
+    regression = rolling_regression(returns, factors, window=24, min_periods=18,
+                                    chunk=2, dtype=np.float64)
+
+    solved = 0
+    for asset in range(5):
+        for month in range(60):
+            window = slice(max(month - 23, 0), month + 1)
+            y = returns.values[asset, window]
+            X = np.hstack([np.ones((len(y), 1)), factors.values[window]])
+            used = ~np.isnan(y) & ~np.isnan(X).any(axis=1)
+            observations = regression['observations'][asset, month]
+            assert observations == used.sum()
+            if observations < 18:
+                assert np.isnan(regression['alpha'][asset, month])
+                continue
+            coefficients, residual = np.linalg.lstsq(X[used], y[used], rcond=None)[:2]
+            np.testing.assert_allclose(regression['alpha'][asset, month], 
+                                       coefficients[0], rtol=1e-8, atol=1e-12)
+            np.testing.assert_allclose(regression['betas'][asset, month], 
+                                       coefficients[1:], rtol=1e-8, atol=1e-12)
+            np.testing.assert_allclose(regression['residual_vol'][asset, month], 
+                                       np.sqrt(residual[0]/(used.sum() - 3)), 
+                                       rtol=1e-6, atol=1e-9)
+            solved += 1
+
+    assert solved > 100
+    assert list(regression['factors']) == ['HXLInvestment', 'HXLProfit']
+
+
+def test_collinear_factors_are_not_solved():
+
+    rng = np.random.default_rng(1)
+    dates = pd.date_range('2000-01-31', periods=30, freq='ME')
+    first = rng.normal(0, 0.04, 30)
+    factors = pd.DataFrame({'HXLInvestment': first, 'HXLProfit': 2*first}, 
+                           index=dates)
+    returns = pd.DataFrame(rng.normal(0, 0.05, (3, 30)), columns=dates)
+
+    regression = rolling_regression(returns, factors, window=12)
+
+    assert np.isnan(regression['alpha']).all()
+    assert np.isnan(regression['betas']).all()
+    assert (regression['observations'][:, 11:] == 12).all()
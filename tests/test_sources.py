@@ -0,0 +1,118 @@
+"""
+@author: Vitor Eller - @VFermat
+
+Tests of HXLSources: the inputs fetched from files and SQLite, wide and 
+long, against the panels and calculate_factors.
+"""
+
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from HXLFactors import HXLFactors
+from HXLSources import (FIELDS, FileSource, SQLiteSource, calculate_from_sources,
+                        load_sources)
+
+FACTORS = ['HXLInvestment', 'HXLProfit']
+
+
+def long_records(panels):
+    """The panels in long format, with columns ticker, date, field and value."""
+
+    return pd.concat([values.stack().rename('value').rename_axis(
+                              ['ticker', 'date']).reset_index().assign(field=field)
+                      for field, values in panels.items()], ignore_index=True)
+
+
+def assert_matches(hxl, panels):
+    """Checks the factors and classes of hxl against calculate_factors."""
+
+    expected = HXLFactors()
+    expected.calculate_factors(**panels)
+    for factor in FACTORS:
+        np.testing.assert_array_equal(getattr(hxl, factor).values,
+                                      getattr(expected, factor).values)
+    codes = expected.securities['clscode']
+    np.testing.assert_array_equal(
+            hxl.securities['clscode'].reindex(codes.index).values, codes.values)
+
+
+@pytest.fixture
+def wide_sources(panels, tmp_path):
+
+    sources = {}
+    for field in ['prices', 'dividends', 'marketcap']:
+        path = str(tmp_path / '{}.csv'.format(field))
+        panels[field].to_csv(path)
+        sources[field] = FileSource(path, float_precision='round_trip')
+    for field in ['assets', 'ROE']:
+        path = str(tmp_path / '{}.pkl'.format(field))
+        panels[field].to_pickle(path)
+        sources[field] = FileSource(path)
+
+    return sources
+
+
+@pytest.fixture
+def long_sources(panels, tmp_path):
+
+    records = long_records(panels)
+    records['date'] = records['date'].dt.strftime('%Y-%m-%d')
+    database = str(tmp_path / 'fundamentals.db')
+    with sqlite3.connect(database) as connection:
+        records.to_sql('records', connection, index=False)
+    query = 'SELECT ticker, date, value FROM records WHERE field = ?'
+    sources = {field: SQLiteSource(database, query, (field,)) for field in FIELDS}
+
+    # Dividends from a long CSV file
+    path = str(tmp_path / 'dividends.csv')
+    records.loc[records['field'] == 'dividends', 
+                ['ticker', 'date', 'value']].to_csv(path, index=False)
+    sources['dividends'] = FileSource(path, long=True, 
+                                      float_precision='round_trip')
+
+    return sources
+
+
+def test_load_sources_reads_wide_inputs(panels, wide_sources):
+
+    loaded = load_sources(wide_sources)
+
+    assert list(loaded) == FIELDS
+    for field in FIELDS:
+        pd.testing.assert_frame_equal(loaded[field], panels[field], check_exact=True,
+                                      check_freq=False, check_index_type=False,
+                                      check_column_type=False)
+
+
+def test_load_sources_reads_long_inputs(panels, long_sources):
+
+    loaded = load_sources(long_sources)
+
+    # Prices and marketcap are pivoted, marketcap to the stocks and months 
+    # of prices
+    prices = loaded['prices']
+    pd.testing.assert_frame_equal(prices, panels['prices'].reindex(prices.index),
+                                  check_exact=True, check_freq=False, check_index_type=False,
+                                  check_column_type=False, check_names=False)
+    assert loaded['marketcap'].index.equals(prices.index)
+    assert loaded['marketcap'].columns.equals(prices.columns)
+    for field in ['dividends', 'assets', 'ROE']:
+        expected = panels[field].stack()
+        pd.testing.assert_series_equal(loaded[field].sort_index(),
+                                       expected.sort_index(), check_exact=True,
+                                       check_names=False,
+                                       check_index_type=False)
+
+
+@pytest.mark.parametrize('layout', ['wide', 'long'])
+def test_calculate_from_sources_matches_calculate_factors(panels, layout, request):
+
+    sources = request.getfixturevalue(layout + '_sources')
+    hxl = calculate_from_sources(HXLFactors(profile=True), sources)
+
+    assert_matches(hxl, panels)
+    assert list(hxl.profile_report['stage'])[:2] == ['_get_aligned[dividends]',
+                                                      '_get_return']
@@ -0,0 +1,144 @@
+"""
+@author: Vitor Eller - @VFermat
+
+Tests of the persistent results: the factor store and the out of core runs.
+"""
+
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import HXLDisk
+import HXLStore
+from HXLDisk import run_on_disk
+from HXLFactors import HXLFactors, ResultCache
+from HXLLoader import iter_chunks
+from HXLStore import FactorStore, results_frame
+
+
+def months(start, periods):
+
+    return pd.date_range(start, periods=periods, freq='ME')
+
+
+def crashed_append(store, values):
+    """Appends values, failing before the manifest commits them."""
+
+    with mock.patch.object(HXLStore.os, 'replace', side_effect=OSError('crash')):
+        with pytest.raises(OSError):
+            store.append(values)
+
+
+def assert_profit(factors, panels):
+    """Checks the HXLProfit of a run against calculate_factors."""
+
+    hxl = HXLFactors()
+    hxl.calculate_factors(**panels)
+    np.testing.assert_allclose(factors['HXLProfit'].values[:-1],
+                               hxl.HXLProfit.astype(float).values[:-1],
+                               rtol=0, atol=1e-12)
+
+
+def test_run_on_disk_resumes_and_restarts_on_revised_inputs(panels, tmp_path):
+
+    directory = str(tmp_path)
+    factors = run_on_disk(panels, directory, months=20).factors
+    assert_profit(factors, panels)
+
+    # Neither a cache nor threads change the results, so the run is kept
+    with mock.patch.object(HXLDisk, '_create_arrays',
+                           side_effect=AssertionError('restarted')):
+        rerun = run_on_disk(panels, directory, months=20, cache=ResultCache(),
+                            threads=2)
+    assert rerun.factors.equals(factors)
+
+    revised = dict(panels, dividends=panels['dividends']*2)
+    assert_profit(run_on_disk(revised, directory, months=20).factors, revised)
+
+    # A parameter the results depend on starts the run over
+    with mock.patch.object(HXLDisk, '_create_arrays',
+                           wraps=HXLDisk._create_arrays) as create:
+        run_on_disk(revised, directory, months=20, nan_returns='drop')
+    create.assert_called_once()
+
+
+def test_run_on_disk_resumes_interrupted_runs(panels, tmp_path):
+
+    chunks = []
+
+    def interrupted(panels, months):
+        for chunk in iter_chunks(panels, months):
+            if len(chunks) == 2:
+                raise KeyboardInterrupt
+            chunks.append(chunk)
+            yield chunk
+
+    with mock.patch.object(HXLDisk, 'iter_chunks', interrupted):
+        with pytest.raises(KeyboardInterrupt):
+            run_on_disk(panels, str(tmp_path), months=20)
+    assert HXLDisk._read_manifest(str(tmp_path))['done'] > 0
+
+    # The rerun only streams the months not written, with their context
+    with mock.patch.object(HXLDisk, 'iter_chunks',
+                           wraps=iter_chunks) as stream:
+        factors = run_on_disk(panels, str(tmp_path), months=20).factors
+    assert stream.call_args[0][0]['prices'].shape[1] < panels['prices'].shape[1]
+    assert factors.equals(run_on_disk(panels, str(tmp_path / 'full'),
+                                      months=20).factors)
+    assert_profit(factors, panels)
+
+
+def test_store_keeps_results(panels, tmp_path):
+
+    hxl = HXLFactors()
+    hxl.calculate_factors(**panels)
+    with FactorStore(str(tmp_path), 'a') as store:
+        store.append_factors(hxl)
+
+    expected = results_frame(hxl).iloc[:-1]
+    store = FactorStore(str(tmp_path))
+    pd.testing.assert_frame_equal(store.read(), expected, check_freq=False,
+                                  check_index_type=False)
+    pd.testing.assert_series_equal(store.read('HXLProfit', '2003-01-31', '2003-12-31'),
+                                   expected['HXLProfit'].loc['2003'],
+                                   check_freq=False, check_index_type=False)
+
+
+def test_store_drops_crashed_appends(tmp_path):
+
+    good = pd.DataFrame({'a': [1., 2, 3], 'b': [4., 5, 6]},
+                        index=months('2000-01-31', 3))
+    more = good.set_axis(months('2000-04-30', 3))
+
+    # A first append crashing leaves no manifest behind
+    store = FactorStore(str(tmp_path), 'a')
+    crashed_append(store, good*10)
+    store.close()
+    with FactorStore(str(tmp_path), 'a') as store:
+        store.append(good)
+        # A failed append retried by the same writer
+        crashed_append(store, more*10)
+        store.append(more)
+
+    pd.testing.assert_frame_equal(FactorStore(str(tmp_path)).read(),
+                                  pd.concat([good, more]), check_freq=False,
+                                  check_index_type=False)
+
+
+def test_store_has_one_writer_and_refreshed_readers(tmp_path):
+
+    first = pd.DataFrame({'a': [1., 2]}, index=months('2000-01-31', 2))
+    with FactorStore(str(tmp_path), 'a') as store:
+        store.append(first)
+        with pytest.raises(RuntimeError):
+            FactorStore(str(tmp_path), 'a')
+
+        reader = FactorStore(str(tmp_path))
+        store.append(first.set_axis(months('2000-03-31', 2)))
+        with pytest.raises(ValueError):
+            store.append(first)
+        assert len(reader.read('a')) == 2
+        reader.refresh()
+        assert list(reader.read('a', start='2000-02-29', end='2000-03-31')) == [2., 1.]